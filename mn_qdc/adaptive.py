@@ -0,0 +1,186 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+
+from logging import getLogger
+
+from .retry import TRANSIENT_ERRORS, describe
+
+# latency samples are normalized to seconds per call plus this many bytes,
+# so that large uploads do not look like a slow MN
+LATENCY_UNIT = 1024 * 1024
+
+
+class AdaptiveLimiter():
+    """
+    Limit on the number of concurrent MN uploads that adapts to the MN,
+    additive-increase/multiplicative-decrease (AIMD) style.
+
+    After every ``limit`` uploads that succeed without a rise in latency,
+    the limit grows by one. A transient error (such as a 503 or a timeout),
+    or a short-term latency average more than ``tolerance`` times the
+    long-term one, cuts the limit by ``backoff``. Only calls that started
+    under the current limit can change it, so a burst of failures from
+    calls made under the old limit cuts it once. Cuts are logged at INFO,
+    increases at DEBUG.
+
+    Latency is measured per call, normalized by the size of the object.
+    The limiter can be shared by threads (slot()) or by the tasks of one
+    event loop (aslot()). If ``metrics`` is given, the current limit is
+    published as the ``concurrency_limit`` gauge.
+    """
+    def __init__(self, maximum: int, minimum: int=1, initial: int=None, tolerance: float=2.0,
+                 backoff: float=0.5, transient: tuple=TRANSIENT_ERRORS, metrics=None):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = max(self.minimum, min(initial or self.maximum // 4, self.maximum))
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.transient = transient
+        self.metrics = metrics
+        self.in_flight = 0
+        self.lowest = self.highest = self.limit
+        self.increases = 0
+        self.decreases = 0
+        self._epoch = 0
+        self._successes = 0
+        self._short = None
+        self._long = None
+        self._cond = threading.Condition()
+        self._waiters = deque()
+        self._publish()
+
+    def _publish(self):
+        if self.metrics:
+            self.metrics.gauge('concurrency_limit', self.limit)
+
+    def _set_limit(self, limit: int, reason: str):
+        """
+        Change the limit; must be called with the condition held.
+        """
+        L = getLogger(__name__)
+        limit = max(self.minimum, min(limit, self.maximum))
+        self._epoch += 1
+        self._successes = 0
+        if limit == self.limit:
+            return
+        if limit > self.limit:
+            self.increases += 1
+        else:
+            self.decreases += 1
+        # backing off is worth noting; the steady climb in between is not
+        log = L.debug if limit > self.limit else L.info
+        log(f'Concurrency limit {self.limit} -> {limit} ({reason})')
+        self.limit = limit
+        self.lowest = min(self.lowest, limit)
+        self.highest = max(self.highest, limit)
+        self._publish()
+        self._wake()
+
+    def _wake(self):
+        """
+        Hand free slots to waiting tasks and wake waiting threads; must be
+        called with the condition held.
+        """
+        while self._waiters and self.in_flight < self.limit:
+            loop, fut = self._waiters.popleft()
+            self.in_flight += 1
+            loop.call_soon_threadsafe(self._grant, fut)
+        self._cond.notify_all()
+
+    def _grant(self, fut: asyncio.Future):
+        if fut.cancelled():
+            self._release(None)
+        else:
+            fut.set_result(None)
+
+    def _observe(self, epoch: int, seconds: float, size: int, error: BaseException):
+        """
+        Adjust the limit after a call; must be called with the condition held.
+        """
+        if epoch != self._epoch:
+            return
+        if error is not None:
+            if isinstance(error, self.transient):
+                self._set_limit(int(self.limit * self.backoff), describe(error))
+            return
+        sample = seconds / (1 + size / LATENCY_UNIT)
+        self._short = sample if self._short is None else 0.7 * self._short + 0.3 * sample
+        self._long = sample if self._long is None else 0.98 * self._long + 0.02 * sample
+        if self._short > self._long * self.tolerance:
+            self._set_limit(int(self.limit * self.backoff),
+                            f'latency {round(self._short, 3)} s, usually {round(self._long, 3)} s')
+            # start from the new level, so one slow period cuts the limit once
+            self._long = self._short
+            return
+        self._successes += 1
+        if self._successes >= self.limit:
+            self._set_limit(self.limit + 1, 'latency stable')
+
+    def _release(self, epoch: int=None, seconds: float=0, size: int=0, error: BaseException=None):
+        with self._cond:
+            self.in_flight -= 1
+            if epoch is not None:
+                self._observe(epoch, seconds, size, error)
+            self._wake()
+
+    @contextmanager
+    def slot(self, size: int=0):
+        """
+        Context manager that holds one of ``limit`` slots for an upload of
+        ``size`` bytes, blocking the thread until one is free.
+        """
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+            epoch = self._epoch
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._release(epoch, time.perf_counter() - start, size, error)
+
+    @asynccontextmanager
+    async def aslot(self, size: int=0):
+        """
+        Async counterpart of slot(); waits without blocking the event loop.
+        """
+        with self._cond:
+            if self.in_flight < self.limit and not self._waiters:
+                self.in_flight += 1
+                fut = None
+            else:
+                fut = asyncio.get_running_loop().create_future()
+                self._waiters.append((asyncio.get_running_loop(), fut))
+        if fut:
+            try:
+                await fut
+            except asyncio.CancelledError:
+                # a waiter cancelled before its slot was granted gives it back in _grant
+                if fut.done() and not fut.cancelled():
+                    self._release()
+                raise
+        with self._cond:
+            epoch = self._epoch
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._release(epoch, time.perf_counter() - start, size, error)
+
+    def summary(self):
+        return {
+            'Concurrency limit': f'{self.limit} (lowest {self.lowest}, highest {self.highest}, '
+                                 f'{self.increases} increases, {self.decreases} decreases)',
+        }
@@ -0,0 +1,462 @@
+import uuid
+import signal
+import asyncio
+import datetime
+from pathlib import Path
+from contextlib import nullcontext
+from typing import Union, Iterable, Callable
+
+import aiohttp
+import d1_common.url
+import d1_common.xml
+import d1_common.types.exceptions
+import d1_common.types.dataoneTypes
+
+from logging import getLogger
+
+from . import run
+from .journal import Journal
+from .trace import span
+from .preflight import aowned_by
+
+# aiohttp's own transient errors, in addition to retry.TRANSIENT_ERRORS
+AIO_TRANSIENT_ERRORS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+
+
+class AsyncMemberNodeClient():
+    """
+    asyncio client for the MN calls that mnqdc makes (create, delete and
+    getSystemMetadata).
+
+    All requests share one aiohttp keep-alive connection pool, and at most
+    ``max_in_flight`` requests are outstanding at any time. Files passed to
+    create() are only opened once their request holds a slot, and aiohttp
+    reads them in a thread so the event loop never blocks on disk.
+    Use as an async context manager.
+    """
+    def __init__(self, base_url: str, headers: dict=None, max_in_flight: int=100,
+                 timeout_sec: float=60, verify_tls: bool=True):
+        self.base_url = base_url
+        self.headers = headers or {}
+        self.max_in_flight = max_in_flight
+        self.timeout_sec = timeout_sec
+        self.verify_tls = verify_tls
+        self._sem = None
+        self._session = None
+
+    async def __aenter__(self):
+        self._sem = asyncio.Semaphore(self.max_in_flight)
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight,
+                                         limit_per_host=self.max_in_flight,
+                                         ssl=None if self.verify_tls else False)
+        timeout = aiohttp.ClientTimeout(total=None,
+                                        sock_connect=self.timeout_sec,
+                                        sock_read=self.timeout_sec)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.headers)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._session.close()
+
+    def _url(self, *elements):
+        return d1_common.url.joinPathElements(self.base_url, 'v2',
+                                              *[d1_common.url.encodePathElement(e) for e in elements])
+
+    def _raise(self, status: int, body: bytes):
+        """
+        Raise the DataONE exception described by an error response.
+        """
+        try:
+            e = d1_common.types.exceptions.deserialize(body)
+        except d1_common.types.exceptions.ServiceFailure:
+            # not a DataONE error document; map the HTTP status instead
+            e = d1_common.types.exceptions.create_exception_by_error_code(
+                status, description=body[:1024].decode('utf-8', 'replace'))
+        raise e
+
+    async def _request(self, method: str, url: str, data=None):
+        async with self._session.request(method, url, data=data) as response:
+            body = await response.read()
+            if response.status != 200:
+                self._raise(response.status, body)
+            return d1_common.xml.deserialize(body)
+
+    async def _send_object(self, method: str, url: str, fields: dict, obj: Union[bytes, str, Path], sysmeta_pyxb):
+        """
+        Send an object and its sysmeta as a multipart form, after the other
+        form ``fields``. With run.LIMITER set, the request first waits for
+        one of its slots.
+        """
+        async with run.LIMITER.aslot(sysmeta_pyxb.size) if run.LIMITER else nullcontext(), self._sem:
+            # timed from here so that waiting for a slot is not counted as MN latency
+            with run.METRICS.time('mn_create'):
+                stream = open(obj, 'rb') if isinstance(obj, Path) else None
+                try:
+                    form = aiohttp.FormData()
+                    for name, value in fields.items():
+                        form.add_field(name, value)
+                    form.add_field('object', stream or obj, filename='content.bin',
+                                   content_type='application/octet-stream')
+                    form.add_field('sysmeta', sysmeta_pyxb.toxml('utf-8'), filename='sysmeta.xml',
+                                   content_type='text/xml')
+                    return await self._request(method, url, data=form)
+                finally:
+                    if stream:
+                        stream.close()
+
+    async def create(self, pid: str, obj: Union[bytes, str, Path], sysmeta_pyxb):
+        """
+        MNStorage.create. ``obj`` may be bytes, str, or the Path of a file to
+        stream from disk.
+        """
+        return await self._send_object('POST', self._url('object'), {'pid': pid}, obj, sysmeta_pyxb)
+
+    async def update(self, pid: str, obj: Union[bytes, str, Path], new_pid: str, sysmeta_pyxb):
+        """
+        MNStorage.update: create ``new_pid`` as the next version of ``pid``.
+        """
+        return await self._send_object('PUT', self._url('object', pid), {'newPid': new_pid}, obj, sysmeta_pyxb)
+
+    async def delete(self, pid: str):
+        """
+        MNStorage.delete
+        """
+        async with self._sem:
+            return await self._request('DELETE', self._url('object', pid))
+
+    async def getSystemMetadata(self, pid: str):
+        """
+        MNRead.getSystemMetadata
+        """
+        async with self._sem:
+            return await self._request('GET', self._url('meta', pid))
+
+
+async def acreate_object(aclient: AsyncMemberNodeClient, pid: str, obj: Union[bytes, str, Path], sysmeta_pyxb,
+                         size: int=0, obsoletes: str=None):
+    """
+    Async counterpart of run.create_object.
+    """
+    L = getLogger(__name__)
+    attempts = 0
+    async def _create():
+        nonlocal attempts
+        attempts += 1
+        try:
+            with span(run.TRACER, 'create', pid=pid, bytes=size, attempt=attempts):
+                if obsoletes:
+                    return await aclient.update(obsoletes, obj, pid, sysmeta_pyxb)
+                return await aclient.create(pid, obj, sysmeta_pyxb)
+        except d1_common.types.exceptions.IdentifierNotUnique:
+            if attempts == 1:
+                raise
+            L.info(f'{pid} was created by an earlier attempt')
+            return d1_common.types.dataoneTypes.identifier(pid)
+    identifier = await run.RETRY.acall(_create, what=f'update {obsoletes} to {pid}' if obsoletes else f'create {pid}',
+                                       size=size, transient=AIO_TRANSIENT_ERRORS)
+    run.METRICS.inc('objects_created_total')
+    run.METRICS.inc('bytes_uploaded_total', size)
+    return identifier
+
+
+async def arollback(aclient: AsyncMemberNodeClient, doi: str, pids: list, sizes: dict=None):
+    """
+    Async counterpart of run.rollback; the objects are deleted concurrently.
+    """
+    L = getLogger(__name__)
+    sizes = sizes or {}
+    L.info(f'{doi} Removing objects...')
+    async def _delete(pid):
+        try:
+            await run.RETRY.acall(lambda: aclient.delete(pid), what=f'delete {pid}',
+                                  transient=AIO_TRANSIENT_ERRORS)
+            return sizes.get(pid, 0)
+        except d1_common.types.exceptions.NotFound:
+            L.debug(f'{doi} {pid} was not on the MN')
+        except Exception as e:
+            L.error(f'{doi} Could not delete {pid} ({run.describe(e)}); it must be removed by hand')
+        return None
+    with run.METRICS.time('rollback'), span(run.TRACER, 'rollback', doi=doi, objects=len(pids)):
+        results = await asyncio.gather(*[_delete(pid) for pid in pids])
+    deleted = [size for size in results if size is not None]
+    run.RETRY.record_rollback(sum(deleted))
+    L.info(f'Successfully deleted {len(deleted)} of {len(pids)} objects.')
+
+
+async def aupload_data_object(orcid: str, doi: str, f: Path, data_pid: str, aclient: AsyncMemberNodeClient,
+                              journal: Journal=None, checksum: tuple=None):
+    """
+    Async counterpart of run.upload_data_object. Hashing runs in a thread.
+    With tracing on, each upload gets a lane of its own.
+    """
+    L = getLogger(__name__)
+    if run.TRACER:
+        run.TRACER.lane(f'{doi} {f.name}')
+    with span(run.TRACER, 'upload', doi=doi, file=f.name, pid=data_pid):
+        size, digest = checksum or await asyncio.to_thread(run.checksum_file, f)
+        data_sm = run.generate_sys_meta(data_pid, None, run.get_format(f), size, digest,
+                                        datetime.datetime.now(), orcid)
+        L.info(f'{doi} Uploading {f.name}')
+        await asyncio.to_thread(run.renew_lease, doi)
+        dmd = await acreate_object(aclient, data_pid, f, data_sm, size=size)
+    L.debug(f'{doi} Received response for science object upload', extra={'body': dmd})
+    if journal:
+        await asyncio.to_thread(journal.add_object, doi, f, data_pid, (size, digest), run.CHECKSUM_ALGORITHM)
+    return dmd
+
+
+async def acreate_package(orcid: str, doi: str, qdc_bytes: str, aclient: AsyncMemberNodeClient,
+                          journal: Journal=None):
+    """
+    Async counterpart of run.create_package, with the same steps, journal
+    and dedup handling, retries and rollback. All data objects of the package are
+    uploaded concurrently, limited only by the client's in-flight cap.
+    """
+    L = getLogger(__name__)
+    qdc_pid, data_pids, ore_pid = None, None, None
+    uploaded = []
+    paths = {}
+    done = {}
+    reused = set()
+    new_keys = {}
+    prev_qdc, prev_ore = None, None
+    recorded = (None, None)
+    record_fp = run.record_fingerprint(qdc_bytes)
+    if journal:
+        # the journal is SQLite; keep its disk writes off the event loop
+        await asyncio.to_thread(journal.start, doi)
+        qdc_pid = await asyncio.to_thread(journal.get_qdc_pid, doi)
+        done = await asyncio.to_thread(journal.get_objects, doi)
+        reused = await asyncio.to_thread(journal.reused_pids, doi)
+        prev_qdc, prev_ore = await asyncio.to_thread(journal.get_previous, doi)
+        recorded = await asyncio.to_thread(journal.get_fingerprints, doi)
+    try:
+        if qdc_pid:
+            L.info(f'{doi} Resuming with metadata object {qdc_pid} and {len(done)} data objects')
+        elif prev_qdc and recorded[0] == record_fp:
+            L.info(f'{doi} QDC record unchanged; keeping metadata object {prev_qdc}')
+            qdc_pid = prev_qdc
+            await asyncio.to_thread(journal.set_qdc_pid, doi, qdc_pid)
+        else:
+            qdc_pid = str(uuid.uuid4())
+            meta_sm = run.generate_system_metadata(pid=qdc_pid,
+                                                   sid=doi,
+                                                   format_id='http://ns.dataone.org/metadata/schema/onedcx/v1.0',
+                                                   science_object=qdc_bytes,
+                                                   orcid=orcid,
+                                                   obsoletes=prev_qdc)
+            if prev_qdc:
+                L.info(f'{doi} Updating metadata object {prev_qdc}')
+            L.debug(f'{doi} Uploading metadata object')
+            await asyncio.to_thread(run.renew_lease, doi)
+            rmd = await acreate_object(aclient, qdc_pid, qdc_bytes, meta_sm, size=meta_sm.size, obsoletes=prev_qdc)
+            L.debug(f'{doi} Received response for metadata object upload', extra={'body': rmd})
+            if journal:
+                await asyncio.to_thread(journal.set_qdc_pid, doi, qdc_pid)
+        with span(run.TRACER, 'search_versions', doi=doi) as sp:
+            files = await asyncio.to_thread(run.search_versions, doi)
+            sp['files'] = len(files)
+        if len(files) == 0:
+            raise FileNotFoundError(f'{doi} No files found for this version chain!')
+        data_pids = [done.get(str(f)) for f in files]
+        paths = {data_pids[i]: files[i] for i in range(len(files)) if data_pids[i] and data_pids[i] not in reused}
+        uploaded = list(paths)
+        todo = [i for i, data_pid in enumerate(data_pids) if not data_pid]
+        keys = {}
+        reuses = {}
+        pending = {}
+        if run.DEDUP:
+            verify = aowned_by(aclient, orcid)
+            sums = await asyncio.gather(*[asyncio.to_thread(run.checksum_file, files[i]) for i in todo])
+            keys = dict(zip(todo, sums))
+            ticket = run.DEDUP.ticket()
+            unique = []
+            for i in todo:
+                if keys[i] not in new_keys:
+                    # check candidates here, so that reserve_object does not block the loop on the MN
+                    await run.DEDUP.aget(keys[i], verify)
+                data_pids[i], pending[i], reuses[i] = run.reserve_object(doi, files[i], keys[i], new_keys, ticket)
+                if data_pids[i] and reuses[i] is None:
+                    unique.append(i)
+            pending = {i: fut for i, fut in pending.items() if fut}
+            todo = unique
+        else:
+            for i in todo:
+                data_pids[i] = str(uuid.uuid4())
+        paths.update((data_pids[i], files[i]) for i in todo)
+        tasks = [asyncio.ensure_future(aupload_data_object(orcid, doi, files[i], data_pids[i], aclient,
+                                                           journal, keys.get(i)))
+                 for i in todo]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # let the other uploads settle so every object that may be on the MN can be rolled back
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            uploaded.extend(data_pids[i] for task, i in zip(tasks, todo) if not task.cancelled())
+        for i, fut in pending.items():
+            with span(run.TRACER, 'dedup_wait', doi=doi, file=files[i].name):
+                data_pids[i] = new_keys.get(keys[i]) or await asyncio.wrap_future(fut)
+            if data_pids[i]:
+                reuses[i] = keys[i] not in new_keys
+                L.info(f'{doi} {files[i].name} was uploaded by a concurrent package as {data_pids[i]}; reusing it')
+                run.DEDUP.record_saving(keys[i][0])
+                continue
+            L.info(f'{doi} The package uploading {files[i].name} failed; uploading it here')
+            data_pids[i] = new_keys[keys[i]] = str(uuid.uuid4())
+            paths[data_pids[i]] = files[i]
+            uploaded.append(data_pids[i])
+            await aupload_data_object(orcid, doi, files[i], data_pids[i], aclient, journal, keys[i])
+        if journal:
+            for i, other in reuses.items():
+                if other is not None:
+                    await asyncio.to_thread(journal.add_object, doi, files[i], data_pids[i], keys[i],
+                                            run.CHECKSUM_ALGORITHM, reused=other)
+        data_pids = list(dict.fromkeys(data_pids))
+        ore_pid = str(uuid.uuid4())
+        with span(run.TRACER, 'ore', doi=doi, objects=len(data_pids)):
+            ore_bytes = await asyncio.to_thread(run.build_resource_map, ore_pid, qdc_pid, data_pids)
+        ore_meta = run.generate_system_metadata(pid=ore_pid,
+                                                sid=run.ore_sid(doi),
+                                                format_id='http://www.openarchives.org/ore/terms',
+                                                science_object=ore_bytes,
+                                                orcid=orcid,
+                                                obsoletes=prev_ore)
+        L.info(f'{doi} Updating resource map {prev_ore}' if prev_ore else f'{doi} Uploading resource map')
+        await asyncio.to_thread(run.renew_lease, doi)
+        mmd = await acreate_object(aclient, ore_pid, ore_bytes, ore_meta, size=ore_meta.size, obsoletes=prev_ore)
+        L.debug(f'{doi} Received response for resource map upload', extra={'body': mmd})
+        if journal:
+            files_fp = await asyncio.to_thread(run.files_fingerprint, files, run.DATA_ROOT)
+            await asyncio.to_thread(journal.finish, doi, ore_pid, (record_fp, files_fp))
+        if run.DEDUP:
+            for key, data_pid in new_keys.items():
+                run.DEDUP.add(key, data_pid)
+            new_keys = {}
+    except Exception as e:
+        L.error(f'{doi} upload failed ({run.describe(e)})')
+        if journal and run.RETRY.is_transient(e, AIO_TRANSIENT_ERRORS):
+            L.info(f'{doi} Keeping the objects created so far for the next run to resume from')
+            raise
+        sizes = {}
+        for pid, f in paths.items():
+            try:
+                sizes[pid] = f.stat().st_size
+            except OSError:
+                pass
+        own_qdc = [qdc_pid] if qdc_pid and qdc_pid != prev_qdc else []
+        await arollback(aclient, doi, ([ore_pid] if ore_pid else []) + uploaded + own_qdc, sizes)
+        if journal:
+            await asyncio.to_thread(journal.fail, doi)
+        raise
+    finally:
+        for key, data_pid in new_keys.items():
+            run.DEDUP.release(key, data_pid)
+    return qdc_pid
+
+
+async def apackage_record(i: int, doi: str, qdc: str, orcid: str, aclient: AsyncMemberNodeClient,
+                          journal: Journal=None):
+    """
+    Async counterpart of run.package_record.
+    """
+    L = getLogger(__name__)
+    L.debug(f'({i}) {doi} QDC record', extra={'body': qdc})
+    if journal and await asyncio.to_thread(journal.is_done, doi):
+        if not (run.DELTA and await asyncio.to_thread(run.package_changed, doi, qdc, journal)):
+            L.info(f'({i}) {doi} already done according to journal; skipping')
+            return doi, True
+        L.info(f'({i}) {doi} changed since it was uploaded; updating it')
+        await asyncio.to_thread(journal.begin_update, doi)
+    L.info(f'({i}) Working on {doi}')
+    if run.TRACER:
+        run.TRACER.lane(doi)
+    try:
+        with span(run.TRACER, 'package', doi=doi, record=i):
+            qdc_pid = await acreate_package(orcid, doi, qdc, aclient, journal=journal)
+        L.info(f'{doi} done. PID: {qdc_pid}')
+        run.METRICS.inc('packages_total', result='success')
+        return doi, True
+    except Exception as e:
+        L.error(f'{doi} failed: {run.describe(e)}')
+        run.METRICS.inc('packages_total', result='failure')
+        return doi, False
+
+
+async def acreate_packages(qdcs: Iterable, orcid: str, aclient: AsyncMemberNodeClient, workers: int=1,
+                           journal: Journal=None, on_result: Callable=None, batched: bool=False):
+    """
+    Create up to ``workers`` packages concurrently on one event loop.
+    Results are reported in record order. On SIGINT no new packages are
+    started, and the ones in flight are allowed to finish before the report
+    is generated. If given, ``on_result(doi, success)`` is called as each
+    package finishes. ``batched`` is as in run.create_packages.
+    Returns the lists of successful and failed DOIs.
+    """
+    L = getLogger(__name__)
+    loop = asyncio.get_running_loop()
+    async def record(i: int, doi: str, qdc: str):
+        result = await apackage_record(i, doi, qdc, orcid, aclient, journal)
+        if on_result:
+            on_result(*result)
+        return result
+    async def run_batch(batch: list):
+        done = []
+        for i, doi, qdc in batch:
+            done.append((i, await record(i, doi, qdc)))
+            if stop.is_set():
+                break
+        return done
+    stop = asyncio.Event()
+    try:
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+    except NotImplementedError:
+        pass
+    results = {}
+    pending = {}
+    try:
+        for batch in qdcs if batched else run.numbered(qdcs):
+            while len(pending) >= workers and not stop.is_set():
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    del pending[task]
+                    results.update(task.result())
+            if stop.is_set():
+                L.info('Caught KeyboardInterrupt; waiting for in-flight packages...')
+                break
+            pending[asyncio.ensure_future(run_batch(batch))] = batch
+        if pending:
+            await asyncio.wait(pending)
+        for task in pending:
+            results.update(task.result())
+    finally:
+        try:
+            loop.remove_signal_handler(signal.SIGINT)
+        except NotImplementedError:
+            pass
+        succ_list = [results[i][0] for i in sorted(results) if results[i][1]]
+        err_list = [results[i][0] for i in sorted(results) if not results[i][1]]
+        stats = {}
+        if run.DEDUP:
+            stats.update(run.DEDUP.summary())
+        stats.update(run.RETRY.summary())
+        if run.LIMITER:
+            stats.update(run.LIMITER.summary())
+        stats.update(run.METRICS.summary())
+        run.report(succ=len(succ_list), fail=len(err_list), finished_dois=succ_list, failed_dois=err_list,
+                   stats=stats)
+    return succ_list, err_list
+
+
+def create_packages_async(qdcs: Iterable, orcid: str, mn_url: str, headers: dict, workers: int=1,
+                          max_in_flight: int=100, journal: Journal=None, on_result: Callable=None,
+                          batched: bool=False):
+    """
+    Run acreate_packages on a new event loop.
+    """
+    async def _main():
+        async with AsyncMemberNodeClient(mn_url, headers=headers, max_in_flight=max_in_flight) as aclient:
+            return await acreate_packages(qdcs, orcid, aclient, workers=workers, journal=journal,
+                                         on_result=on_result, batched=batched)
+    return asyncio.run(_main())
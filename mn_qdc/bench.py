@@ -0,0 +1,333 @@
+import sys
+import json
+import time
+import uuid
+import logging
+import random
+import tempfile
+import argparse
+import platform
+import subprocess
+import multiprocessing
+from pathlib import Path
+
+from logging import getLogger
+
+from . import run
+from .config import setup_logging
+from .logs import JSONFormatter, BODY_LIMIT, queue_handlers
+from .mockmn import MockMemberNode
+from .dedup import DedupRegistry
+from .index import build_index
+from .retry import RetryPolicy
+from .metrics import Metrics
+from .workqueue import WorkQueue, run_shard
+from .ore import resource_map
+
+RESULT_VERSION = 1
+QDC_RECORD = """<qdc:qualifieddc xmlns:qdc="http://dspace.org/qualifieddc/" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:dcterms="http://purl.org/dc/terms/">
+  <dc:title>Synthetic record %(n)d</dc:title>
+  <dc:creator>Benchmark, Synthetic</dc:creator>
+  <dc:description>%(description)s</dc:description>
+  <dc:identifier>%(doi)s</dc:identifier>
+</qdc:qualifieddc>
+"""
+# PIDs that need escaping in URIs and XML, included in every resource map check
+AWKWARD_PIDS = ['pid with spaces', 'a&b<c>"d\'e', 'doi:10.5072/x/y#z?q=1', 'r\u00e9sum\u00e9/\u00fc']
+
+
+def generate_dataset(root: Path, packages: int, files: int, size: int, versions: int=1, seed: int=0):
+    """
+    Write a synthetic QDC export and DATA_ROOT tree under ``root``.
+
+    Each package gets ``files`` files of about ``size`` bytes. With
+    ``versions`` > 1, the QDC record points at a version that has no
+    directory, and the earlier ``versions`` directories share the same files,
+    as is common in Figshare mirrors.
+    Returns the path of the QDC file and the data root.
+    """
+    rnd = random.Random(seed)
+    data_root = root / 'data'
+    qdc_file = root / 'qdc.xml'
+    with open(qdc_file, 'w') as qf:
+        qf.write('<?xml version="1.0" encoding="UTF-8"?>\n<wrapper>\n')
+        for n in range(packages):
+            doiroot = f'10.5072/bench.{n}'
+            contents = [rnd.randbytes(max(1, int(size * rnd.uniform(0.5, 1.5)))) for _ in range(files)]
+            for v in range(1, versions + 1):
+                d = data_root / f'{doiroot}.v{v}'
+                d.mkdir(parents=True, exist_ok=True)
+                for i, content in enumerate(contents):
+                    (d / f'file{i}.csv').write_bytes(content)
+            doi = f'{doiroot}.v{versions + 1 if versions > 1 else 1}'
+            qf.write(QDC_RECORD % {'n': n, 'doi': doi, 'description': 'x' * 500})
+        qf.write('</wrapper>\n')
+    return qdc_file, data_root
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class TimedHandler(logging.Handler):
+    """
+    Pass records to ``handler``, counting them and the time the threads that
+    log them spend handling them. Wrapping a QueueHandler measures only the
+    cost of queueing a record; wrapping a file handler, that of formatting
+    and writing it.
+    """
+    def __init__(self, handler: logging.Handler):
+        super().__init__(handler.level)
+        self.handler = handler
+        self.records = 0
+        self.seconds = 0.0
+
+    def handle(self, record: logging.LogRecord):
+        start = time.perf_counter()
+        rv = self.handler.handle(record)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.records += 1
+            self.seconds += elapsed
+        return rv
+
+
+def setup_bench_logging(args):
+    """
+    Configure logging for a benchmark run: as the command line tools do,
+    plus DEBUG records as JSON lines to --log-file, through a queue unless
+    --log-sync is given. The handlers of the root logger are timed.
+    Returns the TimedHandlers.
+    """
+    setup_logging(queue=False)
+    root = getLogger()
+    if args.log_file:
+        handler = logging.FileHandler(args.log_file, mode='w')
+        handler.setLevel(logging.DEBUG)
+        handler.setFormatter(JSONFormatter(body_limit=args.body_limit, body_sample=args.body_sample))
+        # keep the other handlers at the level they had through the root logger
+        for h in root.handlers:
+            if h.level == logging.NOTSET:
+                h.setLevel(root.level)
+        root.addHandler(handler)
+        root.setLevel(logging.DEBUG)
+    if not args.log_sync:
+        queue_handlers(root)
+    timed = [TimedHandler(h) for h in root.handlers]
+    for h, t in zip(list(root.handlers), timed):
+        root.removeHandler(h)
+        root.addHandler(t)
+    return timed
+
+
+def setup_run(args, data_root: Path):
+    """
+    Reset the module state of run.py for a benchmark run.
+    """
+    run.DATA_ROOT = data_root
+    run.DATA_INDEX = None if args.no_index else build_index(data_root)
+    run.DEDUP = None if args.no_dedup else DedupRegistry()
+    run.CHECKSUM_CACHE = None
+    run.METRICS = Metrics()
+    run.RETRY = RetryPolicy(attempts=args.retries, base_delay=args.retry_delay, seed=args.seed)
+
+
+def bench_shard(args, data_root: Path, base_url: str, queue_path: Path, shard: int):
+    """
+    Run one shard of a sharded benchmark; the target of each shard process.
+    """
+    from d1_client.mnclient_2_0 import MemberNodeClient_2_0
+    setup_logging()
+    setup_run(args, data_root)
+    queue = run.QUEUE = WorkQueue(queue_path, lease=args.lease, owner=f'shard{shard}')
+    client = MemberNodeClient_2_0(base_url, try_count=1)
+    def create(records, on_result):
+        return run.create_packages(records, 'http://orcid.org/0000-0000-0000-0000', client,
+                                   workers=args.workers, file_workers=args.file_workers, on_result=on_result)
+    run_shard(queue, create, run.shard_stats, poll=min(0.5, args.lease))
+    client._session.close()
+    queue.close()
+
+
+def run_benchmark(args):
+    """
+    Generate a dataset, start a mock MN and time create_packages against it.
+    Returns a result dict.
+    """
+    from d1_client.mnclient_2_0 import MemberNodeClient_2_0
+    L = getLogger(__name__)
+    with tempfile.TemporaryDirectory(prefix='mnqdc-bench-') as tmp:
+        qdc_file, data_root = generate_dataset(Path(tmp), args.packages, args.files, args.size,
+                                               versions=args.versions, seed=args.seed)
+        setup_run(args, data_root)
+        with MockMemberNode(latency=args.latency, bandwidth=args.bandwidth,
+                            error_rate=args.error_rate, seed=args.seed) as mn:
+            start = time.perf_counter()
+            if args.shards > 1:
+                # each shard is a separate process taking records from a shared queue
+                queue = WorkQueue(Path(tmp) / 'queue.sqlite')
+                queue.fill(run.parse_qdc_file(qdc_file))
+                ctx = multiprocessing.get_context('spawn')
+                procs = [ctx.Process(target=bench_shard, args=(args, data_root, mn.base_url, queue.path, n))
+                         for n in range(args.shards)]
+                for p in procs:
+                    p.start()
+                for p in procs:
+                    p.join()
+                succ, fail, _ = queue.merged()
+                totals = queue.totals()
+                queue.close()
+            elif args.engine == 'async':
+                from .aio import create_packages_async
+                succ, fail = create_packages_async(run.parse_qdc_file(qdc_file), 'http://orcid.org/0000-0000-0000-0000',
+                                                   mn.base_url, {}, workers=args.workers,
+                                                   max_in_flight=args.max_in_flight)
+            else:
+                client = MemberNodeClient_2_0(mn.base_url, try_count=1)
+                succ, fail = run.create_packages(run.parse_qdc_file(qdc_file), 'http://orcid.org/0000-0000-0000-0000',
+                                                 client, workers=args.workers, file_workers=args.file_workers)
+                client._session.close()
+            elapsed = time.perf_counter() - start
+            stats = dict(mn.stats)
+            if args.shards <= 1:
+                totals = run.shard_stats()
+    L.info(f'Benchmark finished in {round(elapsed, 2)} s')
+    return {
+        'version': RESULT_VERSION,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'params': {k: str(v) if isinstance(v, Path) else v for k, v in sorted(vars(args).items()) if k != 'out'},
+        'elapsed_s': round(elapsed, 4),
+        'packages': len(succ),
+        'failed_packages': len(fail),
+        'objects': stats['creates'],
+        'bytes': stats['bytes'],
+        'mn_errors': stats['errors'],
+        'retries': totals['retries'],
+        'stage_seconds': {stage: total for stage, (total, _) in totals['stages'].items()},
+        'wasted_bytes': totals['wasted_bytes'],
+        'packages_per_s': round(len(succ) / elapsed, 3),
+        'objects_per_s': round(stats['creates'] / elapsed, 3),
+        'mb_per_s': round(stats['bytes'] / (1024 * 1024) / elapsed, 3),
+    }
+
+
+def check_resource_map(members: int):
+    """
+    Build a resource map of ``members`` data objects with ore.resource_map
+    and with d1_common.resource_map.createSimpleResourceMap, and check that
+    both describe the same RDF graph, and that d1_common.resource_map reads
+    the same PIDs back from both. Returns a result dict with the timings.
+    """
+    from d1_common.resource_map import ResourceMap, createSimpleResourceMap
+    L = getLogger(__name__)
+    ore_pid, qdc_pid = str(uuid.uuid4()), str(uuid.uuid4())
+    data_pids = AWKWARD_PIDS[:members] + [str(uuid.uuid4()) for _ in range(members - len(AWKWARD_PIDS))]
+    start = time.perf_counter()
+    fast = resource_map(ore_pid, qdc_pid, data_pids)
+    fast_s = time.perf_counter() - start
+    start = time.perf_counter()
+    reference = createSimpleResourceMap(ore_pid, qdc_pid, data_pids)
+    reference.serialize(format='xml')
+    reference_s = time.perf_counter() - start
+    parsed = ResourceMap().parseDoc(fast)
+    problems = []
+    if set(parsed.triples((None, None, None))) != set(reference.triples((None, None, None))):
+        problems.append('the graphs differ')
+    for name in ('getResourceMapPid', 'getAggregatedPids', 'getAggregatedScienceMetadataPids',
+                 'getAggregatedScienceDataPids'):
+        ours, theirs = getattr(parsed, name)(), getattr(reference, name)()
+        if isinstance(ours, list):
+            ours, theirs = sorted(ours), sorted(theirs)
+        if ours != theirs:
+            problems.append(f'{name} differs')
+    for problem in problems:
+        L.error(f'Resource map of {members} members: {problem}')
+    L.info(f'Resource map of {members} members: {round(fast_s * 1000, 2)} ms, '
+           f'{round(reference_s * 1000, 2)} ms with createSimpleResourceMap')
+    return {
+        'version': RESULT_VERSION,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'params': {'ore_members': members},
+        'ore_bytes': len(fast),
+        'ore_s': round(fast_s, 6),
+        'reference_ore_s': round(reference_s, 6),
+        'ore_equivalent': not problems,
+    }
+
+
+def main():
+    """
+    Run the end-to-end benchmark and append the result to a JSON-lines file.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark mnqdc against a local mock member node')
+    parser.add_argument('--packages', type=int, default=50, help='Number of synthetic packages (default: 50)')
+    parser.add_argument('--files', type=int, default=10, help='Files per package (default: 10)')
+    parser.add_argument('--size', type=int, default=64 * 1024, help='Average file size in bytes (default: 65536)')
+    parser.add_argument('--versions', type=int, default=1,
+                        help='Version directories per DOI sharing the same files (default: 1)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    parser.add_argument('--engine', choices=['thread', 'async'], default='thread')
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('-f', '--file-workers', type=int, default=1)
+    parser.add_argument('--max-in-flight', type=int, default=100)
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Number of processes sharing a work queue (thread engine only; default: 1)')
+    parser.add_argument('--lease', type=float, default=30, help='Work queue lease in seconds (default: 30)')
+    parser.add_argument('--no-dedup', action='store_true')
+    parser.add_argument('--no-index', action='store_true')
+    parser.add_argument('--latency', type=float, default=0.0, help='Mock MN latency per request in seconds')
+    parser.add_argument('--bandwidth', type=float, default=None, help='Mock MN upload bandwidth in bytes/s')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of MN requests that fail')
+    parser.add_argument('--retries', type=int, default=5, help='Attempts per MN call (default: 5)')
+    parser.add_argument('--retry-delay', type=float, default=0.05,
+                        help='Base backoff delay in seconds (default: 0.05)')
+    parser.add_argument('--log-file', type=Path, metavar='PATH',
+                        help='Also log DEBUG records, with QDC records and MN responses, to PATH as JSON lines')
+    parser.add_argument('--log-sync', action='store_true',
+                        help='Write log records on the threads that log them instead of through a queue')
+    parser.add_argument('--body-limit', type=int, default=BODY_LIMIT,
+                        help=f'Characters of each debug body written to --log-file; 0 for all (default: {BODY_LIMIT})')
+    parser.add_argument('--body-sample', type=float, default=1.0,
+                        help='Fraction of debug records whose body is written to --log-file (default: 1.0)')
+    parser.add_argument('--ore-members', type=int, metavar='N',
+                        help='Instead of the end-to-end benchmark, build a resource map of N data objects '
+                             'and check it against the one d1_common builds')
+    parser.add_argument('-o', '--out', type=Path, default=Path('bench_results.jsonl'),
+                        help='JSON-lines file the result is appended to (default: bench_results.jsonl)')
+    args = parser.parse_args()
+    timed = setup_bench_logging(args)
+    if args.ore_members is not None:
+        result = check_resource_map(args.ore_members)
+        with open(args.out, 'a') as f:
+            f.write(json.dumps(result, sort_keys=True) + '\n')
+        print(f"Resource map of {args.ore_members} members: {result['ore_s']} s, "
+              f"{result['reference_ore_s']} s with createSimpleResourceMap; "
+              f"{'equivalent' if result['ore_equivalent'] else 'NOT equivalent'}")
+        sys.exit(0 if result['ore_equivalent'] else 1)
+    result = run_benchmark(args)
+    # records logged by the benchmark process; shards log on their own
+    result['log_records'] = max((t.records for t in timed), default=0)
+    result['log_seconds'] = round(sum(t.seconds for t in timed), 4)
+    result['log_us_per_object'] = round(result['log_seconds'] / max(1, result['objects']) * 1e6, 1)
+    with open(args.out, 'a') as f:
+        f.write(json.dumps(result, sort_keys=True) + '\n')
+    print(f"{result['packages']} packages, {result['objects']} objects in {result['elapsed_s']} s: "
+          f"{result['packages_per_s']} packages/s, {result['objects_per_s']} objects/s, "
+          f"{result['mb_per_s']} MB/s")
+    print(f"Logging: {result['log_records']} records, {result['log_us_per_object']} us per object "
+          f"on the logging threads")
+
+
+if __name__ == "__main__":
+    """
+    Running directly
+    """
+    main()
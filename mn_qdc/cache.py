@@ -0,0 +1,68 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS digests (
+    path TEXT NOT NULL,
+    algorithm TEXT NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (path, algorithm)
+);
+"""
+
+
+class ChecksumCache():
+    """
+    Persistent cache of file digests, kept in a SQLite database.
+
+    Entries are keyed on the file's path, inode, size and mtime_ns, so a
+    cached digest is only returned while the file is unchanged. The database
+    can be shared between threads and between concurrent processes.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(self.path, check_same_thread=False,
+                                    isolation_level=None, timeout=30)
+        self._con.execute('PRAGMA journal_mode=WAL')
+        self._con.execute('PRAGMA synchronous=NORMAL')
+        self._con.executescript(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path: Path, st: os.stat_result, algorithm: str='MD5'):
+        """
+        Return the cached digest of ``path`` for ``algorithm``, or None if
+        there is no entry or the file has changed since it was recorded.
+        """
+        with self._lock:
+            row = self._con.execute('SELECT inode, size, mtime_ns, digest FROM digests '
+                                    'WHERE path = ? AND algorithm = ?',
+                                    (os.path.abspath(path), algorithm)).fetchone()
+            if row and tuple(row[:3]) == (st.st_ino, st.st_size, st.st_mtime_ns):
+                self.hits += 1
+                return row[3]
+            self.misses += 1
+            return None
+
+    def put(self, path: Path, st: os.stat_result, digests: dict):
+        """
+        Record the digests of ``path`` (algorithm -> hexdigest) as of ``st``.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            self._con.executemany('INSERT OR REPLACE INTO digests '
+                                  '(path, algorithm, inode, size, mtime_ns, digest) '
+                                  'VALUES (?, ?, ?, ?, ?, ?)',
+                                  [(path, algorithm, st.st_ino, st.st_size, st.st_mtime_ns, digest)
+                                   for algorithm, digest in digests.items()])
+
+    def close(self):
+        with self._lock:
+            self._con.close()
@@ -0,0 +1,248 @@
+import sys
+import argparse
+from pathlib import Path
+
+from .config import JOURNAL_LOC, CHECKSUM_CACHE_LOC, INDEX_LOC, setup_logging
+
+# Subcommands only import the modules they need when they run, so that
+# `mnqdc test` and `mnqdc status` do not load the DataONE client stack.
+COMMANDS = ('upload', 'plan', 'apply', 'test', 'convert', 'status')
+
+
+def add_worker_arguments(parser: argparse.ArgumentParser, files: bool=True):
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of packages to create concurrently (default: 1)')
+    if files:
+        parser.add_argument('-f', '--file-workers', type=int, default=1,
+                            help='Number of data objects to upload concurrently within each package (default: 1)')
+
+
+def add_journal_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('-j', '--journal', type=Path, default=JOURNAL_LOC,
+                        help=f'Run journal used to resume interrupted runs (default: {JOURNAL_LOC})')
+    parser.add_argument('--no-journal', action='store_true',
+                        help='Do not record progress or skip previously finished DOIs')
+
+
+def add_source_arguments(parser: argparse.ArgumentParser):
+    """
+    Options for reading, hashing and deduplicating the files of the data root.
+    """
+    parser.add_argument('--checksum-cache', type=Path, default=CHECKSUM_CACHE_LOC,
+                        help=f'Cache of file checksums reused across runs (default: {CHECKSUM_CACHE_LOC})')
+    parser.add_argument('--no-checksum-cache', action='store_true',
+                        help='Hash every file, ignoring and not updating the checksum cache')
+    parser.add_argument('--checksum-algorithm', choices=['MD5', 'SHA-1', 'SHA-256'],
+                        help='Checksum algorithm used in sysmeta and for dedup '
+                             '(default: checksum_algorithm in config.json, or MD5)')
+    parser.add_argument('--digests', type=lambda s: [a for a in s.split(',') if a],
+                        help='Comma-separated digests to compute and cache for every file in the same pass, '
+                             'e.g. SHA-256 (default: digests in config.json)')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='Upload every file, even if identical content was already uploaded in this run')
+    parser.add_argument('--preflight', action='store_true',
+                        help='List the objects already on the MN and reuse those with matching content')
+    add_index_arguments(parser)
+
+
+def add_index_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--index', type=Path, default=INDEX_LOC,
+                        help=f'Saved index of the data root, refreshed at startup (default: {INDEX_LOC})')
+    parser.add_argument('--no-index', action='store_true',
+                        help='Probe the data root for each DOI instead of indexing it up front')
+    parser.add_argument('--scan-workers', type=int, default=16,
+                        help='Number of threads used to index the data root (default: 16)')
+
+
+def add_queue_arguments(parser: argparse.ArgumentParser):
+    """
+    Options for sharded runs, where several processes share a work queue.
+    """
+    parser.add_argument('--queue', type=Path, metavar='PATH',
+                        help='Take records from the work queue at PATH, shared with other mnqdc processes; '
+                             'the first process fills it from the QDC file. Use a path on a filesystem shared '
+                             'by all hosts, and give each host its own --journal')
+    parser.add_argument('--shard-id',
+                        help='Name of this process in the work queue (default: hostname:pid)')
+    parser.add_argument('--lease', type=float, default=300,
+                        help='Seconds after which the record of a package that made no progress is handed '
+                             'to other shards; must be longer than the slowest single upload (default: 300)')
+    parser.add_argument('--lease-attempts', type=int, default=3,
+                        help='Times a record is leased before it is marked failed (default: 3)')
+    parser.add_argument('--requeue-failed', action='store_true',
+                        help='Make the failed records in the work queue pending again')
+
+
+def add_run_arguments(parser: argparse.ArgumentParser):
+    """
+    Options for retries, metrics and tracing of MN calls.
+    """
+    parser.add_argument('--retries', type=int, default=5,
+                        help='Attempts per MN call before a transient error fails the package (default: 5)')
+    parser.add_argument('--retry-delay', type=float, default=1.0,
+                        help='Base delay in seconds of the exponential backoff between attempts (default: 1.0)')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Adapt the number of concurrent uploads to the latency and errors of the MN, '
+                             'up to workers x file workers (or --max-in-flight with --async)')
+    parser.add_argument('--metrics', type=Path, metavar='PATH',
+                        help='Write run metrics to PATH periodically: a Prometheus textfile if PATH ends '
+                             'in .prom, JSON otherwise')
+    parser.add_argument('--metrics-interval', type=float, default=15,
+                        help='Seconds between metrics snapshots (default: 15)')
+    parser.add_argument('--trace', type=Path, metavar='PATH',
+                        help='Record per-package spans to PATH in Chrome trace format '
+                             '(one event per line if PATH ends in .jsonl)')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='mnqdc',
+                                     description='Create data packages from QDC records and upload them to a '
+                                                 'member node. Without a command, runs "upload".')
+    sub = parser.add_subparsers(dest='command', metavar='COMMAND')
+
+    p = sub.add_parser('upload', help='Create and upload the package of every QDC record')
+    add_worker_arguments(p)
+    p.add_argument('--async', dest='use_async', action='store_true',
+                   help='Upload with the asyncio engine instead of threads')
+    p.add_argument('--max-in-flight', type=int, default=100,
+                   help='With --async, maximum number of concurrent MN requests (default: 100)')
+    p.add_argument('--schedule', action='store_true',
+                   help='Start the largest packages first and run tiny ones in batches, and print the '
+                        'estimated time to completion; all records are sized before the run starts')
+    p.add_argument('--throughput', type=float, default=10,
+                   help='With --schedule, upload throughput of one worker in MB/s assumed by the estimate '
+                        '(default: 10)')
+    add_journal_arguments(p)
+    p.add_argument('--delta', action='store_true',
+                   help='Also check the packages the journal records as done, and update those whose QDC '
+                        'record or files have changed since as new versions on the MN')
+    add_source_arguments(p)
+    add_queue_arguments(p)
+    add_run_arguments(p)
+    p.set_defaults(plan=None, apply=None)
+
+    p = sub.add_parser('plan', help='Resolve, hash and build every package offline and write them to a manifest')
+    p.add_argument('plan', type=Path, metavar='MANIFEST',
+                   help='Manifest to write (gzipped if the name ends in .gz)')
+    add_worker_arguments(p, files=False)
+    add_source_arguments(p)
+    add_run_arguments(p)
+    p.set_defaults(apply=None, use_async=False, file_workers=1, journal=JOURNAL_LOC, no_journal=True, queue=None,
+                   schedule=False, delta=False)
+
+    p = sub.add_parser('apply', help='Upload the packages planned in a manifest')
+    p.add_argument('apply', type=Path, metavar='MANIFEST',
+                   help='Manifest written by the plan command')
+    add_worker_arguments(p)
+    add_journal_arguments(p)
+    add_run_arguments(p)
+    p.set_defaults(plan=None, use_async=False, queue=None, checksum_algorithm=None, digests=None)
+
+    p = sub.add_parser('test', help='Check that data files can be found for each QDC record')
+    add_index_arguments(p)
+
+    p = sub.add_parser('convert', help='Convert every QDC record to an EML document')
+    p.add_argument('out', type=Path, metavar='DIR',
+                   help='Directory to write the EML documents and errors.jsonl to')
+    p.add_argument('-w', '--workers', type=int,
+                   help='Number of processes converting records (default: one per CPU)')
+    p.add_argument('--chunk-records', type=int, default=50,
+                   help='Records sent to a process at a time (default: 50)')
+
+    p = sub.add_parser('status', help='Show the progress recorded in the run journal or a work queue')
+    p.add_argument('-j', '--journal', type=Path, default=JOURNAL_LOC,
+                   help=f'Run journal to read (default: {JOURNAL_LOC})')
+    p.add_argument('--queue', type=Path, metavar='PATH',
+                   help='Show the progress of the shards using the work queue at PATH instead')
+    p.add_argument('--list', choices=['started', 'failed', 'done'], action='append', default=[],
+                   help='Also list the DOIs in this state (may be repeated)')
+    return parser
+
+
+def status(args):
+    """
+    Print the number of DOIs in each journal state, and optionally the DOIs
+    in some of them. Started DOIs are interrupted or still running packages.
+    """
+    if args.queue:
+        return queue_status(args)
+    from .journal import Journal
+    if not args.journal.exists():
+        print(f'No run journal at {args.journal}')
+        return
+    journal = Journal(args.journal)
+    try:
+        summary = journal.summary()
+        print(f'Run journal {journal.path}')
+        for state in ('done', 'started', 'failed'):
+            print(f'{state + ":":<10}{summary.get(state, 0)}')
+        for state in args.list:
+            print(f'\n{state.capitalize()} DOIs:')
+            for doi, updated in journal.dois(state):
+                print(f'{updated}  {doi}')
+    finally:
+        journal.close()
+
+
+def queue_status(args):
+    """
+    Print the number of records in each work queue state and the merged
+    results of its shards.
+    """
+    from .workqueue import WorkQueue
+    if not args.queue.exists():
+        print(f'No work queue at {args.queue}')
+        return
+    queue = WorkQueue(args.queue)
+    try:
+        summary = queue.summary()
+        print(f'Work queue {queue.path}')
+        for state in ('done', 'leased', 'pending', 'failed'):
+            print(f'{state + ":":<10}{summary.get(state, 0)}')
+        finished, failed, stats = queue.merged()
+        print()
+        for k, v in stats.items():
+            print(f'{k + ":":<24}{v}')
+        for state in args.list:
+            dois = {'done': finished, 'failed': failed}.get(state, [])
+            print(f'\n{state.capitalize()} DOIs:')
+            print('\n'.join(dois))
+    finally:
+        queue.close()
+
+
+def main(argv: list=None):
+    """
+    Entry point of the mnqdc command.
+    """
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # options without a command are those of upload, as before subcommands
+    if not argv or (argv[0] not in COMMANDS and argv[0] not in ('-h', '--help')):
+        argv.insert(0, 'upload')
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, 'preflight', False) and args.no_dedup:
+        parser.error('--preflight cannot be used with --no-dedup')
+    if getattr(args, 'delta', False) and args.no_journal:
+        parser.error('--delta needs the run journal; it cannot be used with --no-journal')
+    if args.command == 'status' and args.queue and 'started' in args.list:
+        parser.error('--list started is for the run journal; the work queue has done and failed records')
+    if args.command == 'status':
+        return status(args)
+    setup_logging()
+    if args.command == 'test':
+        from .test import check_data
+        check_data(args)
+    elif args.command == 'convert':
+        from .conv import convert
+        convert(args)
+    else:
+        from .run import upload
+        upload(args)
+
+
+if __name__ == "__main__":
+    """
+    Running directly
+    """
+    main()
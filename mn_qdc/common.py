@@ -0,0 +1,88 @@
+from pathlib import Path
+
+from lxml import etree
+
+from logging import getLogger
+
+try:
+    from .defs import fmts
+except:
+    fmts = {'.xls': 'application/vnd.ms-excel','.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet','.doc': 'application/msword','.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document','.ppt': 'application/vnd.ms-powerpoint','.pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation','.pdf': 'application/pdf','.txt': 'text/plain','.zip': 'application/zip','.ttl': 'text/turtle','.md': 'text/markdown','.rmd': 'text/x-rmarkdown','.csv': 'text/csv','.bmp': 'image/bmp','.gif': 'image/gif','.jpg': 'image/jpeg','.jpeg': 'image/jpeg','.jp2': 'image/jp2','.png': 'image/png','.tif': 'image/geotiff','.svg': 'image/svg+xml','.nc': 'netCDF-4','.py': 'application/x-python','.hdf': 'application/x-hdf','.hdf5': 'application/x-hdf5','.tab': 'text/plain','.gz': 'application/x-gzip','.html': 'text/html','.htm': 'text/html','.xml': 'text/xml','.ps': 'application/postscript','.tsv': 'text/tsv','.rtf': 'application/rtf','.mp4': 'video/mp4','.r': 'application/R','.rar': 'application/x-rar-compressed','.fasta': 'application/x-fasta','.fastq': 'application/x-fasta','.fas': 'application/x-fasta',}
+
+QDC_TAG = '{*}qualifieddc'
+DC_IDENTIFIER = '{http://purl.org/dc/elements/1.1/}identifier'
+rpt_txt = """
+Package creation report:
+Failed uploads:     %s
+Successful uploads: %s
+
+Failed packages:
+%s
+
+Successful packages:
+%s
+"""
+
+def parse_qdc_file(qdc_file):
+    """
+    Incrementally parse the QDC file, yielding a (doi, qdc) tuple for each
+    qdc:qualifieddc record, where doi is the record's dc:identifier and qdc is
+    the serialized record.
+    Each record is discarded once it has been yielded, so memory use stays
+    constant no matter how large the export is.
+    """
+    L = getLogger(__name__)
+    for _, elem in etree.iterparse(str(qdc_file), events=('end',), tag=QDC_TAG, huge_tree=True):
+        doi = elem.findtext(f'.//{DC_IDENTIFIER}')
+        qdc = etree.tostring(elem, encoding='unicode', with_tail=False)
+        # free this record and the ones before it
+        elem.clear(keep_tail=False)
+        parent = elem.getparent()
+        if parent is not None:
+            while elem.getprevious() is not None:
+                del parent[0]
+        if not doi:
+            L.error(f'Skipping QDC record with no dc:identifier:\n{qdc}')
+            continue
+        yield doi.strip(), qdc
+
+
+def parse_records(path):
+    """
+    Incrementally read (doi, qdc) records from a QDC export, or from a
+    Figshare JSON dump if the file name ends in .json or .jsonl (optionally
+    gzipped).
+    """
+    from .figshare import is_figshare_file, parse_figshare_records
+    if is_figshare_file(path):
+        return parse_figshare_records(path)
+    return parse_qdc_file(path)
+
+
+def get_format(fmt: Path):
+    """
+    Test the format based on the file suffix. If none is found, fall back to
+    application/octet-stream.
+    """
+    L = getLogger(__name__)
+    if fmt.suffix:
+        format_id = fmts.get(fmt.suffix.lower())
+        if format_id:
+            L.debug(f'Found format id {format_id}')
+            return format_id
+    L.debug(f'No format id could be found. Using "application/octet-stream"')
+    return "application/octet-stream"
+
+
+def report(succ: int, fail: int, finished_dois: list, failed_dois: list, stats: dict=None):
+    """
+    Generate a short report with the successes and failures of the process.
+    Any ``stats`` (name -> value) are appended to the report.
+    """
+    L = getLogger(__name__)
+    finished_str = "\n".join(str(x) for x in finished_dois)
+    failed_str = "\n".join(str(x) for x in failed_dois)
+    rpt = rpt_txt % (fail, succ, failed_str, finished_str)
+    if stats:
+        rpt += '\n' + '\n'.join(f'{k + ":":<24}{v}' for k, v in stats.items()) + '\n'
+    L.info(rpt)
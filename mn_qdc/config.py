@@ -0,0 +1,48 @@
+import json
+from pathlib import Path
+
+from logging import getLogger, basicConfig, INFO
+
+CONFIG_LOC = Path('~/.config/mn-qdc/').expanduser().absolute()
+LOGCONFIG = CONFIG_LOC.joinpath('log/config.json')
+JOURNAL_LOC = CONFIG_LOC.joinpath('journal.sqlite')
+CHECKSUM_CACHE_LOC = CONFIG_LOC.joinpath('checksums.sqlite')
+INDEX_LOC = CONFIG_LOC.joinpath('index.json')
+
+
+def setup_logging(queue: bool=True):
+    """
+    Configure logging from '~/.config/mn-qdc/log/config.json', or log INFO
+    and above to stderr if there is no logging config.
+    Called by the command line tools, not on import.
+    :param queue: Whether to write records from a background thread, so that
+                  logging does not block uploads on formatting and disk I/O
+    """
+    if LOGCONFIG.exists():
+        from logging.config import dictConfig
+        with open(LOGCONFIG, 'r') as lc:
+            dictConfig(json.load(lc))
+    else:
+        basicConfig(level=INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+        getLogger(__name__).debug(f'No logging config at {LOGCONFIG}')
+    if queue:
+        from .logs import queue_handlers
+        queue_handlers()
+
+
+def get_token():
+    """
+    Paste your auth token into '~/.d1_token'
+    """
+    # Set the D1 token
+    with open(Path(CONFIG_LOC / '.d1_token'), 'r') as tf:
+        return tf.read().split('\n')[0]
+
+
+def load_config():
+    """
+    Config values that are not the d1 token go in 'config.json'.
+    :return: The config as a dict
+    """
+    with open(CONFIG_LOC.joinpath('config.json'), 'r') as lc:
+        return json.load(lc)
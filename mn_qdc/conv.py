@@ -1,63 +1,273 @@
-import logging
+import os
+import re
+import sys
+import json
+import time
+from pathlib import Path
+from xml.sax.saxutils import escape
+from typing import Iterable
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from lxml import etree
+
+from logging import getLogger
 
 from metapype.eml.exceptions import MetapypeRuleError
 import metapype.eml.names as names
 import metapype.eml.validate as validate
+from metapype.model import metapype_io
 from metapype.model.node import Node
 
+from .config import load_config
+from .common import parse_records
 
-def main():
+EML_NS = 'https://eml.ecoinformatics.org/eml-2.2.0'
+EML_NAMESPACES = {
+    'eml': EML_NS,
+    'stmml': 'http://www.xml-cml.org/schema/stmml-1.2',
+    'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+}
+SCHEMA_LOCATION = f'{EML_NS} https://nis.lternet.edu/schemas/EML/eml-2.2.0/xsd/eml.xsd'
+AUTH_SYSTEM = 'https://cilogon.org'
+# records per task sent to a worker process; small records are cheap to
+# convert, so sending them one by one would cost more in IPC than in work
+CHUNK_RECORDS = 50
+ERRORS_FILE = 'errors.jsonl'
+PUBDATE = re.compile(r'^\d{4}(-\d{2}-\d{2})?')
 
-    eml = Node(names.EML)
-    eml.add_attribute('packageId', 'edi.23.1')
-    eml.add_attribute('system', 'metapype')
+# the template of every record, built once per worker process
+global TEMPLATE
+TEMPLATE = None
+
+
+def add_node(parent: Node, name: str, content: str=None):
+    """
+    Add a child called ``name`` to ``parent`` and return it.
+    """
+    node = Node(name, parent=parent, content=content)
+    parent.add_child(node)
+    return node
 
-    access = Node(names.ACCESS, parent=eml)
-    access.add_attribute('authSystem', 'pasta')
+
+def build_template(orcid: str):
+    """
+    Build the parts of the EML tree that are the same in every record: the
+    root element with its namespaces, and access rules that let the
+    rightsholder do anything and the public read.
+    """
+    eml = Node(names.EML)
+    eml.prefix = 'eml'
+    for prefix, ns in EML_NAMESPACES.items():
+        eml.add_namespace(prefix, ns)
+    eml.add_extras('xsi:schemaLocation', SCHEMA_LOCATION)
+    eml.add_attribute('system', 'https://doi.org')
+    access = add_node(eml, names.ACCESS)
+    access.add_attribute('authSystem', AUTH_SYSTEM)
     access.add_attribute('order', 'allowFirst')
-    eml.add_child(access)
+    for principal, permission in ((orcid, 'all'), ('public', 'read')):
+        allow = add_node(access, names.ALLOW)
+        add_node(allow, names.PRINCIPAL, principal)
+        add_node(allow, names.PERMISSION, permission)
+    return eml
+
+
+def qdc_fields(qdc: str):
+    """
+    Return the text of the elements of a QDC record by local name, e.g.
+    {'title': [...], 'creator': [...]}, in document order. dc and dcterms
+    elements with the same local name are merged.
+    """
+    fields = {}
+    for el in etree.fromstring(qdc.encode('utf-8')):
+        if not isinstance(el.tag, str) or not el.text or not el.text.strip():
+            continue
+        fields.setdefault(etree.QName(el).localname, []).append(el.text.strip())
+    return fields
+
 
-    allow = Node(names.ALLOW, parent=access)
-    access.add_child(allow)
+def add_party(parent: Node, name: str, person: str):
+    """
+    Add a party such as a creator or contact, splitting "Last, First" names.
+    """
+    party = add_node(parent, name)
+    individual = add_node(party, names.INDIVIDUALNAME)
+    surname, _, given = person.partition(',')
+    if given.strip():
+        add_node(individual, names.GIVENNAME, given.strip())
+    add_node(individual, names.SURNAME, surname.strip())
+    return party
 
-    principal = Node(names.PRINCIPAL, parent=allow)
-    principal.content = 'uid=gaucho,o=EDI,dc=edirepository,dc=org'
-    allow.add_child(principal)
 
-    permission = Node(names.PERMISSION, parent=allow)
-    permission.content = 'all'
-    allow.add_child(permission)
+def fill_template(eml: Node, doi: str, fields: dict):
+    """
+    Map the QDC ``fields`` of ``doi`` onto a copy of the template, in the
+    element order EML requires.
+    """
+    # metapype writes attribute values as they are
+    eml.add_attribute('packageId', escape(doi, {'"': '&quot;'}))
+    dataset = add_node(eml, names.DATASET)
+    add_node(dataset, names.ALTERNATEIDENTIFIER, doi).add_attribute('system', 'https://doi.org')
+    for title in fields.get('title', ()):
+        add_node(dataset, names.TITLE, title)
+    creators = fields.get('creator', ())
+    for creator in creators:
+        add_party(dataset, names.CREATOR, creator)
+    for contributor in fields.get('contributor', ()):
+        add_node(add_party(dataset, names.ASSOCIATEDPARTY, contributor), names.ROLE, 'contributor')
+    dates = [d for d in fields.get('issued', []) + fields.get('date', []) if PUBDATE.match(d)]
+    if dates:
+        add_node(dataset, names.PUBDATE, PUBDATE.match(dates[0]).group(0))
+    if 'language' in fields:
+        add_node(dataset, names.LANGUAGE, fields['language'][0])
+    descriptions = fields.get('abstract', []) + fields.get('description', [])
+    if descriptions:
+        abstract = add_node(dataset, names.ABSTRACT)
+        for description in descriptions:
+            add_node(abstract, names.PARA, description)
+    if 'subject' in fields:
+        keywords = add_node(dataset, names.KEYWORDSET)
+        for subject in fields['subject']:
+            add_node(keywords, names.KEYWORD, subject)
+    rights = fields.get('rights', []) + fields.get('license', [])
+    if rights:
+        intellectual_rights = add_node(dataset, names.INTELLECTUALRIGHTS)
+        for r in rights:
+            add_node(intellectual_rights, names.PARA, r)
+    # EML needs a contact; the first creator is the best guess a QDC record gives
+    if creators:
+        add_party(dataset, names.CONTACT, creators[0])
+    if 'publisher' in fields:
+        publisher = add_node(dataset, names.PUBLISHER)
+        add_node(publisher, names.ORGANIZATIONNAME, fields['publisher'][0])
+    return eml
 
-    dataset = Node(names.DATASET, parent=eml)
-    eml.add_child(dataset)
 
-    title = Node(names.TITLE, parent=dataset)
-    title.content = 'Green sea turtle counts: Tortuga Island 20017'
-    dataset.add_child(title)
+def convert_record(doi: str, qdc: str):
+    """
+    Convert one QDC record to EML and validate it.
+    Returns (doi, EML document or None, list of errors); the document is
+    None if the record could not be converted or is not valid EML.
+    """
+    # the nodes of this record are dropped from metapype's node store when it
+    # is done, so a long-lived worker does not keep every tree it built
+    with Node.store_scope():
+        try:
+            eml = fill_template(TEMPLATE.copy(), doi, qdc_fields(qdc))
+        except etree.XMLSyntaxError as e:
+            return doi, None, [f'Could not parse the QDC record: {e}']
+        errs = []
+        try:
+            validate.tree(eml, errs)
+        except MetapypeRuleError as e:
+            errs.append((None, str(e)))
+        if errs:
+            # errors are (kind, message, node, ...) tuples
+            return doi, None, [err[1] for err in errs]
+        return doi, '<?xml version="1.0" encoding="UTF-8"?>\n' + metapype_io.to_xml(eml), []
 
-    creator = Node(names.CREATOR, parent=dataset)
-    dataset.add_child(creator)
 
-    individualName_creator = Node(names.INDIVIDUALNAME, parent=creator)
-    creator.add_child(individualName_creator)
+def init_worker(orcid: str):
+    global TEMPLATE
+    TEMPLATE = build_template(orcid)
 
-    surName_creator = Node(names.SURNAME, parent=individualName_creator)
-    surName_creator.content = 'Gaucho'
-    individualName_creator.add_child(surName_creator)
 
-    contact = Node(names.CONTACT, parent=dataset)
-    dataset.add_child(contact)
+def convert_chunk(records: list):
+    """
+    Convert a list of (doi, qdc) records in a worker process.
+    """
+    return [convert_record(doi, qdc) for doi, qdc in records]
 
-    individualName_contact = Node(names.INDIVIDUALNAME, parent=contact)
-    contact.add_child(individualName_contact)
 
-    surName_contact = Node(names.SURNAME, parent=individualName_contact)
-    surName_contact.content = 'Gaucho'
-    individualName_contact.add_child(surName_contact)
+def chunked(records: Iterable, size: int):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-    try:
-        validate.tree(eml)
-    except MetapypeRuleError as e:
-        logging.error(e)
-        
-    return 0
\ No newline at end of file
+
+def eml_path(out: Path, doi: str):
+    """
+    Return the file the EML of ``doi`` is written to.
+    """
+    return out / (doi.replace('/', '_') + '.xml')
+
+
+def convert_records(qdcs: Iterable, orcid: str, out: Path, workers: int=None, chunk_records: int=CHUNK_RECORDS):
+    """
+    Convert (doi, qdc) records, such as those yielded by parse_qdc_file, to
+    EML documents in ``out``, one file per DOI.
+
+    Records are sent in chunks of ``chunk_records`` to a pool of ``workers``
+    processes (default: one per CPU) that build each tree from a template
+    and validate it. At most two chunks per worker are read ahead of the
+    results, and each document is written as soon as its chunk is done, so
+    memory use does not grow with the number of records.
+    Records that fail are listed in ``out``/errors.jsonl, one JSON object
+    with the DOI and its errors per line.
+    Returns the lists of converted and failed DOIs.
+    """
+    L = getLogger(__name__)
+    workers = workers or os.cpu_count() or 1
+    out.mkdir(parents=True, exist_ok=True)
+    converted, failed = [], []
+    start = time.perf_counter()
+    with open(out / ERRORS_FILE, 'w') as ef, \
+            ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(orcid,)) as ex:
+
+        def collect(done):
+            for fut in done:
+                for doi, eml, errors in fut.result():
+                    if eml is None:
+                        L.error(f'{doi} Could not convert to EML: {errors[0]}'
+                                + (f' (and {len(errors) - 1} more errors)' if len(errors) > 1 else ''))
+                        ef.write(json.dumps({'doi': doi, 'errors': errors}) + '\n')
+                        failed.append(doi)
+                        continue
+                    eml_path(out, doi).write_text(eml, encoding='utf-8')
+                    converted.append(doi)
+            L.debug(f'Converted {len(converted)} records, {len(failed)} failed')
+
+        pending = set()
+        try:
+            for chunk in chunked(qdcs, chunk_records):
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(ex.submit(convert_chunk, chunk))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        except KeyboardInterrupt:
+            L.warning('Interrupted; waiting for the running conversions to finish')
+            for fut in pending:
+                fut.cancel()
+            raise
+    seconds = time.perf_counter() - start
+    L.info(f'Converted {len(converted)} records to EML in {out} in {round(seconds, 1)} s '
+           f'({round((len(converted) + len(failed)) / max(seconds, 1e-9), 1)} records/s); '
+           f'{len(failed)} failed' + (f', see {out / ERRORS_FILE}' if failed else ''))
+    return converted, failed
+
+
+def convert(args):
+    """
+    Convert the records in the configured QDC file (or Figshare dump) to EML.
+    """
+    L = getLogger(__name__)
+    config = load_config()
+    orcid, qdc_file = config['rightsholder_orcid'], config['qdc_file']
+    L.info(f'Reading records from {qdc_file}')
+    convert_records(parse_records(qdc_file), orcid, args.out, workers=args.workers,
+                    chunk_records=args.chunk_records)
+
+
+def main():
+    """
+    Entry point for converting the QDC file to EML; same as 'mnqdc convert'.
+    """
+    from .cli import main as cli_main
+    cli_main(['convert'] + sys.argv[1:])
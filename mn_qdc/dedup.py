@@ -0,0 +1,163 @@
+import itertools
+import threading
+from concurrent.futures import Future
+from typing import Callable, Iterable
+
+
+class DedupRegistry():
+    """
+    Run-wide map of content keys, (size, checksum) tuples as returned by
+    checksum_file, to the PID of an object with that content on the MN.
+
+    Packages only add their objects once the package has been created
+    successfully, so a PID handed out by the registry is never one that a
+    failing package is about to roll back.
+
+    Objects found on the MN before the run (see preflight.py) are added as
+    candidates. A candidate is only handed out once ``verify(pid)`` has
+    confirmed that it can be reused; it is checked at most once.
+
+    Content that a package is still uploading is reserved (see reserve()), so
+    that concurrent packages sharing it wait for the owner's PID instead of
+    uploading their own copy. The registry is per process: shards of a work
+    queue only share content through the journal (see seed()).
+    """
+    def __init__(self, verify: Callable=None):
+        self._pids = {}
+        self._candidates = {}
+        self._inflight = {}
+        self._tickets = itertools.count()
+        self._lock = threading.Lock()
+        self.verify = verify
+        self.saved_objects = 0
+        self.saved_bytes = 0
+
+    def get(self, key: tuple):
+        """
+        Return the PID of an existing object with this content, or None.
+        """
+        with self._lock:
+            pid = self._pids.get(key)
+            if pid or key not in self._candidates:
+                return pid
+            candidate = self._candidates.pop(key)
+        if self.verify and not self.verify(candidate):
+            return None
+        with self._lock:
+            return self._pids.setdefault(key, candidate)
+
+    async def aget(self, key: tuple, verify: Callable):
+        """
+        Async counterpart of get(); candidates are checked by awaiting
+        ``verify(pid)`` instead of calling self.verify, so that the event
+        loop is not blocked on the MN.
+        """
+        with self._lock:
+            pid = self._pids.get(key)
+            if pid or key not in self._candidates:
+                return pid
+            candidate = self._candidates.pop(key)
+        if not await verify(candidate):
+            return None
+        with self._lock:
+            return self._pids.setdefault(key, candidate)
+
+    def add_candidate(self, key: tuple, pid: str):
+        """
+        Register a PID found on the MN that still needs to be verified before
+        it is reused.
+        """
+        with self._lock:
+            if key not in self._pids:
+                self._candidates.setdefault(key, pid)
+
+    def candidates(self):
+        with self._lock:
+            return len(self._candidates)
+
+    def add(self, key: tuple, pid: str):
+        """
+        Register the PID of an object on the MN. The first PID registered for
+        a given content key is kept. Packages waiting for a reservation of the
+        key by ``pid`` get the registered PID.
+        """
+        with self._lock:
+            registered = self._pids.setdefault(key, pid)
+            owner = self._inflight.get(key)
+            if owner is None or owner[1] != pid:
+                return
+            del self._inflight[key]
+        owner[2].set_result(registered)
+
+    def ticket(self):
+        """
+        Return a number that orders packages by when they started looking up
+        their content.
+        """
+        with self._lock:
+            return next(self._tickets)
+
+    def reserve(self, key: tuple, pid: str, ticket: int):
+        """
+        Claim ``key`` for the upload of ``pid`` by the package holding
+        ``ticket``. Returns an (existing PID, pending) tuple:
+
+        - (PID, None) if the content has been registered in the meantime
+        - (None, future) if an earlier package is uploading it; the future
+          resolves to that package's PID once the package has been created,
+          or to None if it failed
+        - (None, None) if the caller should upload it
+
+        A package never waits for one holding a later ticket (it uploads its
+        own copy instead), so waiting packages cannot deadlock.
+        The caller must add() or release() every key it reserved.
+        """
+        with self._lock:
+            if key in self._pids:
+                return self._pids[key], None
+            owner = self._inflight.get(key)
+            if owner is None:
+                self._inflight[key] = (ticket, pid, Future())
+                return None, None
+            if owner[0] < ticket:
+                return None, owner[2]
+            return None, None
+
+    def release(self, key: tuple, pid: str):
+        """
+        Drop the reservation of ``key`` by ``pid`` without registering it;
+        packages waiting for it upload their own copy.
+        """
+        with self._lock:
+            owner = self._inflight.get(key)
+            if owner is None or owner[1] != pid:
+                return
+            del self._inflight[key]
+        owner[2].set_result(None)
+
+    def seed(self, pairs: Iterable):
+        """
+        Register ((size, checksum), PID) pairs, such as those of the finished
+        packages in a journal (see Journal.dedup_keys).
+        Returns the number of keys added.
+        """
+        with self._lock:
+            before = len(self._pids)
+            for key, pid in pairs:
+                self._pids.setdefault(key, pid)
+                self._candidates.pop(key, None)
+            return len(self._pids) - before
+
+    def record_saving(self, size: int):
+        """
+        Count an upload of ``size`` bytes that was avoided by reusing a PID.
+        """
+        with self._lock:
+            self.saved_objects += 1
+            self.saved_bytes += size
+
+    def summary(self):
+        return {
+            'Deduplicated objects': self.saved_objects,
+            'Bytes saved': f'{self.saved_bytes} ({round(self.saved_bytes/(1024*1024), 1)} MB)',
+        }
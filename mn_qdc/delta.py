@@ -0,0 +1,41 @@
+import os
+import hashlib
+from pathlib import Path
+from typing import Iterable, Union
+
+# prefix of the series ID of a package's resource map; the QDC record's
+# series ID is the DOI itself
+ORE_SID_PREFIX = 'resource_map_'
+
+
+def ore_sid(doi: str):
+    """
+    Return the series ID of the resource maps of a DOI.
+    """
+    return f'{ORE_SID_PREFIX}{doi}'
+
+
+def record_fingerprint(qdc: Union[bytes, str]):
+    """
+    Return a fingerprint of the text of a QDC record.
+    """
+    if isinstance(qdc, str):
+        qdc = qdc.encode('utf-8')
+    return hashlib.sha256(qdc).hexdigest()
+
+
+def files_fingerprint(files: Iterable, root: Path):
+    """
+    Return a fingerprint of a package's file set: the path (relative to
+    ``root``), size and mtime of every file. Files are stat'ed, not read, so
+    a file rewritten with the same size and mtime is not noticed.
+    Files that have disappeared are left out.
+    """
+    h = hashlib.sha256()
+    for f in sorted(str(f) for f in files):
+        try:
+            st = os.stat(f)
+        except FileNotFoundError:
+            continue
+        h.update(f'{os.path.relpath(f, root)}\0{st.st_size}\0{st.st_mtime_ns}\n'.encode('utf-8'))
+    return h.hexdigest()
@@ -0,0 +1,206 @@
+import json
+import gzip
+from pathlib import Path
+from typing import NamedTuple
+
+from lxml import etree
+
+from logging import getLogger
+
+CONTEXT_LOC = Path(__file__).parent.joinpath('manifest/figshare.jsonld')
+SCHEMA = 'http://schema.org/'
+QDC_NSMAP = {
+    'qdc': 'http://dspace.org/qualifieddc/',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'dcterms': 'http://purl.org/dc/terms/',
+}
+# file names that are read as Figshare JSON rather than as a QDC export
+FIGSHARE_SUFFIXES = ('.json', '.jsonl', '.json.gz', '.jsonl.gz')
+# characters read from a dump at a time
+READ_SIZE = 1024 * 1024
+
+# the context compiled to term -> IRI, built once per process
+global CONTEXT
+CONTEXT = None
+
+
+class FigshareFile(NamedTuple):
+    name: str
+    size: int
+    md5: str
+    url: str
+
+
+class Article(NamedTuple):
+    doi: str
+    metadata: dict
+    files: list
+
+
+def is_figshare_file(path):
+    return str(path).lower().endswith(FIGSHARE_SUFFIXES)
+
+
+def compile_context(path: Path=CONTEXT_LOC):
+    """
+    Compile a JSON-LD context to a dict of term -> full IRI (or keyword,
+    such as @id), resolving prefixes like "schema:".
+    """
+    with open(path, 'r') as cf:
+        context = json.load(cf)['@context']
+    prefixes = {k: v for k, v in context.items() if isinstance(v, str) and v.endswith(('/', '#'))}
+
+    def resolve(iri: str):
+        prefix, sep, suffix = iri.partition(':')
+        return prefixes[prefix] + suffix if sep and prefix in prefixes else iri
+
+    return {k: resolve(v if isinstance(v, str) else v['@id'])
+            for k, v in context.items() if k not in prefixes}
+
+
+def get_context():
+    """
+    Return the compiled Figshare context, compiling it on first use.
+    """
+    global CONTEXT
+    if CONTEXT is None:
+        CONTEXT = compile_context()
+    return CONTEXT
+
+
+def expand(value, terms: dict):
+    """
+    Expand a Figshare JSON value with compiled ``terms``: keys become full
+    IRIs, the values of each IRI are a list (in order, for @list terms), and
+    nested objects are expanded in turn. Keys the context does not define
+    are dropped, as in JSON-LD expansion; keys that map to the same IRI,
+    such as title and name, are merged.
+    """
+    if isinstance(value, list):
+        return [expand(v, terms) for v in value]
+    if not isinstance(value, dict):
+        return value
+    expanded = {}
+    for k, v in value.items():
+        iri = terms.get(k)
+        if iri is None or v is None:
+            continue
+        if iri.startswith('@'):
+            expanded[iri] = v
+            continue
+        values = v if isinstance(v, list) else [v]
+        expanded.setdefault(iri, []).extend(expand(x, terms) for x in values if x is not None)
+    return expanded
+
+
+def iter_json(path: Path, read_size: int=READ_SIZE):
+    """
+    Incrementally decode the values of a JSON dump: a top-level array, or
+    one value per line (gzipped if the name ends in .gz).
+    Only the value being decoded and one read of the file are held in
+    memory, so the size of the dump does not matter. A value that spans
+    reads is decoded again once more has been read; each retry at least
+    doubles what is read, so large values cost linear time.
+    """
+    decoder = json.JSONDecoder()
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        buf, pos, eof = '', 0, False
+        while True:
+            # skip the brackets of a top-level array and the separators between values
+            while pos < len(buf) and buf[pos] in ' \t\r\n,[]':
+                pos += 1
+            if pos == len(buf):
+                if eof:
+                    return
+                buf, pos = f.read(read_size), 0
+                eof = not buf
+                continue
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                more = f.read(max(read_size, len(buf) - pos))
+                buf, pos, eof = buf[pos:] + more, 0, not more
+                continue
+            pos = end
+            yield value
+
+
+def parse_figshare_file(path: Path):
+    """
+    Incrementally read a Figshare JSON dump of articles, as returned by the
+    Figshare API, and yield an Article for each: the DOI, the metadata
+    expanded with the bundled figshare.jsonld context, and the files.
+    """
+    L = getLogger(__name__)
+    terms = get_context()
+    for n, item in enumerate(iter_json(path), 1):
+        if not isinstance(item, dict):
+            L.error(f'Skipping value {n} of {path}: not a Figshare article')
+            continue
+        doi = item.get('doi')
+        if not doi:
+            L.error(f'Skipping Figshare article {item.get("id")} with no DOI')
+            continue
+        files = [FigshareFile(f.get('name'), f.get('size'), f.get('computed_md5'), f.get('download_url'))
+                 for f in item.get('files') or []]
+        yield Article(doi.strip(), expand(item, terms), files)
+
+
+def first(metadata: dict, term: str):
+    values = metadata.get(SCHEMA + term)
+    return values[0] if values else None
+
+
+def person(author):
+    """
+    Return an author as "Family, Given", or the full name if the parts are
+    not given.
+    """
+    if not isinstance(author, dict):
+        return author
+    family, given = first(author, 'familyName'), first(author, 'givenName')
+    if family:
+        return f'{family}, {given}' if given else family
+    return first(author, 'name')
+
+
+def article_qdc(article: Article):
+    """
+    Write the metadata of an article as a QDC record like those of the QDC
+    export.
+    """
+    qdc = etree.Element(f'{{{QDC_NSMAP["qdc"]}}}qualifieddc', nsmap=QDC_NSMAP)
+
+    def add(ns: str, name: str, text):
+        if text:
+            etree.SubElement(qdc, f'{{{QDC_NSMAP[ns]}}}{name}').text = str(text)
+
+    md = article.metadata
+    add('dc', 'title', first(md, 'name'))
+    for author in md.get(SCHEMA + 'author', ()):
+        add('dc', 'creator', person(author))
+    add('dc', 'description', first(md, 'description'))
+    add('dcterms', 'issued', first(md, 'datePublished'))
+    add('dcterms', 'modified', first(md, 'dateModified'))
+    for keyword in md.get(SCHEMA + 'keywords', ()):
+        add('dc', 'subject', keyword)
+    for lic in md.get(SCHEMA + 'license', ()):
+        add('dc', 'rights', (first(lic, 'name') or first(lic, 'url')) if isinstance(lic, dict) else lic)
+    add('dc', 'type', md.get('@type'))
+    add('dc', 'identifier', article.doi)
+    return etree.tostring(qdc, encoding='unicode')
+
+
+def parse_figshare_records(path: Path):
+    """
+    Incrementally read a Figshare JSON dump and yield a (doi, qdc) tuple for
+    each article, like parse_qdc_file, so that it can be packaged without a
+    separate QDC export. Package files are still resolved in DATA_ROOT.
+    """
+    L = getLogger(__name__)
+    for article in parse_figshare_file(path):
+        L.debug(f'{article.doi} Figshare lists {len(article.files)} files')
+        yield article.doi, article_qdc(article)
@@ -0,0 +1,96 @@
+import os
+import time
+import hashlib
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# DataONE checksum algorithm names and their hashlib constructors
+ALGORITHMS = {
+    'MD5': hashlib.md5,
+    'SHA-1': hashlib.sha1,
+    'SHA-256': hashlib.sha256,
+}
+# files at least this large are hashed with reads and digest updates overlapped
+PARALLEL_THRESHOLD = 64 * 1024 * 1024
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def normalize(algorithm: str):
+    """
+    Return the DataONE name of a checksum algorithm (e.g. 'sha256' -> 'SHA-256').
+    """
+    name = algorithm.upper().replace('_', '-')
+    if name not in ALGORITHMS:
+        name = {'SHA1': 'SHA-1', 'SHA256': 'SHA-256'}.get(name, name)
+    if name not in ALGORITHMS:
+        raise ValueError(f'Unsupported checksum algorithm {algorithm} (use one of {", ".join(ALGORITHMS)})')
+    return name
+
+
+def _pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix='hash')
+        return _POOL
+
+
+def hash_bytes(data: bytes, algorithms: tuple):
+    """
+    Return a dict of algorithm -> hex digest of ``data``.
+    """
+    return {a: ALGORITHMS[a](data).hexdigest() for a in algorithms}
+
+
+def _update(hasher, chunk: bytes):
+    """
+    Update a digest with a chunk and return the seconds it took.
+    """
+    start = time.perf_counter()
+    hasher.update(chunk)
+    return time.perf_counter() - start
+
+
+def hash_file(path: Path, algorithms: tuple, chunk_size: int, timings: dict=None):
+    """
+    Compute several digests of a file in a single chunked read; only one or
+    two chunks are held in memory at a time.
+
+    Small files are hashed inline. For files of PARALLEL_THRESHOLD bytes or
+    more, each chunk's digest updates run on a shared thread pool while the
+    next chunk is read (hashlib releases the GIL), so reading and the
+    separate digests proceed in parallel. On a single CPU this only adds
+    overhead, so it is skipped there.
+    :param timings: If given, 'read' and 'hash' seconds are added to it; 'hash' is
+        the time spent updating each digest, summed over the digests
+    :return: A (size, {algorithm: hex digest}) tuple
+    """
+    hashers = [ALGORITHMS[a]() for a in algorithms]
+    size = 0
+    read_s, hash_s = 0.0, 0.0
+    with open(path, 'rb') as f:
+        parallel = os.fstat(f.fileno()).st_size >= PARALLEL_THRESHOLD and (os.cpu_count() or 1) > 1
+        pending = []
+        while True:
+            t0 = time.perf_counter()
+            chunk = f.read(chunk_size)
+            read_s += time.perf_counter() - t0
+            # the previous chunk's updates must finish before this chunk's start
+            for fut in pending:
+                hash_s += fut.result()
+            pending = []
+            if not chunk:
+                break
+            if parallel:
+                pending = [_pool().submit(_update, h, chunk) for h in hashers]
+            else:
+                for h in hashers:
+                    hash_s += _update(h, chunk)
+            size += len(chunk)
+    if timings is not None:
+        timings['read'] = timings.get('read', 0.0) + read_s
+        timings['hash'] = timings.get('hash', 0.0) + hash_s
+    return size, {a: h.hexdigest() for a, h in zip(algorithms, hashers)}
@@ -0,0 +1,174 @@
+import os
+import re
+import json
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from logging import getLogger
+
+INDEX_VERSION = 1
+VERSION_RE = re.compile(r'^(?P<root>.+)\.v(?P<version>\d+)$')
+
+
+class DataIndex():
+    """
+    In-memory index of the files under DATA_ROOT.
+
+    The index maps each directory (relative to the root, '/'-separated) to
+    its mtime_ns, its subdirectories and its files with their sizes. It is
+    built with one parallel scandir sweep and can be saved to disk; on the
+    next refresh, directories whose mtime has not changed are not listed
+    again, but their files are still stat'ed, since rewriting a file in
+    place does not change the mtime of its directory. DOI directories are additionally grouped by DOI root and version,
+    so that resolving the files of a DOI is a dictionary lookup.
+    """
+    def __init__(self, root: Path, dirs: dict=None):
+        self.root = Path(root)
+        self.dirs = dirs or {}
+        self._group_versions()
+
+    @classmethod
+    def load(cls, path: Path, root: Path):
+        """
+        Load a saved index, or return an empty one if the file does not exist
+        or was built for a different root.
+        """
+        L = getLogger(__name__)
+        try:
+            with open(path, 'r') as f:
+                saved = json.load(f)
+            if saved.get('version') == INDEX_VERSION and saved.get('root') == str(root):
+                return cls(root, saved['dirs'])
+            L.info(f'Index {path} was built for a different root or format; rebuilding')
+        except FileNotFoundError:
+            L.info(f'No index found at {path}; building a new one')
+        except ValueError as e:
+            L.warning(f'Could not read index {path} ({e}); rebuilding')
+        return cls(root)
+
+    def save(self, path: Path):
+        """
+        Write the index to ``path`` atomically.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'root': str(self.root), 'dirs': self.dirs}, f)
+        os.replace(tmp, path)
+
+    def _scan_dir(self, rel: str):
+        """
+        List a single directory, reusing the previous listing if its mtime is
+        unchanged; the files of a reused listing are stat'ed again so that
+        their sizes are current. Returns (rel, entry, rescanned), or
+        (rel, None, False) if the directory has disappeared.
+        """
+        path = os.path.join(self.root, rel) if rel else str(self.root)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            old = self.dirs.get(rel)
+            if old and old['mtime_ns'] == mtime_ns:
+                try:
+                    files = [[name, os.stat(os.path.join(path, name)).st_size] for name, size in old['files']]
+                    return rel, {**old, 'files': files}, False
+                except FileNotFoundError:
+                    # replaced within the mtime granularity of the directory; list it again
+                    pass
+            files, subdirs = [], []
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                    elif entry.is_file():
+                        files.append([entry.name, entry.stat().st_size])
+        except FileNotFoundError:
+            return rel, None, False
+        return rel, {'mtime_ns': mtime_ns, 'subdirs': sorted(subdirs), 'files': sorted(files)}, True
+
+    def refresh(self, workers: int=16):
+        """
+        Sweep the root breadth-first on a thread pool and update the index.
+        Every directory and file is stat'ed once; only directories whose
+        mtime changed are listed again. Directories that no longer exist are
+        dropped.
+        """
+        L = getLogger(__name__)
+        dirs = {}
+        rescanned = 0
+        frontier = ['']
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            while frontier:
+                nxt = []
+                for rel, entry, changed in ex.map(self._scan_dir, frontier):
+                    if entry is None:
+                        continue
+                    dirs[rel] = entry
+                    rescanned += changed
+                    nxt.extend(f'{rel}/{d}' if rel else d for d in entry['subdirs'])
+                frontier = nxt
+        self.dirs = dirs
+        self._group_versions()
+        L.info(f'Indexed {len(dirs)} directories under {self.root} ({rescanned} rescanned)')
+        return self
+
+    def _group_versions(self):
+        self.versions = {}
+        for rel in self.dirs:
+            m = VERSION_RE.match(rel)
+            if m:
+                self.versions.setdefault(m['root'], {})[int(m['version'])] = rel
+
+    def exists(self, doi: str):
+        return doi in self.dirs
+
+    def entries(self, doi: str):
+        """
+        Return a list of (Path, size) for the files directly in a DOI directory.
+        """
+        d = self.dirs.get(doi)
+        if not d:
+            return []
+        return [(self.root / doi / name, size) for name, size in d['files']]
+
+    def resolve_entries(self, doi: str, quiet: bool=False):
+        """
+        Return (Path, size) for the files of a DOI. If the DOI directory does
+        not exist, collect the files of every earlier version directory of the
+        same DOI root instead, newest first. With ``quiet``, nothing is logged.
+        """
+        L = getLogger(__name__)
+        log = L.debug if quiet else L.info
+        if doi in self.dirs:
+            return self.entries(doi)
+        m = VERSION_RE.match(doi)
+        if not m:
+            log(f'{doi} has no version.')
+            return []
+        version = int(m['version'])
+        older = sorted((v for v in self.versions.get(m['root'], {}) if v < version), reverse=True)
+        flist = []
+        for v in older:
+            found = self.entries(self.versions[m['root']][v])
+            log(f'Found {len(found)} existing files in version {v} directory')
+            flist.extend(found)
+        log(f'Found {len(older)} versions of doi root {m["root"]}')
+        return flist
+
+    def resolve(self, doi: str):
+        """
+        Return the list of file Paths for a DOI (see resolve_entries).
+        """
+        return [f for f, size in self.resolve_entries(doi)]
+
+
+def build_index(root: Path, path: Path=None, workers: int=16):
+    """
+    Load the saved index at ``path`` (if any), refresh it against ``root`` and
+    save it again.
+    """
+    index = DataIndex.load(path, root) if path else DataIndex(root)
+    index.refresh(workers=workers)
+    if path:
+        index.save(path)
+    return index
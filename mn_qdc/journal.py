@@ -0,0 +1,214 @@
+import sqlite3
+import datetime
+import threading
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS packages (
+    doi TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    qdc_pid TEXT,
+    ore_pid TEXT,
+    updated TEXT NOT NULL,
+    record_fp TEXT,
+    files_fp TEXT,
+    prev_qdc_pid TEXT,
+    prev_ore_pid TEXT
+);
+CREATE TABLE IF NOT EXISTS objects (
+    doi TEXT NOT NULL,
+    path TEXT NOT NULL,
+    pid TEXT NOT NULL,
+    size INTEGER,
+    checksum TEXT,
+    algorithm TEXT,
+    reused INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (doi, path)
+);
+"""
+
+# columns added to the packages and objects tables after their first release
+PACKAGE_COLUMNS = {
+    'record_fp': 'TEXT',
+    'files_fp': 'TEXT',
+    'prev_qdc_pid': 'TEXT',
+    'prev_ore_pid': 'TEXT',
+}
+OBJECT_COLUMNS = {
+    'size': 'INTEGER',
+    'checksum': 'TEXT',
+    'algorithm': 'TEXT',
+    'reused': 'INTEGER NOT NULL DEFAULT 0',
+}
+
+STARTED = 'started'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Journal():
+    """
+    Durable record of run progress, kept in a SQLite database.
+
+    Each DOI has a state and the PIDs of the objects that have already been
+    created on the MN for it, so that an interrupted run can skip finished
+    packages and continue partial ones without re-uploading anything.
+    Objects are stored with their size and checksum so that later runs can
+    reuse them for dedup; objects that a package reuses from another package
+    are marked as such and never rolled back with it.
+
+    Finished packages also keep fingerprints of their QDC record and file
+    set (see delta.py). When a changed package is updated, the PIDs of the
+    version it replaces are kept until the new version is finished.
+    The journal is safe to share between package and upload threads.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._con.execute('PRAGMA journal_mode=WAL')
+        self._con.execute('PRAGMA synchronous=NORMAL')
+        self._con.executescript(SCHEMA)
+        for table, added in (('packages', PACKAGE_COLUMNS), ('objects', OBJECT_COLUMNS)):
+            columns = {row[1] for row in self._con.execute(f'PRAGMA table_info({table})')}
+            for name, decl in added.items():
+                if name not in columns:
+                    self._con.execute(f'ALTER TABLE {table} ADD COLUMN {name} {decl}')
+
+    def _now(self):
+        return datetime.datetime.now().isoformat(timespec='seconds')
+
+    def _execute(self, sql: str, params=()):
+        with self._lock:
+            return self._con.execute(sql, params).fetchall()
+
+    def state(self, doi: str):
+        """
+        Return the state of a DOI, or None if it has not been seen before.
+        """
+        rows = self._execute('SELECT state FROM packages WHERE doi = ?', (doi,))
+        return rows[0][0] if rows else None
+
+    def is_done(self, doi: str):
+        return self.state(doi) == DONE
+
+    def get_qdc_pid(self, doi: str):
+        rows = self._execute('SELECT qdc_pid FROM packages WHERE doi = ?', (doi,))
+        return rows[0][0] if rows else None
+
+    def get_ore_pid(self, doi: str):
+        rows = self._execute('SELECT ore_pid FROM packages WHERE doi = ?', (doi,))
+        return rows[0][0] if rows else None
+
+    def get_objects(self, doi: str):
+        """
+        Return a dict of file path -> PID for data objects already uploaded.
+        """
+        rows = self._execute('SELECT path, pid FROM objects WHERE doi = ?', (doi,))
+        return {path: pid for path, pid in rows}
+
+    def reused_pids(self, doi: str):
+        """
+        Return the set of PIDs this DOI reuses from other packages.
+        """
+        rows = self._execute('SELECT pid FROM objects WHERE doi = ? AND reused', (doi,))
+        return {pid for pid, in rows}
+
+    def dedup_keys(self, algorithm: str):
+        """
+        Return (size, checksum), PID pairs for the objects of finished
+        packages whose checksum was computed with ``algorithm``.
+        """
+        rows = self._execute('SELECT DISTINCT o.size, o.checksum, o.pid FROM objects o '
+                             'JOIN packages p ON p.doi = o.doi '
+                             'WHERE p.state = ? AND o.algorithm = ? AND o.checksum IS NOT NULL',
+                             (DONE, algorithm))
+        return [((size, checksum), pid) for size, checksum, pid in rows]
+
+    def get_fingerprints(self, doi: str):
+        """
+        Return the (record, files) fingerprints of the last finished version
+        of a DOI; either may be None.
+        """
+        rows = self._execute('SELECT record_fp, files_fp FROM packages WHERE doi = ?', (doi,))
+        return tuple(rows[0]) if rows else (None, None)
+
+    def set_fingerprints(self, doi: str, fingerprints: tuple):
+        self._execute('UPDATE packages SET record_fp = ?, files_fp = ? WHERE doi = ?', (*fingerprints, doi))
+
+    def get_previous(self, doi: str):
+        """
+        Return the (QDC PID, resource map PID) of the version of a DOI that
+        is being updated, or (None, None).
+        """
+        rows = self._execute('SELECT prev_qdc_pid, prev_ore_pid FROM packages WHERE doi = ?', (doi,))
+        return tuple(rows[0]) if rows else (None, None)
+
+    def begin_update(self, doi: str):
+        """
+        Start a new version of a finished DOI: its PIDs become the previous
+        version, and its objects are forgotten so that nothing is resumed
+        from or rolled back into the old version.
+        """
+        with self._lock:
+            with self._con:
+                self._con.execute('BEGIN')
+                self._con.execute('DELETE FROM objects WHERE doi = ?', (doi,))
+                self._con.execute('UPDATE packages SET state = ?, prev_qdc_pid = qdc_pid, prev_ore_pid = ore_pid, '
+                                  'qdc_pid = NULL, ore_pid = NULL, updated = ? WHERE doi = ?',
+                                  (STARTED, self._now(), doi))
+
+    def start(self, doi: str):
+        self._execute('INSERT INTO packages (doi, state, updated) VALUES (?, ?, ?) '
+                      'ON CONFLICT(doi) DO UPDATE SET state = excluded.state, updated = excluded.updated',
+                      (doi, STARTED, self._now()))
+
+    def set_qdc_pid(self, doi: str, pid: str):
+        self._execute('UPDATE packages SET qdc_pid = ?, updated = ? WHERE doi = ?',
+                      (pid, self._now(), doi))
+
+    def add_object(self, doi: str, path: Path, pid: str, key: tuple=None, algorithm: str=None,
+                   reused: bool=False):
+        """
+        Record the object for ``path``; ``key`` is its (size, checksum) tuple
+        and ``reused`` marks a PID that belongs to another package.
+        """
+        size, checksum = key or (None, None)
+        self._execute('INSERT OR REPLACE INTO objects (doi, path, pid, size, checksum, algorithm, reused) '
+                      'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                      (doi, str(path), pid, size, checksum, algorithm if key else None, int(reused)))
+
+    def finish(self, doi: str, ore_pid: str, fingerprints: tuple=(None, None)):
+        self._execute('UPDATE packages SET state = ?, ore_pid = ?, record_fp = ?, files_fp = ?, '
+                      'prev_qdc_pid = NULL, prev_ore_pid = NULL, updated = ? WHERE doi = ?',
+                      (DONE, ore_pid, *fingerprints, self._now(), doi))
+
+    def fail(self, doi: str):
+        """
+        Mark a DOI as failed and forget its PIDs (they have been rolled back).
+        The PIDs of a previous version are kept for the next update.
+        """
+        with self._lock:
+            with self._con:
+                self._con.execute('BEGIN')
+                self._con.execute('DELETE FROM objects WHERE doi = ?', (doi,))
+                self._con.execute('UPDATE packages SET state = ?, qdc_pid = NULL, ore_pid = NULL, '
+                                  'updated = ? WHERE doi = ?', (FAILED, self._now(), doi))
+
+    def summary(self):
+        """
+        Return a dict of state -> number of DOIs.
+        """
+        return dict(self._execute('SELECT state, COUNT(*) FROM packages GROUP BY state'))
+
+    def dois(self, state: str):
+        """
+        Return the DOIs in ``state`` with the time each was last updated,
+        oldest first.
+        """
+        return self._execute('SELECT doi, updated FROM packages WHERE state = ? ORDER BY updated', (state,))
+
+    def close(self):
+        with self._lock:
+            self._con.close()
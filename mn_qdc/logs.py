@@ -0,0 +1,88 @@
+import json
+import queue
+import atexit
+import random
+import datetime
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+# characters of a debug body written to the log by default
+BODY_LIMIT = 2000
+
+
+def body_text(body):
+    """
+    Return the text of a debug body; pyxb objects, such as MN responses, are
+    written as XML.
+    """
+    toxml = getattr(body, 'toxml', None)
+    if toxml:
+        try:
+            return toxml('utf-8').decode('utf-8')
+        except Exception:
+            # types that are not bound to an element cannot be serialized alone
+            pass
+    return str(body)
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Format records as JSON lines with the time, level, logger, function,
+    thread and message, and the traceback if there is one.
+
+    Bulky payloads such as QDC records and MN responses are passed as
+    ``extra={'body': obj}`` rather than in the message. They are only turned
+    into text here, which with queue logging is on the listener thread, not
+    the thread that logged them; at most ``body_limit`` characters are kept
+    (0 for no limit), and only a ``body_sample`` fraction of records keep
+    their body at all.
+    """
+    def __init__(self, body_limit: int=BODY_LIMIT, body_sample: float=1.0, **kwargs):
+        super().__init__(**kwargs)
+        self.body_limit = body_limit
+        self.body_sample = body_sample
+
+    def format(self, record: logging.LogRecord):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'func': record.funcName,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        body = getattr(record, 'body', None)
+        if body is not None and (self.body_sample >= 1 or random.random() < self.body_sample):
+            text = body_text(body)
+            if self.body_limit and len(text) > self.body_limit:
+                entry['body_chars'] = len(text)
+                text = text[:self.body_limit]
+            entry['body'] = text
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def queue_handlers(logger: logging.Logger=None):
+    """
+    Move the handlers of ``logger`` (default: the root logger) behind a
+    queue: the logger gets a QueueHandler, and a QueueListener thread passes
+    records to the original handlers, so that threads and the event loop do
+    not wait on formatting and disk writes. The listener is stopped, and
+    the queue flushed, at exit.
+    Returns the listener, or None if the logger has no handlers.
+    """
+    logger = logger or logging.getLogger()
+    handlers = [h for h in logger.handlers if not isinstance(h, QueueHandler)]
+    if not handlers:
+        return None
+    q = queue.SimpleQueue()
+    for h in handlers:
+        logger.removeHandler(h)
+    logger.addHandler(QueueHandler(q))
+    listener = QueueListener(q, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
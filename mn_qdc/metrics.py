@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+from logging import getLogger
+
+PREFIX = 'mnqdc'
+# histogram buckets in seconds, from a cached stat to a multi-GB upload
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+HELP = {
+    'stage_seconds': 'Time spent in each stage of package creation',
+    'bytes_read_total': 'Bytes read from DATA_ROOT for hashing',
+    'bytes_uploaded_total': 'Bytes of objects created on the MN',
+    'objects_created_total': 'Objects created on the MN',
+    'packages_total': 'Packages finished, by result',
+    'concurrency_limit': 'Current limit on concurrent MN uploads (see --adaptive)',
+}
+
+
+class Metrics():
+    """
+    Thread-safe counters and histograms for a run.
+
+    Histograms record durations under a ``stage`` label (read, hash,
+    sysmeta, ore, mn_create, rollback, ...), so that a snapshot shows
+    whether a run is waiting on the disk, the CPU or the MN. Snapshots can
+    be written as JSON or as a Prometheus textfile.
+    """
+    def __init__(self, buckets: tuple=BUCKETS):
+        self.buckets = buckets
+        self.started = time.time()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: dict):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, le in enumerate(self.buckets):
+                if seconds <= le:
+                    h['buckets'][i] += 1
+                    break
+            h['sum'] += seconds
+            h['count'] += 1
+
+    @contextmanager
+    def time(self, stage: str, **labels):
+        """
+        Context manager that records the duration of its block as a stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+    def snapshot(self):
+        """
+        Return the current values as a dict that can be serialized to JSON.
+        Histogram buckets are cumulative, as in Prometheus.
+        """
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            gauges = [{'name': name, 'labels': dict(labels), 'value': value}
+                      for (name, labels), value in sorted(self._gauges.items())]
+            histograms = []
+            for (name, labels), h in sorted(self._histograms.items()):
+                cumulative, n = [], 0
+                for le, count in zip(self.buckets, h['buckets']):
+                    n += count
+                    cumulative.append([le, n])
+                histograms.append({'name': name, 'labels': dict(labels), 'buckets': cumulative,
+                                   'sum': round(h['sum'], 6), 'count': h['count']})
+        return {'timestamp': time.time(), 'started': self.started,
+                'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def to_prometheus(self, snapshot: dict=None):
+        """
+        Render a snapshot in the Prometheus text exposition format.
+        """
+        snapshot = snapshot or self.snapshot()
+        def fmt(labels: dict):
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+        lines, seen = [], set()
+        def header(name: str, kind: str):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f'# HELP {PREFIX}_{name} {HELP.get(name, name)}')
+                lines.append(f'# TYPE {PREFIX}_{name} {kind}')
+        for c in snapshot['counters']:
+            header(c['name'], 'counter')
+            lines.append(f'{PREFIX}_{c["name"]}{fmt(c["labels"])} {c["value"]}')
+        for g in snapshot['gauges']:
+            header(g['name'], 'gauge')
+            lines.append(f'{PREFIX}_{g["name"]}{fmt(g["labels"])} {g["value"]}')
+        for h in snapshot['histograms']:
+            header(h['name'], 'histogram')
+            for le, n in h['buckets']:
+                lines.append(f'{PREFIX}_{h["name"]}_bucket{fmt({**h["labels"], "le": le})} {n}')
+            lines.append(f'{PREFIX}_{h["name"]}_bucket{fmt({**h["labels"], "le": "+Inf"})} {h["count"]}')
+            lines.append(f'{PREFIX}_{h["name"]}_sum{fmt(h["labels"])} {h["sum"]}')
+            lines.append(f'{PREFIX}_{h["name"]}_count{fmt(h["labels"])} {h["count"]}')
+        lines.append(f'{PREFIX}_start_time_seconds {snapshot["started"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: Path):
+        """
+        Write a snapshot to ``path`` atomically: a Prometheus textfile if the
+        name ends in .prom, JSON otherwise.
+        """
+        path = Path(path)
+        snapshot = self.snapshot()
+        text = self.to_prometheus(snapshot) if path.suffix == '.prom' else json.dumps(snapshot, indent=1)
+        tmp = path.with_name(f'.{path.name}.tmp')
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    def summary(self):
+        """
+        Return the total time and number of calls of each stage, for the
+        run report.
+        """
+        totals = {}
+        with self._lock:
+            for (name, labels), h in self._histograms.items():
+                if name == 'stage_seconds':
+                    stage = dict(labels)['stage']
+                    total, count = totals.get(stage, (0.0, 0))
+                    totals[stage] = (total + h['sum'], count + h['count'])
+        return {f'Time in {stage}': f'{round(total, 1)} s ({count} calls)'
+                for stage, (total, count) in sorted(totals.items())}
+
+
+class MetricsWriter():
+    """
+    Writes snapshots of ``metrics`` to ``path`` every ``interval`` seconds
+    from a background thread, and once more when stopped.
+    Use as a context manager.
+    """
+    def __init__(self, metrics: Metrics, path: Path, interval: float=15):
+        self.metrics = metrics
+        self.path = Path(path)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics-writer', daemon=True)
+
+    def _run(self):
+        L = getLogger(__name__)
+        while not self._stop.wait(self.interval):
+            try:
+                self.metrics.write(self.path)
+            except OSError as e:
+                L.warning(f'Could not write metrics to {self.path} ({e})')
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        self.metrics.write(self.path)
@@ -0,0 +1,235 @@
+import re
+import time
+import random
+import hashlib
+import datetime
+import threading
+import email.policy
+import email.parser
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from d1_common.types import dataoneTypes
+
+from logging import getLogger
+
+READ_SIZE = 64 * 1024
+ERROR_XML = ('<?xml version="1.0" encoding="UTF-8"?>'
+             '<error name="%s" errorCode="%s" detailCode="0"><description>%s</description></error>')
+
+
+class MockMemberNode():
+    """
+    Local stand-in for a DataONE Member Node, for testing and benchmarking.
+
+    Implements the calls mnqdc uses (MNStorage.create/update/delete,
+    MNRead.listObjects/getSystemMetadata) under ``base_url``. Object bytes
+    are not kept, only their sysmeta, size and MD5. Each request can be
+    slowed by a fixed ``latency`` (seconds), uploads are throttled to
+    ``bandwidth`` bytes/s, and a fraction ``error_rate`` of requests fails
+    with ServiceUnavailable (503).
+    """
+    def __init__(self, host: str='127.0.0.1', port: int=0, latency: float=0.0, bandwidth: float=None,
+                 error_rate: float=0.0, seed: int=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.objects = {}
+        self.stats = {'requests': 0, 'creates': 0, 'updates': 0, 'deletes': 0, 'errors': 0, 'bytes': 0}
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/mn'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def count(self, key: str, n: int=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+
+def _handler(mn: MockMemberNode):
+    L = getLogger(__name__)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body are written separately; avoid Nagle/delayed-ACK stalls
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            L.debug(format % args)
+
+        def _send(self, status: int, body: bytes, content_type: str='text/xml'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _error(self, name: str, status: int, description: str):
+            mn.count('errors')
+            self._send(status, (ERROR_XML % (name, status, description)).encode('utf-8'))
+
+        def _read_body(self):
+            """
+            Read the request body, throttled to the configured bandwidth.
+            """
+            remaining = int(self.headers.get('Content-Length', 0))
+            chunks = []
+            start = time.monotonic()
+            received = 0
+            while remaining > 0:
+                chunk = self.rfile.read(min(READ_SIZE, remaining))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                remaining -= len(chunk)
+                received += len(chunk)
+                if mn.bandwidth:
+                    ahead = received / mn.bandwidth - (time.monotonic() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+            mn.count('bytes', received)
+            return b''.join(chunks)
+
+        def _parse_multipart(self, body: bytes):
+            msg = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                b'Content-Type: ' + self.headers['Content-Type'].encode('latin-1') + b'\r\n\r\n' + body)
+            return {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                    for part in msg.iter_parts()}
+
+        def _route(self):
+            path = urlparse(self.path)
+            m = re.match(r'^/mn/v2/(?P<resource>object|meta)(/(?P<pid>.+))?$', path.path)
+            if not m:
+                return None, None, None
+            return m['resource'], unquote(m['pid']) if m['pid'] else None, parse_qs(path.query)
+
+        def _begin(self):
+            mn.count('requests')
+            if mn.latency:
+                time.sleep(mn.latency)
+            if mn.should_fail():
+                self._error('ServiceUnavailable', 503, 'Injected failure')
+                return False
+            return True
+
+        def _store(self, pid: str, fields: dict):
+            obj = fields.get('object') or b''
+            sysmeta = dataoneTypes.CreateFromDocument(fields['sysmeta'])
+            sysmeta.dateUploaded = sysmeta.dateUploaded or datetime.datetime.now()
+            with mn._lock:
+                if pid in mn.objects:
+                    return False
+                mn.objects[pid] = {'sysmeta': sysmeta, 'size': len(obj),
+                                   'md5': hashlib.md5(obj).hexdigest()}
+            return True
+
+        def do_POST(self):
+            body = self._read_body()
+            resource, pid, _ = self._route()
+            if resource != 'object' or pid:
+                return self._error('NotImplemented', 501, f'POST {self.path}')
+            if not self._begin():
+                return
+            fields = self._parse_multipart(body)
+            pid = fields['pid'].decode('utf-8')
+            if not self._store(pid, fields):
+                return self._error('IdentifierNotUnique', 409, pid)
+            mn.count('creates')
+            self._send(200, dataoneTypes.identifier(pid).toxml('utf-8'))
+
+        def do_PUT(self):
+            body = self._read_body()
+            resource, pid, _ = self._route()
+            if resource != 'object' or not pid:
+                return self._error('NotImplemented', 501, f'PUT {self.path}')
+            if not self._begin():
+                return
+            if pid not in mn.objects:
+                return self._error('NotFound', 404, pid)
+            fields = self._parse_multipart(body)
+            new_pid = fields['newPid'].decode('utf-8')
+            if not self._store(new_pid, fields):
+                return self._error('IdentifierNotUnique', 409, new_pid)
+            with mn._lock:
+                mn.objects[pid]['sysmeta'].obsoletedBy = new_pid
+            mn.count('updates')
+            self._send(200, dataoneTypes.identifier(new_pid).toxml('utf-8'))
+
+        def do_DELETE(self):
+            self._read_body()
+            resource, pid, _ = self._route()
+            if resource != 'object' or not pid:
+                return self._error('NotImplemented', 501, f'DELETE {self.path}')
+            if not self._begin():
+                return
+            with mn._lock:
+                found = mn.objects.pop(pid, None)
+            if not found:
+                return self._error('NotFound', 404, pid)
+            mn.count('deletes')
+            self._send(200, dataoneTypes.identifier(pid).toxml('utf-8'))
+
+        def do_GET(self):
+            self._read_body()
+            resource, pid, query = self._route()
+            if not resource:
+                return self._error('NotImplemented', 501, f'GET {self.path}')
+            if not self._begin():
+                return
+            if resource == 'meta' and pid:
+                with mn._lock:
+                    found = mn.objects.get(pid)
+                if not found:
+                    return self._error('NotFound', 404, pid)
+                return self._send(200, found['sysmeta'].toxml('utf-8'))
+            if resource == 'object' and not pid:
+                return self._send(200, self._list_objects(query))
+            self._error('NotImplemented', 501, f'GET {self.path}')
+
+        def _list_objects(self, query: dict):
+            start = int(query.get('start', ['0'])[0])
+            count = int(query.get('count', ['1000'])[0])
+            with mn._lock:
+                pids = sorted(mn.objects)
+                page = [(pid, mn.objects[pid]) for pid in pids[start:start + count]]
+            ol = dataoneTypes.objectList()
+            ol.start, ol.total = start, len(pids)
+            for pid, obj in page:
+                sm = obj['sysmeta']
+                info = dataoneTypes.objectInfo()
+                info.identifier = pid
+                info.formatId = sm.formatId
+                info.checksum = dataoneTypes.checksum(obj['md5'])
+                info.checksum.algorithm = 'MD5'
+                info.size = obj['size']
+                info.dateSysMetadataModified = sm.dateSysMetadataModified or datetime.datetime.now()
+                ol.objectInfo.append(info)
+            ol.count = len(page)
+            return ol.toxml('utf-8')
+
+    return Handler
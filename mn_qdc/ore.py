@@ -0,0 +1,76 @@
+from typing import Iterable
+from xml.sax.saxutils import escape
+
+import d1_common.const
+import d1_common.url
+import d1_common.type_conversions
+
+# the prefix of the URIs of objects in resource maps, as in d1_common.resource_map
+RESOLVE_URL = d1_common.url.joinPathElements(d1_common.const.URL_DATAONE_ROOT,
+                                             d1_common.type_conversions.get_version_tag(2), 'resolve')
+ORE_NS = 'http://www.openarchives.org/ore/terms/'
+NAMESPACES = {
+    'cito': 'http://purl.org/spar/cito/',
+    'dcterms': 'http://purl.org/dc/terms/',
+    'ore': ORE_NS,
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+}
+ATTR_ENTITIES = {'"': '&quot;'}
+
+
+def pid_uri(pid: str):
+    """
+    Return the URI of ``pid`` in a resource map, escaped for an attribute.
+    """
+    return escape(f'{RESOLVE_URL}/{d1_common.url.encodePathElement(pid)}', ATTR_ENTITIES)
+
+
+def resource_map(ore_pid: str, qdc_pid: str, data_pids: Iterable,
+                 software: str=d1_common.const.ORE_SOFTWARE_ID):
+    """
+    Write the RDF/XML resource map that aggregates the metadata object
+    ``qdc_pid`` and the ``data_pids`` it documents. The graph is the same as
+    that of d1_common.resource_map.createSimpleResourceMap, but it is written
+    directly as text in one pass, so the time taken grows linearly with the
+    number of data objects instead of building and querying an RDF graph.
+    Repeated data PIDs are listed once.
+    Returns the document as UTF-8 bytes.
+    """
+    ore = pid_uri(ore_pid)
+    aggregation = f'{ore}#aggregation'
+    qdc = pid_uri(qdc_pid)
+    data = [(pid, pid_uri(pid)) for pid in dict.fromkeys(data_pids)]
+    xmlns = ' '.join(f'xmlns:{prefix}="{ns}"' for prefix, ns in NAMESPACES.items())
+    parts = [
+        '<?xml version="1.0" encoding="utf-8"?>\n',
+        f'<rdf:RDF {xmlns}>\n',
+        f'  <ore:ResourceMap rdf:about="{ore}">\n',
+        f'    <dcterms:creator>{escape(software)}</dcterms:creator>\n',
+        f'    <dcterms:identifier>{escape(ore_pid)}</dcterms:identifier>\n',
+        f'    <ore:describes rdf:resource="{aggregation}"/>\n',
+        '  </ore:ResourceMap>\n',
+        f'  <ore:Aggregation rdf:about="{aggregation}">\n',
+        f'    <ore:aggregates rdf:resource="{qdc}"/>\n',
+    ]
+    parts.extend(f'    <ore:aggregates rdf:resource="{uri}"/>\n' for _, uri in data)
+    parts.extend([
+        '  </ore:Aggregation>\n',
+        f'  <rdf:Description rdf:about="{ORE_NS}Aggregation">\n',
+        f'    <rdfs:isDefinedBy rdf:resource="{ORE_NS}"/>\n',
+        '    <rdfs:label>Aggregation</rdfs:label>\n',
+        '  </rdf:Description>\n',
+        f'  <rdf:Description rdf:about="{qdc}">\n',
+        f'    <dcterms:identifier>{escape(qdc_pid)}</dcterms:identifier>\n',
+        f'    <ore:isAggregatedBy rdf:resource="{aggregation}"/>\n',
+    ])
+    parts.extend(f'    <cito:documents rdf:resource="{uri}"/>\n' for _, uri in data)
+    parts.append('  </rdf:Description>\n')
+    for pid, uri in data:
+        parts.append(f'  <rdf:Description rdf:about="{uri}">\n'
+                     f'    <dcterms:identifier>{escape(pid)}</dcterms:identifier>\n'
+                     f'    <ore:isAggregatedBy rdf:resource="{aggregation}"/>\n'
+                     f'    <cito:isDocumentedBy rdf:resource="{qdc}"/>\n'
+                     '  </rdf:Description>\n')
+    parts.append('</rdf:RDF>\n')
+    return ''.join(parts).encode('utf-8')
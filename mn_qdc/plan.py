@@ -0,0 +1,376 @@
+import os
+import re
+import gzip
+import json
+import uuid
+import datetime
+from pathlib import Path
+from typing import Iterable, Callable
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from d1_client.mnclient_2_0 import MemberNodeClient_2_0
+
+from logging import getLogger
+
+from . import run
+from .journal import Journal
+from .trace import span
+
+MANIFEST_VERSION = 1
+QDC_FORMAT = 'http://ns.dataone.org/metadata/schema/onedcx/v1.0'
+ORE_FORMAT = 'http://www.openarchives.org/ore/terms'
+DATES = re.compile(r'<(dateUploaded|dateSysMetadataModified)>[^<]*</\1>')
+
+
+class StaleManifestError(Exception):
+    """
+    A planned file changed after it was hashed; the package must be
+    planned again.
+    """
+
+
+class SerializedSysMeta():
+    """
+    System metadata that was serialized at planning time. The MN clients
+    only call toxml() on the sysmeta they are given, so this can be passed
+    in place of a pyxb document without parsing it again.
+    If ``now`` is given, dateUploaded and dateSysMetadataModified are set to
+    it instead of the planning time.
+    """
+    def __init__(self, xml: str, now: datetime.datetime=None):
+        if now:
+            xml = DATES.sub(lambda m: f'<{m[1]}>{now.isoformat()}</{m[1]}>', xml)
+        self.xml = xml.encode('utf-8')
+
+    def toxml(self, encoding: str='utf-8'):
+        return self.xml
+
+
+def open_manifest(path: Path, mode: str='r'):
+    """
+    Open a manifest for reading or writing text; names ending in .gz are
+    gzip-compressed.
+    """
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def read_manifest(path: Path):
+    """
+    Return the manifest header and a generator over its package entries,
+    which are read one line at a time.
+    """
+    f = open_manifest(path)
+    header = json.loads(f.readline())
+    if header.get('manifest') != MANIFEST_VERSION:
+        f.close()
+        raise ValueError(f'{path} is not a version {MANIFEST_VERSION} manifest')
+    def entries():
+        with f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    return header, entries()
+
+
+def ordered_map(ex: ThreadPoolExecutor, fn: Callable, items: Iterable, window: int):
+    """
+    Like ex.map, but consumes ``items`` lazily and keeps at most ``window``
+    calls queued, so that arbitrarily long inputs can be streamed through a
+    pool. Results are yielded in input order.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(ex.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def resolve_package(record: tuple):
+    """
+    First planning stage: find and hash the files of a (doi, qdc) record.
+    Returns (doi, qdc, [(Path, size, digests, stat)]), with an empty list if
+    no files were found. The stat is taken before hashing, so that apply can
+    tell whether the file changed since.
+    """
+    doi, qdc = record
+    with span(run.TRACER, 'search_versions', doi=doi):
+        files = run.search_versions(doi)
+    return doi, qdc, [(f, *run.digest_file(f), st) for f, st in ((f, os.stat(f)) for f in files)]
+
+
+def serialize_package(entry: dict):
+    """
+    Last planning stage: build and serialize the sysmeta of every object and
+    the resource map of a package whose PIDs have been assigned.
+    """
+    now = datetime.datetime.now()
+    alg = run.CHECKSUM_ALGORITHM
+    qdc_bytes = entry['qdc'].encode('utf-8')
+    entry['qdc_sysmeta'] = run.generate_sys_meta(entry['qdc_pid'], entry['doi'], QDC_FORMAT, len(qdc_bytes),
+                                                 run.hash_bytes(qdc_bytes, (alg,))[alg], now,
+                                                 entry['orcid']).toxml('utf-8').decode('utf-8')
+    for obj in entry['objects']:
+        f = Path(obj['path'])
+        obj['sysmeta'] = run.generate_sys_meta(obj['pid'], None, run.get_format(f), obj['size'],
+                                               obj['digests'][alg], now, entry['orcid']).toxml('utf-8').decode('utf-8')
+    with span(run.TRACER, 'ore', doi=entry['doi'], objects=len(entry['data_pids'])):
+        ore_bytes = run.build_resource_map(entry['ore_pid'], entry['qdc_pid'], entry['data_pids'])
+    entry['ore'] = ore_bytes.decode('utf-8')
+    entry['ore_sysmeta'] = run.generate_sys_meta(entry['ore_pid'], run.ore_sid(entry['doi']), ORE_FORMAT,
+                                                 len(ore_bytes), run.hash_bytes(ore_bytes, (alg,))[alg], now,
+                                                 entry['orcid']).toxml('utf-8').decode('utf-8')
+    del entry['orcid'], entry['data_pids']
+    return entry
+
+
+def plan_packages(qdcs: Iterable, orcid: str, manifest: Path, workers: int=1):
+    """
+    Plan the packages for (doi, qdc) records without contacting the MN, and
+    write them to ``manifest`` as JSON lines: a header, then one entry per
+    package with its PIDs, the QDC record and resource map, and the
+    serialized sysmeta of every object. Data objects also list every digest
+    in run.DIGESTS, for later integrity audits, and the inode and mtime the
+    file had when it was hashed.
+
+    Files are resolved and hashed, and sysmeta and resource maps are built,
+    on a pool of ``workers`` threads. PIDs are assigned in record order, so
+    with DEDUP set, content that was already planned is referenced rather
+    than uploaded again; the entry lists the DOI that owns each such object
+    (None for objects found on the MN by pre-flight), and apply waits for
+    that package to be created first.
+    Returns the lists of planned and failed DOIs.
+    """
+    L = getLogger(__name__)
+    owners = {}
+    planned, failed = [], []
+    objects, size = 0, 0
+
+    def assign(resolved):
+        nonlocal objects, size
+        for doi, qdc, files in resolved:
+            if not files:
+                L.error(f'{doi} No files found for this version chain!')
+                failed.append(doi)
+                continue
+            entry = {'doi': doi, 'orcid': orcid, 'qdc_pid': str(uuid.uuid4()), 'qdc': qdc,
+                     'objects': [], 'refs': [], 'ore_pid': str(uuid.uuid4())}
+            data_pids = []
+            new_keys = {}
+            for f, fsize, digests, st in files:
+                key = (fsize, digests[run.CHECKSUM_ALGORITHM])
+                existing = (new_keys.get(key) or run.DEDUP.get(key)) if run.DEDUP else None
+                if existing:
+                    L.info(f'{doi} {f.name} has the same content as {existing}; reusing it')
+                    run.DEDUP.record_saving(fsize)
+                    if key not in new_keys:
+                        entry['refs'].append({'pid': existing, 'owner': owners.get(existing)})
+                    data_pids.append(existing)
+                    continue
+                pid = new_keys[key] = str(uuid.uuid4())
+                entry['objects'].append({'path': str(f), 'pid': pid, 'size': fsize, 'digests': digests,
+                                         'ino': st.st_ino, 'mtime_ns': st.st_mtime_ns})
+                data_pids.append(pid)
+                objects += 1
+                size += fsize
+            if run.DEDUP:
+                for key, pid in new_keys.items():
+                    run.DEDUP.add(key, pid)
+                    owners[pid] = doi
+            entry['refs'] = list({r['pid']: r for r in entry['refs']}.values())
+            entry['data_pids'] = list(dict.fromkeys(data_pids))
+            planned.append(doi)
+            yield entry
+
+    manifest = Path(manifest)
+    manifest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = manifest.with_name(f'{manifest.stem}.tmp{manifest.suffix}')
+    with ThreadPoolExecutor(max_workers=workers) as ex, open_manifest(tmp, 'w') as out:
+        out.write(json.dumps({'manifest': MANIFEST_VERSION, 'created': datetime.datetime.now().isoformat(),
+                              'orcid': orcid, 'data_root': str(run.DATA_ROOT),
+                              'checksum_algorithm': run.CHECKSUM_ALGORITHM}) + '\n')
+        resolved = ordered_map(ex, resolve_package, qdcs, workers * 2)
+        for entry in ordered_map(ex, serialize_package, assign(resolved), workers * 2):
+            out.write(json.dumps(entry, separators=(',', ':')) + '\n')
+    # replace the previous manifest only once the plan is complete
+    tmp.replace(manifest)
+    stats = {'Planned objects': objects,
+             'Planned bytes': f'{size} ({round(size/(1024*1024), 1)} MB)'}
+    if run.DEDUP:
+        stats.update(run.DEDUP.summary())
+    stats.update(run.METRICS.summary())
+    run.report(succ=len(planned), fail=len(failed), finished_dois=planned, failed_dois=failed, stats=stats)
+    L.info(f'Wrote plan for {len(planned)} packages to {manifest}')
+    return planned, failed
+
+
+def apply_package(entry: dict, client: MemberNodeClient_2_0, file_workers: int=1, journal: Journal=None,
+                  wait_for: Callable=None):
+    """
+    Create one planned package on the MN. Nothing is hashed or generated; the
+    QDC record, data files and resource map are streamed with the sysmeta
+    from the manifest, with its upload dates set to the time of apply.
+    A data file whose size, inode or mtime differs from the plan is not
+    uploaded; the package fails with StaleManifestError instead.
+
+    Objects the journal records as created are skipped, so an interrupted
+    apply resumes where it stopped. Transient errors are retried and
+    rolled back as in run.create_package. If the MN does not accept the PIDs
+    of a package that was rolled back, plan it again.
+    :param wait_for: Called with the owner DOI of each referenced object;
+        returns whether the owner package was created
+    """
+    L = getLogger(__name__)
+    doi = entry['doi']
+    qdc_pid, ore_pid = entry['qdc_pid'], entry['ore_pid']
+    for owner in {r['owner'] for r in entry['refs'] if r['owner']}:
+        if not wait_for(owner):
+            raise RuntimeError(f'{doi} reuses objects of {owner}, which was not created')
+    uploaded = []
+    created_qdc = False
+    done = {}
+    now = datetime.datetime.now()
+    if journal:
+        created_qdc = journal.get_qdc_pid(doi) == qdc_pid
+        journal.start(doi)
+        done = journal.get_objects(doi)
+    try:
+        if created_qdc:
+            L.info(f'{doi} Resuming with metadata object {qdc_pid} and {len(done)} data objects')
+        else:
+            L.debug(f'{doi} Uploading metadata object')
+            created_qdc = True
+            qdc_bytes = entry['qdc'].encode('utf-8')
+            run.create_object(client, qdc_pid, qdc_bytes, SerializedSysMeta(entry['qdc_sysmeta'], now),
+                             size=len(qdc_bytes))
+            if journal:
+                journal.set_qdc_pid(doi, qdc_pid)
+        todo = [obj for obj in entry['objects'] if done.get(obj['path']) != obj['pid']]
+        uploaded = [obj['pid'] for obj in entry['objects'] if done.get(obj['path']) == obj['pid']]
+
+        def upload(obj):
+            f = Path(obj['path'])
+            st = os.stat(f)
+            if st.st_size != obj['size'] or (obj.get('mtime_ns') is not None and
+                                             (st.st_ino, st.st_mtime_ns) != (obj['ino'], obj['mtime_ns'])):
+                raise StaleManifestError(f'{doi} {f} changed after it was planned; plan the package again')
+            L.info(f'{doi} Uploading {f.name}')
+            with span(run.TRACER, 'upload', doi=doi, file=f.name, pid=obj['pid']):
+                run.create_object(client, obj['pid'], f, SerializedSysMeta(obj['sysmeta'], now), size=obj['size'])
+            if journal:
+                alg = run.CHECKSUM_ALGORITHM
+                key = (obj['size'], obj['digests'][alg]) if alg in obj['digests'] else None
+                journal.add_object(doi, f, obj['pid'], key, alg)
+
+        if file_workers <= 1:
+            for obj in todo:
+                uploaded.append(obj['pid'])
+                upload(obj)
+        else:
+            with ThreadPoolExecutor(max_workers=file_workers) as ex:
+                futures = [ex.submit(upload, obj) for obj in todo]
+                try:
+                    for fut in futures:
+                        fut.result()
+                finally:
+                    for fut in futures:
+                        fut.cancel()
+                    wait(futures)
+                    uploaded.extend(obj['pid'] for fut, obj in zip(futures, todo) if not fut.cancelled())
+        L.info(f'{doi} Uploading resource map')
+        ore_bytes = entry['ore'].encode('utf-8')
+        run.create_object(client, ore_pid, ore_bytes, SerializedSysMeta(entry['ore_sysmeta'], now),
+                          size=len(ore_bytes))
+        if journal:
+            journal.finish(doi, ore_pid)
+    except Exception as e:
+        L.error(f'{doi} upload failed ({run.describe(e)})')
+        if journal and run.RETRY.is_transient(e):
+            L.info(f'{doi} Keeping the objects created so far for the next run to resume from')
+            raise
+        sizes = {obj['pid']: obj['size'] for obj in entry['objects']}
+        run.rollback(client, doi, [ore_pid] + uploaded + ([qdc_pid] if created_qdc else []), sizes)
+        if journal:
+            journal.fail(doi)
+        raise
+    return qdc_pid
+
+
+def apply_record(i: int, entry: dict, client: MemberNodeClient_2_0, file_workers: int=1, journal: Journal=None,
+                 wait_for: Callable=None):
+    """
+    Apply the plan of a single package. Returns a (doi, success) tuple.
+    """
+    L = getLogger(__name__)
+    doi = entry['doi']
+    if journal and journal.is_done(doi):
+        L.info(f'({i}) {doi} already done according to journal; skipping')
+        return doi, True
+    L.info(f'({i}) Working on {doi}')
+    try:
+        with span(run.TRACER, 'package', doi=doi, record=i):
+            qdc_pid = apply_package(entry, client, file_workers=file_workers, journal=journal, wait_for=wait_for)
+        L.info(f'{doi} done. PID: {qdc_pid}')
+        run.METRICS.inc('packages_total', result='success')
+        return doi, True
+    except Exception as e:
+        L.error(f'{doi} failed: {run.describe(e)}')
+        run.METRICS.inc('packages_total', result='failure')
+        return doi, False
+
+
+def apply_manifest(manifest: Path, orcid: str, client: MemberNodeClient_2_0, workers: int=1, file_workers: int=1,
+                   journal: Journal=None):
+    """
+    Upload the packages planned in ``manifest``, up to ``workers`` at once,
+    and report the results in manifest order. Packages are started in
+    manifest order, so the owner of any object a package reuses has always
+    been started before it.
+    Returns the lists of successful and failed DOIs.
+    """
+    L = getLogger(__name__)
+    header, entries = read_manifest(manifest)
+    if header['orcid'] != orcid:
+        L.warning(f'{manifest} was planned for rightsholder {header["orcid"]}, not {orcid}')
+    L.info(f'Applying plan {manifest} from {header["created"]}')
+    if workers * file_workers > 1:
+        run.size_connection_pool(client, workers * file_workers)
+    futures = {}
+    results = {}
+
+    def wait_for(owner: str):
+        fut = futures.get(owner)
+        return bool(fut and fut.result()[1]) or bool(journal and journal.is_done(owner))
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+            pending = {}
+            try:
+                for i, entry in enumerate(entries, 1):
+                    while len(pending) >= workers * 2:
+                        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for fut in finished:
+                            results[pending.pop(fut)] = fut.result()
+                    fut = ex.submit(apply_record, i, entry, client, file_workers, journal, wait_for)
+                    futures[entry['doi']] = fut
+                    pending[fut] = i
+                for fut, i in pending.items():
+                    results[i] = fut.result()
+            except KeyboardInterrupt:
+                L.info('Caught KeyboardInterrupt; waiting for in-flight packages...')
+                for fut in pending:
+                    fut.cancel()
+                for fut, i in pending.items():
+                    if not fut.cancelled():
+                        results[i] = fut.result()
+    finally:
+        succ_list = [results[i][0] for i in sorted(results) if results[i][1]]
+        err_list = [results[i][0] for i in sorted(results) if not results[i][1]]
+        run.report(succ=len(succ_list), fail=len(err_list), finished_dois=succ_list, failed_dois=err_list,
+                   stats={**run.RETRY.summary(), **(run.LIMITER.summary() if run.LIMITER else {}),
+                          **run.METRICS.summary()})
+    return succ_list, err_list
@@ -0,0 +1,96 @@
+from logging import getLogger
+
+from d1_client.mnclient_2_0 import MemberNodeClient_2_0
+
+from .dedup import DedupRegistry
+from .retry import describe
+from .hashing import normalize
+
+ORE_FORMAT = 'http://www.openarchives.org/ore/terms'
+
+
+def owned_by(client: MemberNodeClient_2_0, orcid: str):
+    """
+    Return a function that checks whether an object on the MN can be reused
+    in a new package: it must belong to ``orcid`` and be neither archived nor
+    obsoleted.
+    """
+    L = getLogger(__name__)
+    def verify(pid: str):
+        try:
+            sm = client.getSystemMetadata(pid)
+        except Exception as e:
+            L.warning(f'Could not verify existing object {pid} ({describe(e)}); not reusing it')
+            return False
+        return reusable(pid, sm, orcid)
+    return verify
+
+
+def aowned_by(aclient, orcid: str):
+    """
+    Async counterpart of owned_by for an aio.AsyncMemberNodeClient.
+    """
+    L = getLogger(__name__)
+    async def verify(pid: str):
+        try:
+            sm = await aclient.getSystemMetadata(pid)
+        except Exception as e:
+            L.warning(f'Could not verify existing object {pid} ({describe(e)}); not reusing it')
+            return False
+        return reusable(pid, sm, orcid)
+    return verify
+
+
+def reusable(pid: str, sm, orcid: str):
+    """
+    Check the sysmeta of an existing object (see owned_by).
+    """
+    L = getLogger(__name__)
+    if sm.rightsHolder.value() != orcid:
+        L.debug(f'{pid} belongs to {sm.rightsHolder.value()}; not reusing it')
+        return False
+    if sm.archived or sm.obsoletedBy:
+        L.debug(f'{pid} is archived or obsoleted; not reusing it')
+        return False
+    return True
+
+
+def same_algorithm(reported: str, algorithm: str):
+    """
+    Compare a checksum algorithm name reported by the MN, which may be
+    spelled e.g. 'SHA256' or 'sha-256', with a DataONE algorithm name.
+    """
+    try:
+        return normalize(reported) == normalize(algorithm)
+    except ValueError:
+        return False
+
+
+def preflight(client: MemberNodeClient_2_0, registry: DedupRegistry, orcid: str, page_size: int=1000,
+              algorithm: str='MD5'):
+    """
+    Page through the MN's listObjects and add every object with a checksum
+    of the given ``algorithm`` (except resource maps) to the dedup registry as a candidate, so
+    that data files already on the node are reused instead of uploaded again.
+
+    listObjects cannot filter by rightsholder, so each candidate is checked
+    against ``orcid`` with getSystemMetadata when it is first matched.
+    Returns the number of candidates found.
+    """
+    L = getLogger(__name__)
+    registry.verify = owned_by(client, orcid)
+    start, found = 0, 0
+    while True:
+        ol = client.listObjects(start=start, count=page_size)
+        infos = ol.objectInfo
+        for info in infos:
+            if info.formatId == ORE_FORMAT or not same_algorithm(info.checksum.algorithm, algorithm):
+                continue
+            registry.add_candidate((int(info.size), info.checksum.value().lower()), info.identifier.value())
+            found += 1
+        start += len(infos)
+        L.info(f'Pre-flight: listed {start}/{ol.total} objects on the MN')
+        if not infos or start >= ol.total:
+            break
+    L.info(f'Pre-flight: {found} existing objects are candidates for reuse')
+    return found
@@ -0,0 +1,143 @@
+import time
+import random
+import asyncio
+import threading
+from typing import Callable
+
+import requests.exceptions
+import d1_common.types.exceptions
+
+from logging import getLogger
+
+# Errors that are worth another attempt: the MN (or a proxy in front of it)
+# answered with a service failure, or the connection broke or timed out.
+# DataONE error documents with an unknown name, such as ServiceUnavailable,
+# are deserialized as ServiceFailure.
+TRANSIENT_ERRORS = (
+    d1_common.types.exceptions.ServiceFailure,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+def describe(e: BaseException):
+    """
+    Short description of an error for the log; DataONE exceptions otherwise
+    include the whole HTTP exchange.
+    """
+    return f'{type(e).__name__}: {getattr(e, "description", None) or e}'
+
+
+class RetryPolicy():
+    """
+    Retries single MN calls that fail with a transient error, with
+    exponential backoff and full jitter: the n-th retry waits a random time
+    between 0 and min(``max_delay``, ``base_delay`` * 2**(n-1)) seconds.
+    Permanent errors, and transient ones that persist for ``attempts``
+    attempts, are raised to the caller.
+
+    The policy also counts retries and the bytes that were sent for nothing,
+    either in failed attempts or in objects that were rolled back, for the
+    run report. It is safe to share between threads and tasks.
+    """
+    def __init__(self, attempts: int=5, base_delay: float=1.0, max_delay: float=60.0,
+                 transient: tuple=TRANSIENT_ERRORS, seed: int=None):
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.transient = transient
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.exhausted = 0
+        self.rolled_back = 0
+        self.wasted_bytes = 0
+
+    def is_transient(self, e: BaseException, transient: tuple=()):
+        return isinstance(e, self.transient + transient)
+
+    def delay(self, attempt: int):
+        """
+        Return the time to wait after the ``attempt``-th failed attempt.
+        """
+        with self._lock:
+            return self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def _failed(self, e: Exception, attempt: int, what: str, size: int, transient: tuple):
+        """
+        Record a failed attempt. Return the delay before the next attempt, or
+        None if the error should be raised.
+        """
+        L = getLogger(__name__)
+        self.waste(size)
+        if not self.is_transient(e, transient):
+            return None
+        if attempt >= self.attempts:
+            with self._lock:
+                self.exhausted += 1
+            L.error(f'{what} failed {attempt} times; giving up ({describe(e)})')
+            return None
+        delay = self.delay(attempt)
+        with self._lock:
+            self.retries += 1
+        L.warning(f'{what} failed ({describe(e)}); retrying in {round(delay, 2)} s '
+                  f'(attempt {attempt + 1} of {self.attempts})')
+        return delay
+
+    def call(self, fn: Callable, what: str='MN call', size: int=0, transient: tuple=()):
+        """
+        Call ``fn()`` until it succeeds, fails permanently or runs out of
+        attempts.
+        :param what: Description of the call for the log
+        :param size: Bytes sent by each attempt, counted as wasted if it fails
+        :param transient: Extra exception types to treat as transient
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return fn()
+            except Exception as e:
+                delay = self._failed(e, attempt, what, size, transient)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+
+    async def acall(self, fn: Callable, what: str='MN call', size: int=0, transient: tuple=()):
+        """
+        Async counterpart of call(); ``fn()`` must return an awaitable.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await fn()
+            except Exception as e:
+                delay = self._failed(e, attempt, what, size, transient)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+
+    def waste(self, size: int):
+        with self._lock:
+            self.wasted_bytes += size
+
+    def record_rollback(self, size: int):
+        """
+        Count a package that was rolled back, and the ``size`` bytes of its
+        objects that were deleted.
+        """
+        with self._lock:
+            self.rolled_back += 1
+            self.wasted_bytes += size
+
+    def summary(self):
+        return {
+            'Retried MN calls': self.retries,
+            'Calls out of retries': self.exhausted,
+            'Rolled back packages': self.rolled_back,
+            'Bytes wasted': f'{self.wasted_bytes} ({round(self.wasted_bytes/(1024*1024), 1)} MB)',
+        }
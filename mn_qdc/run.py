@@ -1,49 +1,65 @@
+import os
+import sys
 import uuid
-import hashlib
 import datetime
 from pathlib import Path
-import json
+from typing import Union, Iterable, Callable
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 
+from requests.adapters import HTTPAdapter
 from d1_client.mnclient_2_0 import *
 from d1_common.types import dataoneTypes
-from d1_common.resource_map import createSimpleResourceMap
+import d1_common.types.exceptions
 
 from logging import getLogger
-from logging.config import dictConfig
-CONFIG_LOC = Path('~/.config/mn-qdc/').expanduser().absolute()
-LOGCONFIG = CONFIG_LOC.joinpath('log/config.json')
-with open(LOGCONFIG, 'r') as lc:
-    LOGGING_CONFIG = json.load(lc)
-dictConfig(LOGGING_CONFIG)
+
+from .config import CONFIG_LOC, LOGCONFIG, JOURNAL_LOC, CHECKSUM_CACHE_LOC, INDEX_LOC,\
+    setup_logging, get_token, load_config
+from .common import fmts, QDC_TAG, DC_IDENTIFIER, parse_qdc_file, parse_records, get_format, report
 
 global DATA_ROOT
 DATA_ROOT = Path('')
-
-try:
-    from .defs import fmts
-except:
-    fmts = {'.xls': 'application/vnd.ms-excel','.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet','.doc': 'application/msword','.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document','.ppt': 'application/vnd.ms-powerpoint','.pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation','.pdf': 'application/pdf','.txt': 'text/plain','.zip': 'application/zip','.ttl': 'text/turtle','.md': 'text/markdown','.rmd': 'text/x-rmarkdown','.csv': 'text/csv','.bmp': 'image/bmp','.gif': 'image/gif','.jpg': 'image/jpeg','.jpeg': 'image/jpeg','.jp2': 'image/jp2','.png': 'image/png','.tif': 'image/geotiff','.svg': 'image/svg+xml','.nc': 'netCDF-4','.py': 'application/x-python','.hdf': 'application/x-hdf','.hdf5': 'application/x-hdf5','.tab': 'text/plain','.gz': 'application/x-gzip','.html': 'text/html','.htm': 'text/html','.xml': 'text/xml','.ps': 'application/postscript','.tsv': 'text/tsv','.rtf': 'application/rtf','.mp4': 'video/mp4','.r': 'application/R','.rar': 'application/x-rar-compressed','.fasta': 'application/x-fasta','.fastq': 'application/x-fasta','.fas': 'application/x-fasta',}
-
-split_str = '<qdc:qualifieddc '
-rpt_txt = """
-Package creation report:
-Failed uploads:     %s
-Successful uploads: %s
-
-Failed packages:
-%s
-
-Successful packages:
-%s
-"""
-
-def get_token():
-    """
-    Paste your auth token into '~/.d1_token'
-    """
-    # Set the D1 token
-    with open(Path(CONFIG_LOC / '.d1_token'), 'r') as tf:
-        return tf.read().split('\n')[0]
+global CHUNK_SIZE
+CHUNK_SIZE = 1024 * 1024
+global CHECKSUM_ALGORITHM
+CHECKSUM_ALGORITHM = 'MD5'
+global DIGESTS
+DIGESTS = ('MD5',)
+global CHECKSUM_CACHE
+CHECKSUM_CACHE = None
+global DATA_INDEX
+DATA_INDEX = None
+global DEDUP
+DEDUP = None
+global RETRY
+global METRICS
+global TRACER
+TRACER = None
+global QUEUE
+QUEUE = None
+global LIMITER
+LIMITER = None
+global DELTA
+DELTA = False
+
+from .journal import Journal
+from .cache import ChecksumCache
+from .index import DataIndex, build_index
+from .dedup import DedupRegistry
+from .preflight import preflight
+from .retry import RetryPolicy, TRANSIENT_ERRORS, describe
+from .adaptive import AdaptiveLimiter
+from .metrics import Metrics, MetricsWriter
+from .trace import Tracer, span
+from .hashing import hash_file, hash_bytes, normalize
+from .workqueue import WorkQueue, LeaseLost, run_shard
+from .schedule import estimate, schedule, log_schedule
+from .delta import ore_sid, record_fingerprint, files_fingerprint
+from .ore import resource_map
+
+RETRY = RetryPolicy()
+METRICS = Metrics()
 
 
 def get_config():
@@ -51,75 +67,129 @@ def get_config():
     Config values that are not the d1 token go in 'config.json'.
     """
     global DATA_ROOT
+    global CHUNK_SIZE
     # Set your ORCID
-    CONFIG = CONFIG_LOC.joinpath('config.json')
-    with open(CONFIG, 'r') as lc:
-        config = json.load(lc)
+    config = load_config()
     DATA_ROOT = Path(config['data_root'])
+    CHUNK_SIZE = int(config.get('chunk_size', CHUNK_SIZE))
+    set_checksum_algorithms(config.get('checksum_algorithm', CHECKSUM_ALGORITHM), config.get('digests', ()))
     return config['rightsholder_orcid'], config['nodeid'], config['mnurl'], config['qdc_file']
 
 
-def parse_qdc_file(qdc_file):
+def set_checksum_algorithms(algorithm: str, digests: Iterable=()):
     """
-    Parse the QDC file. Get rid of the wrapper tags, then split on the
-    split string.
-    Note that each QDC string will be missing the split string, and it
-    will need to be added back in a subsequent step.
+    Set the checksum algorithm used in sysmeta and for dedup, and the
+    digests computed (and cached) for every file; the sysmeta algorithm is
+    always one of them.
     """
-    with open(qdc_file, 'r') as f:
-        qdcb = f.read()
-        qdcs = qdcb.split('<wrapper>')[1].split('</wrapper>')[0].split(f'\n{split_str}')
-    return qdcs
+    global CHECKSUM_ALGORITHM
+    global DIGESTS
+    CHECKSUM_ALGORITHM = normalize(algorithm)
+    DIGESTS = tuple(dict.fromkeys([CHECKSUM_ALGORITHM] + [normalize(a) for a in digests]))
 
 
-def generate_sys_meta(pid: str, sid: str, format_id: str, size: int, md5, now, orcid: str):
+def generate_sys_meta(pid: str, sid: str, format_id: str, size: int, checksum, now, orcid: str,
+                      obsoletes: str=None):
     """
     Fills out the system metadata object with the needed properties
     :param pid: The pid of the system metadata document
+    :param sid: The series ID of the document, or None
     :param format_id: The format of the document being described
     :param size: The size of the document that is being described
-    :param md5: The md5 hash of the document being described
+    :param checksum: The CHECKSUM_ALGORITHM hash of the document being described
     :param now: The current time
     :param orcid: The uploader's orcid
+    :param obsoletes: The pid of the previous version of the document, if this is an update
     """
-    # create sysmeta and fill out relevant fields
-    sys_meta = dataoneTypes.systemMetadata()
-    sys_meta.identifier = str(pid)
-    #sys_meta.seriesId = sid
-    sys_meta.formatId = format_id
-    sys_meta.size = size
-    sys_meta.rightsHolder = orcid
-    # calculate checksums, set dates, and set public access
-    sys_meta.checksum = dataoneTypes.checksum(str(md5))
-    sys_meta.checksum.algorithm = 'MD5'
-    sys_meta.dateUploaded = now
-    sys_meta.dateSysMetadataModified = now
-    sys_meta.accessPolicy = generate_public_access_policy()
+    with METRICS.time('sysmeta'):
+        # create sysmeta and fill out relevant fields
+        sys_meta = dataoneTypes.systemMetadata()
+        sys_meta.identifier = str(pid)
+        if sid:
+            sys_meta.seriesId = sid
+        if obsoletes:
+            sys_meta.obsoletes = obsoletes
+        sys_meta.formatId = format_id
+        sys_meta.size = size
+        sys_meta.rightsHolder = orcid
+        # calculate checksums, set dates, and set public access
+        sys_meta.checksum = dataoneTypes.checksum(str(checksum))
+        sys_meta.checksum.algorithm = CHECKSUM_ALGORITHM
+        sys_meta.dateUploaded = now
+        sys_meta.dateSysMetadataModified = now
+        sys_meta.accessPolicy = generate_public_access_policy()
     return sys_meta
 
 
-def generate_system_metadata(pid: str, sid: str, format_id: str, science_object: bytes, orcid: str):
+def digest_file(path: Path, chunk_size: int=None):
+    """
+    Compute the size and every digest in DIGESTS of a file in a single
+    chunked pass (see hashing.hash_file). If CHECKSUM_CACHE is set and holds
+    all of the digests for the unchanged file, the file is not read at all.
+    :param path: The file to read
+    :param chunk_size: Bytes to read per chunk (defaults to CHUNK_SIZE)
+    :return: A (size, {algorithm: hex digest}) tuple
+    """
+    L = getLogger(__name__)
+    st = os.stat(path)
+    if CHECKSUM_CACHE:
+        digests = {a: CHECKSUM_CACHE.get(path, st, a) for a in DIGESTS}
+        if all(digests.values()):
+            L.debug(f'Using cached checksums for {path}')
+            return st.st_size, digests
+    timings = {}
+    with span(TRACER, 'checksum', file=str(path), bytes=st.st_size, digests=DIGESTS) as sp:
+        size, digests = hash_file(path, DIGESTS, chunk_size or CHUNK_SIZE, timings)
+        sp['read_s'], sp['hash_s'] = round(timings['read'], 6), round(timings['hash'], 6)
+    METRICS.observe('stage_seconds', timings['read'], stage='read')
+    METRICS.observe('stage_seconds', timings['hash'], stage='hash')
+    METRICS.inc('bytes_read_total', size)
+    if CHECKSUM_CACHE:
+        # only cache the digests if the file did not change while it was read
+        after = os.stat(path)
+        if (after.st_ino, after.st_size, after.st_mtime_ns) == (st.st_ino, size, st.st_mtime_ns):
+            CHECKSUM_CACHE.put(path, st, digests)
+    return size, digests
+
+
+def checksum_file(path: Path, chunk_size: int=None):
+    """
+    Return the size and CHECKSUM_ALGORITHM digest of a file, computed along
+    with the other DIGESTS by digest_file. The (size, checksum) tuple is the
+    key used for dedup.
+    :return: A (size, hex digest) tuple
+    """
+    size, digests = digest_file(path, chunk_size)
+    return size, digests[CHECKSUM_ALGORITHM]
+
+
+def generate_system_metadata(pid: str, sid: str, format_id: str, science_object: Union[bytes, str, Path], orcid: str,
+                             obsoletes: str=None):
     """
     Generates a system metadata document.
     :param pid: The pid that the object will have
+    :param sid: The series ID of the object, or None
     :param format_id: The format of the object (e.g text/csv)
-    :param science_object: The object that is being described
+    :param science_object: The object that is being described, or the Path
+        of a file on disk (which will be read in chunks rather than loaded)
+    :param obsoletes: The pid of the previous version of the object, if any
     :return:
     """
     L = getLogger(__name__)
-    # Check that the science_object is unicode, attempt to convert it if it's a str
-    if not isinstance(science_object, bytes):
-        if isinstance(science_object, str):
-            science_object = science_object.encode("utf-8")
-        else:
-            raise ValueError('Supplied science_object is not unicode')
-    size = len(science_object)
+    if isinstance(science_object, Path):
+        size, checksum = checksum_file(science_object)
+    else:
+        # Check that the science_object is unicode, attempt to convert it if it's a str
+        if not isinstance(science_object, bytes):
+            if isinstance(science_object, str):
+                science_object = science_object.encode("utf-8")
+            else:
+                raise ValueError('Supplied science_object is not unicode')
+        size = len(science_object)
+        checksum = hash_bytes(science_object, (CHECKSUM_ALGORITHM,))[CHECKSUM_ALGORITHM]
     L.debug(f'Object is {size} bytes ({round(size/(1024*1024), 1)} MB)')
-    md5 = hashlib.md5()
-    md5.update(science_object)
-    md5 = md5.hexdigest()
     now = datetime.datetime.now()
-    sys_meta = generate_sys_meta(pid, sid, format_id, size, md5, now, orcid)
+    sys_meta = generate_sys_meta(pid, sid, format_id, size, checksum, now, orcid, obsoletes)
     return sys_meta
 
 
@@ -136,19 +206,13 @@ def generate_public_access_policy():
     return accessPolicy
 
 
-def get_format(fmt: Path):
+def build_resource_map(ore_pid: str, qdc_pid: str, data_pids: list):
     """
-    Test the format based on the file suffix. If none is found, fall back to
-    application/octet-stream.
+    Build the resource map that aggregates the metadata object ``qdc_pid``
+    and its data objects, and return it serialized as bytes.
     """
-    L = getLogger(__name__)
-    if fmt.suffix:
-        format_id = fmts.get(fmt.suffix.lower())
-        if format_id:
-            L.debug(f'Found format id {format_id}')
-            return format_id
-    L.debug(f'No format id could be found. Using "application/octet-stream"')
-    return "application/octet-stream"
+    with METRICS.time('ore'):
+        return resource_map(ore_pid, qdc_pid, data_pids)
 
 
 def search_versions(doi: str):
@@ -156,13 +220,16 @@ def search_versions(doi: str):
     Search the directory structure for a given DOI. If no dir is found, then
     decrease the version at the end of the DOI until a directory is found that
     matches. Return a list of files.
+    If DATA_INDEX is set, this is an in-memory lookup and touches no files.
     """
     global DATA_ROOT
     L = getLogger(__name__)
+    if DATA_INDEX:
+        return DATA_INDEX.resolve(doi)
     doidir = Path(DATA_ROOT / doi)
     flist = []
     if doidir.exists():
-        for f in doidir.glob('*'):
+        for f in sorted(doidir.glob('*')):
             flist.append(f)
     else:
         # we need to figure out where the closest version is (or if it exists?)
@@ -201,154 +268,642 @@ def search_versions(doi: str):
     return flist
 
 
-def create_package(orcid: str, doi: str, qdc_bytes: str, client: MemberNodeClient_2_0):
+def create_object(client: MemberNodeClient_2_0, pid: str, obj: Union[bytes, str, Path], sysmeta, size: int=0,
+                  obsoletes: str=None):
+    """
+    MNStorage.create, retried under RETRY if it fails with a transient error;
+    MNStorage.update of ``obsoletes`` to the new ``pid`` if that is given.
+    A Path ``obj`` is opened for each attempt so the multipart body is
+    streamed from disk. If a retry finds the PID already taken, the object
+    was created by an earlier attempt whose response was lost, and it is kept.
+    Each attempt waits for a slot of LIMITER, if set.
+    :param size: The size of the object, counted as wasted by failed attempts
+    """
+    L = getLogger(__name__)
+    attempts = 0
+    def _create():
+        nonlocal attempts
+        attempts += 1
+        try:
+            with LIMITER.slot(size) if LIMITER else nullcontext(), METRICS.time('mn_create'), \
+                    span(TRACER, 'create', pid=pid, bytes=size, attempt=attempts):
+                if isinstance(obj, Path):
+                    with open(obj, 'rb') as stream:
+                        if obsoletes:
+                            return client.update(obsoletes, stream, pid, sysmeta)
+                        return client.create(pid, stream, sysmeta)
+                if obsoletes:
+                    return client.update(obsoletes, obj, pid, sysmeta)
+                return client.create(pid, obj, sysmeta)
+        except d1_common.types.exceptions.IdentifierNotUnique:
+            if attempts == 1:
+                raise
+            L.info(f'{pid} was created by an earlier attempt')
+            return dataoneTypes.identifier(pid)
+    identifier = RETRY.call(_create, what=f'update {obsoletes} to {pid}' if obsoletes else f'create {pid}', size=size)
+    METRICS.inc('objects_created_total')
+    METRICS.inc('bytes_uploaded_total', size)
+    return identifier
+
+
+def renew_lease(doi: str):
+    """
+    In a sharded run, extend the work queue lease of ``doi`` before an MN
+    create. Raises LeaseLost if another shard has taken the record over.
+    """
+    if QUEUE:
+        QUEUE.renew(doi)
+
+
+def rollback(client: MemberNodeClient_2_0, doi: str, pids: list, sizes: dict=None):
+    """
+    Delete the objects of a failed package from the MN. Objects that are not
+    there (because their create never reached the MN) are skipped, and a
+    failed delete does not stop the others from being deleted.
+    :param sizes: Map of PID -> size of the object, to count wasted bytes
+    """
+    L = getLogger(__name__)
+    sizes = sizes or {}
+    L.info(f'{doi} Removing objects...')
+    deleted = 0
+    wasted = 0
+    with METRICS.time('rollback'), span(TRACER, 'rollback', doi=doi, objects=len(pids)):
+        for pid in pids:
+            try:
+                RETRY.call(lambda: client.delete(pid=pid), what=f'delete {pid}')
+                deleted += 1
+                wasted += sizes.get(pid, 0)
+            except d1_common.types.exceptions.NotFound:
+                L.debug(f'{doi} {pid} was not on the MN')
+            except Exception as e:
+                L.error(f'{doi} Could not delete {pid} ({describe(e)}); it must be removed by hand')
+    RETRY.record_rollback(wasted)
+    L.info(f'Successfully deleted {deleted} of {len(pids)} objects.')
+
+
+def upload_data_object(orcid: str, doi: str, f: Path, data_pid: str, client: MemberNodeClient_2_0, journal: Journal=None,
+                       checksum: tuple=None):
+    """
+    Generate sysmeta for a single data file and upload it, recording the PID
+    in the journal once the MN has accepted the object.
+    If the file's (size, checksum) tuple is already known it is not read twice.
+    """
+    with span(TRACER, 'upload', doi=doi, file=f.name, pid=data_pid):
+        return _upload_data_object(orcid, doi, f, data_pid, client, journal, checksum)
+
+
+def _upload_data_object(orcid: str, doi: str, f: Path, data_pid: str, client: MemberNodeClient_2_0,
+                        journal: Journal=None, checksum: tuple=None):
+    L = getLogger(__name__)
+    fformat = get_format(f)
+    L.debug(f'{doi} Generating sysmeta for {f.name}')
+    if checksum:
+        size, digest = checksum
+        data_sm = generate_sys_meta(data_pid, None, fformat, size, digest, datetime.datetime.now(), orcid)
+    else:
+        data_sm = generate_system_metadata(pid=data_pid,
+                                           sid=None,
+                                           format_id=fformat,
+                                           science_object=f,
+                                           orcid=orcid)
+    L.info(f'{doi} Uploading {f.name}')
+    renew_lease(doi)
+    dmd = create_object(client, data_pid, f, data_sm, size=data_sm.size)
+    L.debug(f'{doi} Received response for science object upload', extra={'body': dmd})
+    if journal:
+        journal.add_object(doi, f, data_pid, checksum or (data_sm.size, data_sm.checksum.value()), CHECKSUM_ALGORITHM)
+    return dmd
+
+
+def reserve_object(doi: str, f: Path, key: tuple, new_keys: dict, ticket: int):
+    """
+    Look up the content of a file under DEDUP and reserve a new PID for it if
+    no package has it yet.
+    Returns a (PID, pending, reused) tuple, which is one of:
+
+    - (existing PID, None, reused) to reuse an object; reused tells whether
+      it belongs to another package
+    - (None, future, None) if an earlier package is uploading the content;
+      see DedupRegistry.reserve
+    - (new PID, None, None) if the file is to be uploaded; the PID is added
+      to ``new_keys``
+    """
+    L = getLogger(__name__)
+    existing = new_keys.get(key)
+    other = existing is None
+    pending = None
+    if other:
+        existing = DEDUP.get(key)
+    if not existing:
+        pid = str(uuid.uuid4())
+        existing, pending = DEDUP.reserve(key, pid, ticket)
+        if not (existing or pending):
+            new_keys[key] = pid
+            return pid, None, None
+    if existing:
+        L.info(f'{doi} {f.name} has the same content as {existing}; reusing it')
+        DEDUP.record_saving(key[0])
+        return existing, None, other
+    return None, pending, None
+
+
+def create_package(orcid: str, doi: str, qdc_bytes: str, client: MemberNodeClient_2_0, file_workers: int=1,
+                   journal: Journal=None):
     """
     Create a data package in 6 steps:
 
     1. Generate sysmeta for QDC metadata object
     2. Upload metadata object and its sysmeta
     3. Search the DOI dir structure and generate sysmeta for each data object
-    4. Upload each data object and its sysmeta
+    4. Upload each data object and its sysmeta (up to ``file_workers`` at once)
     5. Generate sysmeta for resource map
     6. Upload resource map and its sysmeta
 
-    If an error is encountered, delete all package PIDs from the MN and raise
-    an error.
+    If a journal is given, objects it records as already created for this DOI
+    are reused instead of uploaded again. If DEDUP is set, files whose content
+    is already on the MN from this run, or repeated within the package, are
+    uploaded once and their PID is reused; content that an earlier concurrent
+    package is still uploading is waited for before the resource map is made.
+
+    If the journal holds a previous version of the DOI (see
+    Journal.begin_update), the metadata object and resource map are created
+    with MNStorage.update as new versions in their series; an unchanged QDC
+    record keeps its metadata object. The previous version is never rolled
+    back.
+
+    Each MN call is retried under RETRY if it fails with a transient error.
+    If an error persists, delete all package PIDs from the MN and raise the
+    error; but if it is a transient error and a journal is kept, the objects
+    created so far are left in place for the next run to resume from.
     """
     L = getLogger(__name__)
     qdc_pid, data_pids, ore_pid = None, None, None
+    uploaded = []
+    paths = {}
+    done = {}
+    reused = set()
+    new_keys = {}
+    prev_qdc, prev_ore = None, None
+    record_fp = record_fingerprint(qdc_bytes)
+    if journal:
+        journal.start(doi)
+        qdc_pid = journal.get_qdc_pid(doi)
+        done = journal.get_objects(doi)
+        reused = journal.reused_pids(doi)
+        prev_qdc, prev_ore = journal.get_previous(doi)
     try:
-        # Create and upload the EML
-        qdc_pid = str(uuid.uuid4())
-        L.debug(f'{doi} Generating sysmeta for metadata object')
-        meta_sm = generate_system_metadata(pid=qdc_pid,
-                                           sid=doi,
-                                           format_id='http://ns.dataone.org/metadata/schema/onedcx/v1.0',
-                                           science_object=qdc_bytes,
-                                           orcid=orcid)
-        L.debug(f'{doi} Uploading metadata object')
-        rmd = client.create(qdc_pid, qdc_bytes, meta_sm)
-        L.debug(f'{doi} Received response for metadata object upload:\n{rmd}')
-        # Get and upload the data
-        doidir = Path(DATA_ROOT / doi)
-        files = []
-        if doidir.exists():
-            files = doidir.glob('*')
+        if qdc_pid:
+            L.info(f'{doi} Resuming with metadata object {qdc_pid} and {len(done)} data objects')
+        elif prev_qdc and journal.get_fingerprints(doi)[0] == record_fp:
+            L.info(f'{doi} QDC record unchanged; keeping metadata object {prev_qdc}')
+            qdc_pid = prev_qdc
+            journal.set_qdc_pid(doi, qdc_pid)
         else:
-            L.info(f'{doidir} does not exist. Trying other versions...')
-            files = search_versions(doi)
-            if len(files) == 0:
-                raise FileNotFoundError(f'{doi} No files found for this version chain!')
-        # keep track of data pids for resource mapping
-        data_pids = []
-        for f in files:
-            fformat = get_format(f)
-            data_pid = str(uuid.uuid4())
-            data_pids.append(data_pid)
-            L.debug(f'{doi} Reading {f.name}')
-            data_bytes = f.read_bytes()
-            L.debug(f'{doi} Generating sysmeta for {f.name}')
-            data_sm = generate_system_metadata(pid=data_pid,
+            # Create and upload the EML
+            qdc_pid = str(uuid.uuid4())
+            L.debug(f'{doi} Generating sysmeta for metadata object')
+            meta_sm = generate_system_metadata(pid=qdc_pid,
                                                sid=doi,
-                                               format_id=fformat,
-                                               science_object=data_bytes,
-                                               orcid=orcid)
-            L.info(f'{doi} Uploading {f.name}')
-            dmd = client.create(data_pid, data_bytes, data_sm)
-            L.debug(f'{doi} Received response for science object upload:\n{dmd}')
-        # Create and upload the resource map
+                                               format_id='http://ns.dataone.org/metadata/schema/onedcx/v1.0',
+                                               science_object=qdc_bytes,
+                                               orcid=orcid,
+                                               obsoletes=prev_qdc)
+            if prev_qdc:
+                L.info(f'{doi} Updating metadata object {prev_qdc}')
+            L.debug(f'{doi} Uploading metadata object')
+            renew_lease(doi)
+            rmd = create_object(client, qdc_pid, qdc_bytes, meta_sm, size=meta_sm.size, obsoletes=prev_qdc)
+            L.debug(f'{doi} Received response for metadata object upload', extra={'body': rmd})
+            if journal:
+                journal.set_qdc_pid(doi, qdc_pid)
+        # Get and upload the data
+        with span(TRACER, 'search_versions', doi=doi) as sp:
+            files = search_versions(doi)
+            sp['files'] = len(files)
+        if len(files) == 0:
+            raise FileNotFoundError(f'{doi} No files found for this version chain!')
+        # keep track of data pids for resource mapping; pids are assigned up
+        # front so their order does not depend on which upload finishes first
+        files = list(files)
+        data_pids = [done.get(str(f)) for f in files]
+        # objects reused from other packages are not ours to roll back
+        paths = {data_pids[i]: files[i] for i in range(len(files)) if data_pids[i] and data_pids[i] not in reused}
+        uploaded = list(paths)
+        todo = [i for i, data_pid in enumerate(data_pids) if not data_pid]
+        keys = {}
+        reuses = {}
+        pending = {}
+        if DEDUP:
+            # hash first so that repeated content is only uploaded once
+            with span(TRACER, 'dedup', doi=doi, files=len(todo)), ThreadPoolExecutor(max_workers=file_workers) as ex:
+                keys = dict(zip(todo, ex.map(checksum_file, [files[i] for i in todo])))
+            ticket = DEDUP.ticket()
+            unique = []
+            for i in todo:
+                data_pids[i], pending[i], reuses[i] = reserve_object(doi, files[i], keys[i], new_keys, ticket)
+                if data_pids[i] and reuses[i] is None:
+                    unique.append(i)
+            pending = {i: fut for i, fut in pending.items() if fut}
+            todo = unique
+        else:
+            for i in todo:
+                data_pids[i] = str(uuid.uuid4())
+        paths.update((data_pids[i], files[i]) for i in todo)
+        if file_workers <= 1:
+            for i in todo:
+                # a failed create may still have reached the MN, so it is rolled back too
+                uploaded.append(data_pids[i])
+                upload_data_object(orcid, doi, files[i], data_pids[i], client, journal, keys.get(i))
+        else:
+            with ThreadPoolExecutor(max_workers=file_workers) as ex:
+                futures = [ex.submit(upload_data_object, orcid, doi, files[i], data_pids[i], client, journal,
+                                     keys.get(i))
+                           for i in todo]
+                try:
+                    for fut in futures:
+                        fut.result()
+                finally:
+                    # stop queued uploads and let running ones finish so that
+                    # every object that may have reached the MN can be rolled back
+                    for fut in futures:
+                        fut.cancel()
+                    wait(futures)
+                    uploaded.extend(data_pids[i] for fut, i in zip(futures, todo) if not fut.cancelled())
+        for i, fut in pending.items():
+            with span(TRACER, 'dedup_wait', doi=doi, file=files[i].name):
+                data_pids[i] = new_keys.get(keys[i]) or fut.result()
+            if data_pids[i]:
+                reuses[i] = keys[i] not in new_keys
+                L.info(f'{doi} {files[i].name} was uploaded by a concurrent package as {data_pids[i]}; reusing it')
+                DEDUP.record_saving(keys[i][0])
+                continue
+            L.info(f'{doi} The package uploading {files[i].name} failed; uploading it here')
+            data_pids[i] = new_keys[keys[i]] = str(uuid.uuid4())
+            paths[data_pids[i]] = files[i]
+            uploaded.append(data_pids[i])
+            upload_data_object(orcid, doi, files[i], data_pids[i], client, journal, keys[i])
+        if journal:
+            # only now that every object exists, so that a resumed run never
+            # lists a PID that is not on the MN yet
+            for i, other in reuses.items():
+                if other is not None:
+                    journal.add_object(doi, files[i], data_pids[i], keys[i], CHECKSUM_ALGORITHM, reused=other)
+        # Create and upload the resource map; reused pids are only listed once
+        data_pids = list(dict.fromkeys(data_pids))
         ore_pid = str(uuid.uuid4())
-        ore = createSimpleResourceMap(ore_pid, qdc_pid, data_pids)
+        with span(TRACER, 'ore', doi=doi, objects=len(data_pids)):
+            ore_bytes = build_resource_map(ore_pid, qdc_pid, data_pids)
         L.debug(f'{doi} Generating sysmeta for resource map')
         ore_meta = generate_system_metadata(pid=ore_pid,
-                                            sid=doi,
+                                            sid=ore_sid(doi),
                                             format_id='http://www.openarchives.org/ore/terms',
-                                            science_object=ore.serialize(),
-                                            orcid=orcid)
-        L.info(f'{doi} Uploading resource map')
-        mmd = client.create(ore_pid, ore.serialize(), ore_meta)
-        L.debug(f'{doi} Received response for resource map upload:\n{mmd}')
+                                            science_object=ore_bytes,
+                                            orcid=orcid,
+                                            obsoletes=prev_ore)
+        L.info(f'{doi} Updating resource map {prev_ore}' if prev_ore else f'{doi} Uploading resource map')
+        # the resource map publishes the package; only the lease holder may create it
+        renew_lease(doi)
+        mmd = create_object(client, ore_pid, ore_bytes, ore_meta, size=ore_meta.size, obsoletes=prev_ore)
+        L.debug(f'{doi} Received response for resource map upload', extra={'body': mmd})
+        if journal:
+            journal.finish(doi, ore_pid, (record_fp, files_fingerprint(files, DATA_ROOT)))
+        if DEDUP:
+            for key, data_pid in new_keys.items():
+                DEDUP.add(key, data_pid)
+            new_keys = {}
     except Exception as e:
-        L.error(f'{doi} upload failed ({e})')
-        L.info(f'Removing objects...')
-        oi = 0
-        if ore_pid:
-            oi += 1
-            client.delete(pid=ore_pid)
-        if data_pids:
-            for pid in data_pids:
-                oi += 1
-                client.delete(pid=pid)
-        if qdc_pid:
-            oi += 1
-            client.delete(pid=qdc_pid)
-        L.info(f'Successfully deleted {oi} objects.')
-        raise BaseException(e)
+        L.error(f'{doi} upload failed ({describe(e)})')
+        if journal and RETRY.is_transient(e):
+            L.info(f'{doi} Keeping the objects created so far for the next run to resume from')
+            raise
+        sizes = {}
+        for pid, f in paths.items():
+            try:
+                sizes[pid] = f.stat().st_size
+            except OSError:
+                pass
+        own_qdc = [qdc_pid] if qdc_pid and qdc_pid != prev_qdc else []
+        rollback(client, doi, ([ore_pid] if ore_pid else []) + uploaded + own_qdc, sizes)
+        if journal:
+            journal.fail(doi)
+        raise
+    finally:
+        # let packages waiting for this one's content upload their own copy
+        for key, data_pid in new_keys.items():
+            DEDUP.release(key, data_pid)
     return qdc_pid
 
 
-def report(succ: int, fail: int, finished_dois: list, failed_dois: list):
+def size_connection_pool(client: MemberNodeClient_2_0, maxsize: int):
+    """
+    Remount the client's HTTP adapters with a connection pool large enough to
+    hold one keep-alive connection per concurrent request.
+    """
+    adapter = HTTPAdapter(pool_connections=maxsize,
+                          pool_maxsize=maxsize,
+                          max_retries=client._try_count)
+    client._session.mount('http://', adapter)
+    client._session.mount('https://', adapter)
+
+
+def package_changed(doi: str, qdc: str, journal: Journal):
     """
-    Generate a short report with the successes and failures of the process.
+    Compare the fingerprints of a finished DOI's QDC record and file set with
+    those recorded in the journal. A DOI finished before fingerprints were
+    recorded gets them now, and counts as unchanged.
     """
     L = getLogger(__name__)
-    finished_str = "\n".join(str(x) for x in finished_dois)
-    failed_str = "\n".join(str(x) for x in failed_dois)
-    L.info(rpt_txt % (fail, succ, failed_str, finished_str))
+    fingerprints = (record_fingerprint(qdc), files_fingerprint([f for f, size in search_sizes(doi)], DATA_ROOT))
+    recorded = journal.get_fingerprints(doi)
+    if None in recorded:
+        L.debug(f'{doi} Recording fingerprints of the uploaded version')
+        journal.set_fingerprints(doi, fingerprints)
+        return False
+    return fingerprints != recorded
 
 
-def create_packages(qdcs: list, orcid: str, client: MemberNodeClient_2_0):
+def package_record(i: int, doi: str, qdc: str, orcid: str, client: MemberNodeClient_2_0, file_workers: int=1,
+                   journal: Journal=None):
     """
-    Package creation and upload loop.
+    Create the package for a single QDC record.
+    Returns a (doi, success) tuple.
+    DOIs that the journal records as done are skipped, unless DELTA is set
+    and the record or its files have changed, in which case the package is
+    updated.
     """
     L = getLogger(__name__)
-    n = len(qdcs)
-    i = 0
-    er = 0
-    succ_list = []
-    err_list = []
+    L.debug(f'({i}) {doi} QDC record', extra={'body': qdc})
+    if journal and journal.is_done(doi):
+        if not (DELTA and package_changed(doi, qdc, journal)):
+            L.info(f'({i}) {doi} already done according to journal; skipping')
+            return doi, True
+        L.info(f'({i}) {doi} changed since it was uploaded; updating it')
+        journal.begin_update(doi)
+    L.info(f'({i}) Working on {doi}')
     try:
-        for qdc in qdcs:
-            i += 1
-            if not qdc:
-                continue
-            qdc = f'{split_str}{qdc}'
-            L.debug(f'QDC:\n{qdc}')
-            doi = qdc.split('<dc:identifier>')[1].split('</dc:identifier>')[0]
-            L.info(f'({i}/{n}) Working on {doi}')
-            try:
-                qdc_pid = create_package(orcid, doi, qdc, client)
-                L.info(f'{doi} done. PID: {qdc_pid}')
-                succ_list.append(doi)
-            except Exception as e:
-                er += 1
-                err_list.append(doi)
-                L.error(f'{doi} / {repr(e)}: {e}')
+        with span(TRACER, 'package', doi=doi, record=i):
+            qdc_pid = create_package(orcid, doi, qdc, client, file_workers=file_workers, journal=journal)
+        L.info(f'{doi} done. PID: {qdc_pid}')
+        METRICS.inc('packages_total', result='success')
+        return doi, True
+    except Exception as e:
+        L.error(f'{doi} failed: {describe(e)}')
+        METRICS.inc('packages_total', result='failure')
+        return doi, False
+
+
+def search_sizes(doi: str):
+    """
+    Return (Path, size) for the files that search_versions finds for a DOI.
+    """
+    if DATA_INDEX:
+        return DATA_INDEX.resolve_entries(doi, quiet=True)
+    sizes = []
+    for f in search_versions(doi):
+        try:
+            sizes.append((f, f.stat().st_size))
+        except OSError:
+            pass
+    return sizes
+
+
+def schedule_records(qdcs: Iterable, workers: int, file_workers: int, throughput: float, journal: Journal=None):
+    """
+    Estimate the cost of every (doi, qdc) record from the sizes of its files
+    and order the records to finish as early as possible with ``workers``
+    workers (see schedule.py), logging the estimated time to completion.
+    All records are read before the first package is started.
+    Returns batches of numbered (i, doi, qdc) records for create_packages.
+    """
+    with METRICS.time('schedule'):
+        estimates = estimate(qdcs, search_sizes, file_workers, throughput, skip=journal.is_done if journal else None)
+        batches, seconds = schedule(estimates, workers)
+    log_schedule(batches, seconds, workers)
+    return [[(e.i, e.doi, e.qdc) for e in batch] for batch in batches]
+
+
+def numbered(qdcs: Iterable):
+    """
+    Turn (doi, qdc) records into batches of one (i, doi, qdc) record each,
+    numbered from 1, as taken by create_packages.
+    """
+    return ([(i, doi, qdc)] for i, (doi, qdc) in enumerate(qdcs, 1))
+
+
+def create_packages(qdcs: Iterable, orcid: str, client: MemberNodeClient_2_0, workers: int=1, file_workers: int=1,
+                    journal: Journal=None, on_result: Callable=None, batched: bool=False):
+    """
+    Package creation and upload loop over (doi, qdc) records, such as those
+    yielded by parse_qdc_file.
+    With more than one worker, packages are created concurrently on a thread
+    pool sharing the client's connection pool. Results are reported in record
+    order regardless of the order in which packages finish.
+    Each package uploads up to ``file_workers`` data objects at once.
+    Progress is recorded in ``journal`` (if given) so that a rerun resumes.
+    If given, ``on_result(doi, success)`` is called as each package finishes.
+    If ``batched``, ``qdcs`` are batches of numbered (i, doi, qdc) records
+    instead (see schedule.py); the records of a batch are created one after
+    the other by the same worker, and reported in the order of their number.
+    Returns the lists of successful and failed DOIs.
+    """
+    L = getLogger(__name__)
+    results = {}
+    def record(i: int, doi: str, qdc: str):
+        result = package_record(i, doi, qdc, orcid, client, file_workers, journal)
+        if on_result:
+            on_result(*result)
+        return result
+    def run_batch(batch: list):
+        return [(i, record(i, doi, qdc)) for i, doi, qdc in batch]
+    batches = qdcs if batched else numbered(qdcs)
+    try:
+        if workers * file_workers > 1:
+            size_connection_pool(client, workers * file_workers)
+        if workers <= 1:
+            for batch in batches:
+                for i, doi, qdc in batch:
+                    results[i] = record(i, doi, qdc)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as ex:
+                pending = {}
+                try:
+                    for batch in batches:
+                        # keep the queue bounded so records are not all held by futures
+                        while len(pending) >= workers * 2:
+                            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                            for fut in done:
+                                del pending[fut]
+                                results.update(fut.result())
+                        pending[ex.submit(run_batch, batch)] = batch
+                    for fut in as_completed(pending):
+                        results.update(fut.result())
+                except KeyboardInterrupt:
+                    L.info('Caught KeyboardInterrupt; waiting for in-flight packages...')
+                    for fut in pending:
+                        fut.cancel()
+                    for fut in pending:
+                        if not fut.cancelled():
+                            results.update(fut.result())
+                    raise
     except KeyboardInterrupt:
         L.info('Caught KeyboardInterrupt; generating report...')
     finally:
-        report(succ=i-1-er, fail=er, finished_dois=succ_list, failed_dois=err_list)
-
-
-def main():
+        succ_list = [results[i][0] for i in sorted(results) if results[i] and results[i][1]]
+        err_list = [results[i][0] for i in sorted(results) if results[i] and not results[i][1]]
+        stats = {}
+        if DEDUP:
+            stats.update(DEDUP.summary())
+        stats.update(RETRY.summary())
+        if LIMITER:
+            stats.update(LIMITER.summary())
+        stats.update(METRICS.summary())
+        report(succ=len(succ_list), fail=len(err_list), finished_dois=succ_list, failed_dois=err_list,
+               stats=stats)
+    return succ_list, err_list
+
+
+def shard_stats():
+    """
+    Return the statistics of this process for the merged report of a
+    sharded run (see workqueue.COUNTERS).
+    """
+    stats = {
+        'retries': RETRY.retries,
+        'exhausted': RETRY.exhausted,
+        'rolled_back': RETRY.rolled_back,
+        'wasted_bytes': RETRY.wasted_bytes,
+        'saved_objects': DEDUP.saved_objects if DEDUP else 0,
+        'saved_bytes': DEDUP.saved_bytes if DEDUP else 0,
+        'stages': {},
+    }
+    for h in METRICS.snapshot()['histograms']:
+        if h['name'] == 'stage_seconds':
+            total, count = stats['stages'].get(h['labels']['stage'], (0.0, 0))
+            stats['stages'][h['labels']['stage']] = (total + h['sum'], count + h['count'])
+    return stats
+
+
+def upload(args):
     """
-    Set config items then start upload loop.
+    Set config items then start upload loop. ``args`` are the parsed
+    options of the upload, plan or apply command (see cli.py).
     """
+    global CHECKSUM_CACHE
+    global DATA_INDEX
+    global DEDUP
+    global RETRY
+    global TRACER
+    global QUEUE
+    global LIMITER
+    global DELTA
     L = getLogger(__name__)
     # Set config items
     auth_token = get_token()
     orcid, node, mn_url, qdc_file = get_config()
+    if args.checksum_algorithm or args.digests is not None:
+        set_checksum_algorithms(args.checksum_algorithm or CHECKSUM_ALGORITHM,
+                                DIGESTS[1:] if args.digests is None else args.digests)
     L.info(f'Rightsholder ORCiD {orcid}')
     L.info(f'Using {node} at {mn_url}')
     L.info(f'Root path: {DATA_ROOT}')
     # Set the token in the request header
     options: dict = {"headers": {"Authorization": "Bearer " + auth_token}}
+    RETRY = RetryPolicy(attempts=args.retries, base_delay=args.retry_delay)
+    TRACER = Tracer(args.trace) if args.trace else None
+    if args.adaptive:
+        transient = TRANSIENT_ERRORS
+        if args.use_async:
+            from .aio import AIO_TRANSIENT_ERRORS
+            transient += AIO_TRANSIENT_ERRORS
+        LIMITER = AdaptiveLimiter(args.max_in_flight if args.use_async else args.workers * args.file_workers,
+                                  transient=transient, metrics=METRICS)
+        L.info(f'Adapting concurrent uploads to the MN: starting at {LIMITER.limit}, at most {LIMITER.maximum}')
     # Create the Member Node Client
     client: MemberNodeClient_2_0 = MemberNodeClient_2_0(mn_url, **options)
-    qdcs = parse_qdc_file(qdc_file)
-    L.info(f'Found {len(qdcs)} QDC records')
-    create_packages(qdcs=qdcs, orcid=orcid, client=client)
+    metrics = MetricsWriter(METRICS, args.metrics, interval=args.metrics_interval) if args.metrics else nullcontext()
+    if args.apply:
+        from .plan import apply_manifest
+        journal = None if args.no_journal else Journal(args.journal)
+        with metrics:
+            apply_manifest(args.apply, orcid, client, workers=args.workers, file_workers=args.file_workers,
+                           journal=journal)
+        client._session.close()
+        if journal:
+            journal.close()
+        if TRACER:
+            TRACER.close()
+        return
+    qdcs = parse_records(qdc_file)
+    L.info(f'Reading records from {qdc_file}')
+    journal = None if args.no_journal or args.plan else Journal(args.journal)
+    DELTA = bool(journal and args.delta)
+    if DELTA:
+        L.info('Delta mode: updating finished packages whose QDC record or files have changed')
+    if not args.no_index:
+        DATA_INDEX = build_index(DATA_ROOT, args.index, workers=args.scan_workers)
+    DEDUP = None if args.no_dedup else DedupRegistry()
+    if DEDUP and journal:
+        seeded = DEDUP.seed(journal.dedup_keys(CHECKSUM_ALGORITHM))
+        L.info(f'Reusing {seeded} objects of finished packages from the journal for dedup')
+    if args.preflight:
+        preflight(client, DEDUP, orcid, algorithm=CHECKSUM_ALGORITHM)
+    CHECKSUM_CACHE = None if args.no_checksum_cache else ChecksumCache(args.checksum_cache)
+    if journal:
+        L.info(f'Using run journal {journal.path} ({journal.summary()})')
+    queue = None
+    if args.queue:
+        queue = QUEUE = WorkQueue(args.queue, lease=args.lease, owner=args.shard_id,
+                                  max_attempts=args.lease_attempts)
+    batches = None
+    if args.schedule and not (queue and queue.is_filled()):
+        batches = schedule_records(qdcs, args.workers, args.max_in_flight if args.use_async else args.file_workers,
+                                   args.throughput * 1024 * 1024, journal)
+    if queue:
+        if not queue.is_filled():
+            # shards claim records in the order they were filled in
+            queue.fill(((doi, qdc) for batch in batches for i, doi, qdc in batch) if batches else qdcs)
+        if args.requeue_failed:
+            L.info(f'Requeued {queue.requeue_failed()} failed records')
+        L.info(f'Shard {queue.owner} using work queue {queue.path} ({queue.summary()})')
+
+    def create(records: Iterable, on_result: Callable=None, batched: bool=False):
+        if args.use_async:
+            from .aio import create_packages_async
+            return create_packages_async(qdcs=records, orcid=orcid, mn_url=mn_url, headers=options['headers'],
+                                         workers=args.workers, max_in_flight=args.max_in_flight, journal=journal,
+                                         on_result=on_result, batched=batched)
+        return create_packages(qdcs=records, orcid=orcid, client=client, workers=args.workers,
+                               file_workers=args.file_workers, journal=journal, on_result=on_result,
+                               batched=batched)
+
+    with metrics:
+        if args.plan:
+            from .plan import plan_packages
+            plan_packages(qdcs, orcid, args.plan, workers=args.workers)
+        elif queue:
+            run_shard(queue, create, shard_stats)
+        elif batches:
+            create(batches, batched=True)
+        else:
+            create(qdcs)
+    if queue:
+        queue.close()
     client._session.close()
+    if journal:
+        journal.close()
+    if TRACER:
+        TRACER.close()
+    if CHECKSUM_CACHE:
+        L.info(f'Checksum cache: {CHECKSUM_CACHE.hits} hits, {CHECKSUM_CACHE.misses} misses')
+        CHECKSUM_CACHE.close()
+
+
+def main():
+    """
+    Entry point of the mnqdc command; same as 'mnqdc upload'.
+    """
+    from .cli import main as cli_main
+    cli_main(['upload'] + sys.argv[1:])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,85 @@
+import heapq
+import datetime
+from typing import Callable, Iterable, NamedTuple
+
+from logging import getLogger
+
+# cost model defaults: the MN calls every package makes (QDC and resource
+# map), each data object, and the upload throughput of one worker
+PACKAGE_SECONDS = 1.0
+OBJECT_SECONDS = 0.2
+THROUGHPUT = 10 * 1024 * 1024
+# packages smaller than this are run in batches of up to BATCH_RECORDS
+TINY_BYTES = 1024 * 1024
+BATCH_RECORDS = 16
+
+
+class Estimate(NamedTuple):
+    i: int
+    doi: str
+    qdc: str
+    files: int
+    size: int
+    seconds: float
+
+
+def estimate(records: Iterable, resolve: Callable, file_workers: int=1, throughput: float=THROUGHPUT,
+             skip: Callable=None):
+    """
+    Estimate the upload time of every (doi, qdc) record.
+    :param resolve: Called with a DOI; returns the (Path, size) of its files
+    :param skip: Called with a DOI; returns whether it is already done, in
+                 which case it is estimated to take no time
+    Returns a list of Estimates, numbered from 1 in record order.
+    """
+    estimates = []
+    for i, (doi, qdc) in enumerate(records, 1):
+        if skip and skip(doi):
+            estimates.append(Estimate(i, doi, qdc, 0, 0, 0.0))
+            continue
+        entries = resolve(doi)
+        size = sum(s for f, s in entries)
+        seconds = PACKAGE_SECONDS + OBJECT_SECONDS * len(entries) / max(1, file_workers) + size / throughput
+        estimates.append(Estimate(i, doi, qdc, len(entries), size, seconds))
+    return estimates
+
+
+def makespan(batches: list, workers: int):
+    """
+    Return the estimated time to run ``batches`` in order on ``workers``
+    workers, each batch going to the first worker that is free.
+    """
+    lanes = [0.0] * max(1, workers)
+    for batch in batches:
+        heapq.heapreplace(lanes, lanes[0] + sum(e.seconds for e in batch))
+    return max(lanes)
+
+
+def schedule(estimates: list, workers: int=1, tiny: int=TINY_BYTES, batch_records: int=BATCH_RECORDS):
+    """
+    Order estimated records to minimize the time until the last one is done:
+    largest first, so that no big package is started when every other
+    worker is about to go idle, then packages under ``tiny`` bytes in
+    batches of up to ``batch_records`` that one worker runs back to back.
+    Returns (batches, estimated seconds with ``workers`` workers); each batch
+    is a list of Estimates.
+    """
+    ordered = sorted(estimates, key=lambda e: e.seconds, reverse=True)
+    batches = [[e] for e in ordered if e.size >= tiny]
+    small = [e for e in ordered if e.size < tiny]
+    batches.extend(small[n:n + batch_records] for n in range(0, len(small), batch_records))
+    return batches, makespan(batches, workers)
+
+
+def log_schedule(batches: list, seconds: float, workers: int):
+    L = getLogger(__name__)
+    estimates = [e for batch in batches for e in batch]
+    size = sum(e.size for e in estimates)
+    L.info(f'Scheduled {len(estimates)} packages ({sum(e.files for e in estimates)} files, '
+           f'{round(size/(1024*1024*1024), 2)} GB) in {len(batches)} batches, largest first')
+    largest = max(estimates, key=lambda e: e.seconds, default=None)
+    if largest and largest.size:
+        L.info(f'Largest package: {largest.doi} ({largest.files} files, '
+               f'{round(largest.size/(1024*1024), 1)} MB)')
+    L.info(f'Estimated time to completion with {workers} workers: '
+           f'{datetime.timedelta(seconds=round(seconds))}')
@@ -1,9 +1,17 @@
-from .run import get_token, get_format, json,\
-    getLogger, MemberNodeClient_2_0, CONFIG_LOC,\
-    parse_qdc_file, split_str, Path, report
+import sys
+from pathlib import Path
+from typing import Iterable
+
+from logging import getLogger
+
+from .config import load_config
+from .common import parse_records, report
+from .index import build_index
 
 global DATA_ROOT
 DATA_ROOT = Path('')
+global DATA_INDEX
+DATA_INDEX = None
 
 
 def get_config():
@@ -12,9 +20,7 @@ def get_config():
     """
     global DATA_ROOT
     # Set your ORCID
-    CONFIG = CONFIG_LOC.joinpath('config.json')
-    with open(CONFIG, 'r') as lc:
-        config = json.load(lc)
+    config = load_config()
     DATA_ROOT = Path(config['data_root'])
     return config['rightsholder_orcid'], config['nodeid'], config['mnurl'], config['qdc_file']
 
@@ -24,9 +30,12 @@ def testpaths(doi: str):
     Test directory structure for a given DOI. If no dir is found, then decrease
     the version at the end of the DOI until a directory is found that matches.
     Return a list of files.
+    If DATA_INDEX is set, this is an in-memory lookup and touches no files.
     """
     global DATA_ROOT
     L = getLogger(__name__)
+    if DATA_INDEX:
+        return DATA_INDEX.resolve(doi)
     doidir = Path(DATA_ROOT / doi)
     flist = []
     if doidir.exists():
@@ -70,25 +79,20 @@ def testpaths(doi: str):
     return flist
 
 
-def testdata(qdcs: list):
+def testdata(qdcs: Iterable):
     """
-    Parse the QDC record and start the directory testing function.
+    Start the directory testing function for each (doi, qdc) record.
     """
     L = getLogger(__name__)
-    n = len(qdcs)
     i = 0
     er = 0
     succ_list = []
     err_list = []
     try:
-        for qdc in qdcs:
+        for doi, qdc in qdcs:
             i += 1
-            if not qdc:
-                continue
-            qdc = f'{split_str}{qdc}'
-            L.debug(f'QDC:\n{qdc}')
-            doi = qdc.split('<dc:identifier>')[1].split('</dc:identifier>')[0]
-            L.info(f'({i}/{n}) Working on {doi}')
+            L.debug(f'{doi} QDC record', extra={'body': qdc})
+            L.info(f'({i}) Working on {doi}')
             try:
                 qdc_files = testpaths(doi)
                 if len(qdc_files) > 0:
@@ -107,26 +111,33 @@ def testdata(qdcs: list):
         report(succ=i-er, fail=er, finished_dois=succ_list, failed_dois=err_list)
 
 
-def main():
+def check_data(args):
     """
-    Set config items then start test loop.
+    Set config items then start test loop. ``args`` are the parsed options
+    of the test command (see cli.py).
+    No MN client or token is needed, since only the data root is checked.
     """
     global DATA_ROOT
+    global DATA_INDEX
     L = getLogger(__name__)
     # Set config items
-    auth_token = get_token()
     orcid, node, mn_url, qdc_file = get_config()
     L.info(f'Rightsholder ORCiD {orcid}')
     L.info(f'Using {node} at {mn_url}')
     L.info(f'Root path: {DATA_ROOT}')
-    # Set the token in the request header
-    options: dict = {"headers": {"Authorization": "Bearer " + auth_token}}
-    # Create the Member Node Client
-    client: MemberNodeClient_2_0 = MemberNodeClient_2_0(mn_url, **options)
-    qdcs = parse_qdc_file(qdc_file)
-    L.info(f'Found {len(qdcs)} QDC records')
+    if not args.no_index:
+        DATA_INDEX = build_index(DATA_ROOT, args.index, workers=args.scan_workers)
+    qdcs = parse_records(qdc_file)
+    L.info(f'Reading records from {qdc_file}')
     testdata(qdcs=qdcs)
-    client._session.close()
+
+
+def main():
+    """
+    Entry point of the testmnqdc command; same as 'mnqdc test'.
+    """
+    from .cli import main as cli_main
+    cli_main(['test'] + sys.argv[1:])
 
 
 if __name__ == "__main__":
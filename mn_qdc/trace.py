@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import itertools
+import threading
+import contextvars
+from pathlib import Path
+from contextlib import contextmanager, nullcontext
+
+# Span arguments set on a disabled tracer end up here and are discarded.
+_DISCARD = {}
+NULL_SPAN = nullcontext(_DISCARD)
+
+# Lane (trace "thread") of the current asyncio task, if it has its own, as
+# a (lane, thread ident) tuple; the context is also copied into to_thread()
+# calls, which must not use the task's lane.
+_LANE = contextvars.ContextVar('lane', default=None)
+
+
+class Tracer():
+    """
+    Records nested spans in the Chrome trace event format, which can be
+    opened in chrome://tracing or https://ui.perfetto.dev.
+
+    Spans are complete ("X") events on the lane of the thread that ran them;
+    nesting is inferred from their timing. asyncio tasks run on a single
+    thread, so a task can take its own lane with lane(). If ``path`` ends in
+    .jsonl, one event is written per line instead of a JSON array.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.jsonl = self.path.suffix == '.jsonl'
+        self._f = open(self.path, 'w')
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._start = time.perf_counter()
+        self._lanes = itertools.count(1)
+        self._named = set()
+        self._first = True
+        if not self.jsonl:
+            self._f.write('[\n')
+
+    def _write(self, event: dict):
+        line = json.dumps(event, separators=(',', ':'), default=str)
+        with self._lock:
+            if self.jsonl:
+                self._f.write(line + '\n')
+            else:
+                self._f.write(line if self._first else ',\n' + line)
+            self._first = False
+
+    def _tid(self):
+        lane = _LANE.get()
+        tid = threading.get_ident()
+        if lane and lane[1] == tid:
+            return lane[0]
+        if tid not in self._named:
+            self._named.add(tid)
+            self._write({'ph': 'M', 'name': 'thread_name', 'pid': self._pid, 'tid': tid,
+                         'args': {'name': threading.current_thread().name}})
+        return tid
+
+    def _now(self):
+        return (time.perf_counter() - self._start) * 1e6
+
+    def lane(self, name: str):
+        """
+        Give the current asyncio task (and the tasks it creates) a lane of
+        its own, labelled ``name``.
+        """
+        tid = -next(self._lanes)
+        self._write({'ph': 'M', 'name': 'thread_name', 'pid': self._pid, 'tid': tid, 'args': {'name': name}})
+        _LANE.set((tid, threading.get_ident()))
+        return tid
+
+    @contextmanager
+    def span(self, name: str, **args):
+        """
+        Record the block as a span. Yields the span's arguments, which may
+        be added to before the block ends.
+        """
+        tid = self._tid()
+        start = self._now()
+        try:
+            yield args
+        finally:
+            self._write({'ph': 'X', 'name': name, 'cat': 'mnqdc', 'pid': self._pid, 'tid': tid,
+                         'ts': round(start, 1), 'dur': round(self._now() - start, 1), 'args': args})
+
+    def close(self):
+        with self._lock:
+            if not self.jsonl:
+                self._f.write('\n]\n')
+            self._f.close()
+
+
+def span(tracer: Tracer, name: str, **args):
+    """
+    tracer.span(name, **args), or a shared no-op context if tracing is off.
+    """
+    return tracer.span(name, **args) if tracer else NULL_SPAN
@@ -0,0 +1,386 @@
+import os
+import json
+import time
+import signal
+import socket
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Callable, Iterable
+from contextlib import contextmanager
+
+from logging import getLogger
+
+from .common import report
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    doi TEXT NOT NULL UNIQUE,
+    qdc TEXT NOT NULL,
+    state TEXT NOT NULL,
+    owner TEXT,
+    expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, seq);
+CREATE TABLE IF NOT EXISTS shards (
+    owner TEXT PRIMARY KEY,
+    host TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    started REAL NOT NULL,
+    finished REAL,
+    stats TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+
+class LeaseLost(Exception):
+    """
+    Another shard has taken over a record whose lease expired.
+    """
+
+
+# Stats that are summed over the shards for the merged report
+COUNTERS = ('retries', 'exhausted', 'rolled_back', 'wasted_bytes', 'saved_objects', 'saved_bytes')
+class WorkQueue():
+    """
+    Queue of (doi, qdc) records shared by several mnqdc processes, on one
+    host or on many hosts with a shared filesystem, kept in a SQLite
+    database.
+
+    A process (shard) takes records with a lease that expires after
+    ``lease`` seconds. The worker creating a package renews its lease with
+    renew() before each MN create, so a lease expires if the shard dies or
+    its package stops making progress; ``lease`` must therefore be longer
+    than the slowest single upload. Expired leases are handed to the next
+    shard that asks, up to ``max_attempts`` times; after that the record is
+    marked failed. A shard whose lease was taken over gets LeaseLost from
+    renew() and rolls its objects back, so only one shard publishes the
+    package; if the lease is lost after the resource map was created, the
+    package may exist twice on the MN, which complete() logs as an error.
+
+    The database does not use WAL, which needs shared memory and does not
+    work over network filesystems. Lease times are wall clock times, so
+    the hosts' clocks must agree to well within ``lease`` seconds.
+    """
+    def __init__(self, path: Path, lease: float=300, owner: str=None, max_attempts: int=3):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lease = lease
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._con.execute('PRAGMA journal_mode=DELETE')
+        self._con.executescript(SCHEMA)
+        # set on SIGINT, to stop claiming records
+        self.stopping = False
+
+    def _execute(self, sql: str, params=()):
+        with self._lock:
+            return self._con.execute(sql, params).fetchall()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Write transaction that takes the database lock up front, so that two
+        shards cannot claim the same record.
+        """
+        with self._lock:
+            self._con.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._con
+            except BaseException:
+                self._con.execute('ROLLBACK')
+                raise
+            self._con.execute('COMMIT')
+
+    def is_filled(self):
+        return bool(self._execute("SELECT 1 FROM meta WHERE key = 'filled'"))
+
+    def fill(self, records: Iterable, batch: int=1000):
+        """
+        Add (doi, qdc) records, such as those yielded by parse_qdc_file, in
+        record order. DOIs already in the queue are left as they are, so
+        several shards may fill the queue at the same time.
+        :return: The number of records added
+        """
+        L = getLogger(__name__)
+        added, rows = 0, []
+        def flush():
+            nonlocal added
+            with self._transaction() as con:
+                before = con.total_changes
+                con.executemany('INSERT OR IGNORE INTO tasks (doi, qdc, state, updated) VALUES (?, ?, ?, ?)', rows)
+                added += con.total_changes - before
+            rows.clear()
+        now = time.time()
+        for doi, qdc in records:
+            rows.append((doi, qdc, PENDING, now))
+            if len(rows) >= batch:
+                flush()
+        if rows:
+            flush()
+        with self._transaction() as con:
+            con.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('filled', ?)", (str(time.time()),))
+        L.info(f'Added {added} records to work queue {self.path}')
+        return added
+
+    def claim(self):
+        """
+        Lease the next pending record, or a record whose lease has expired.
+        Records that have been leased ``max_attempts`` times are marked
+        failed instead of being handed out again.
+        :return: A (doi, qdc) tuple, or None if there is nothing to claim
+        """
+        L = getLogger(__name__)
+        while True:
+            now = time.time()
+            with self._transaction() as con:
+                row = con.execute('SELECT seq, doi, qdc, state, owner, attempts FROM tasks '
+                                  'WHERE state = ? OR (state = ? AND expires < ?) ORDER BY seq LIMIT 1',
+                                  (PENDING, LEASED, now)).fetchone()
+                if row is None:
+                    return None
+                seq, doi, qdc, state, owner, attempts = row
+                if state == LEASED and attempts >= self.max_attempts:
+                    con.execute('UPDATE tasks SET state = ?, owner = NULL, expires = NULL, updated = ? '
+                                'WHERE seq = ?', (FAILED, now, seq))
+                else:
+                    con.execute('UPDATE tasks SET state = ?, owner = ?, expires = ?, attempts = attempts + 1, '
+                                'updated = ? WHERE seq = ?', (LEASED, self.owner, now + self.lease, now, seq))
+            if state == PENDING:
+                return doi, qdc
+            if attempts >= self.max_attempts:
+                L.error(f'{doi} Lease of {owner} expired after {attempts} attempts; marking failed')
+                continue
+            L.warning(f'{doi} Lease of {owner} expired; reclaiming it (attempt {attempts + 1})')
+            return doi, qdc
+
+    def records(self):
+        """
+        Yield claimed (doi, qdc) records, one claim at a time, until there is
+        nothing left to claim.
+        """
+        while not self.stopping:
+            record = self.claim()
+            if record is None:
+                return
+            yield record
+
+    def complete(self, doi: str, success: bool):
+        """
+        Record the result of a claimed record. A success is always recorded;
+        a failure is not if another shard has taken over the lease.
+        """
+        L = getLogger(__name__)
+        now = time.time()
+        with self._transaction() as con:
+            owner = con.execute('SELECT owner FROM tasks WHERE doi = ? AND state = ?', (doi, LEASED)).fetchone()
+            lost = owner is None or owner[0] != self.owner
+            if success:
+                con.execute('UPDATE tasks SET state = ?, owner = ?, expires = NULL, updated = ? WHERE doi = ?',
+                            (DONE, self.owner, now, doi))
+            elif not lost:
+                con.execute('UPDATE tasks SET state = ?, expires = NULL, updated = ? WHERE doi = ?',
+                            (FAILED, now, doi))
+        if lost and success:
+            L.error(f'{doi} Lease was lost to another shard after the package was published; '
+                    f'it may have been created twice on the MN')
+        elif lost:
+            L.warning(f'{doi} Lease was lost to another shard before the package finished')
+
+    def renew(self, doi: str):
+        """
+        Extend the lease of ``doi`` by ``lease`` seconds.
+        Raises LeaseLost if this shard no longer holds the lease.
+        """
+        with self._transaction() as con:
+            renewed = con.execute('UPDATE tasks SET expires = ? WHERE doi = ? AND owner = ? AND state = ?',
+                                  (time.time() + self.lease, doi, self.owner, LEASED)).rowcount
+        if not renewed:
+            raise LeaseLost(f'{doi} Lease was taken over by another shard')
+
+    def release(self):
+        """
+        Make the records this shard still holds without a result pending
+        again, without counting the attempt.
+        :return: The number of records released
+        """
+        with self._transaction() as con:
+            return con.execute('UPDATE tasks SET state = ?, owner = NULL, expires = NULL, '
+                               'attempts = MAX(attempts - 1, 0), updated = ? WHERE owner = ? AND state = ?',
+                               (PENDING, time.time(), self.owner, LEASED)).rowcount
+
+    def register(self):
+        """
+        Record this shard in the queue, for the merged report.
+        """
+        self._execute('INSERT OR REPLACE INTO shards (owner, host, pid, started) VALUES (?, ?, ?, ?)',
+                      (self.owner, socket.gethostname(), os.getpid(), time.time()))
+
+    def available(self):
+        """
+        Return True if there is a pending record or an expired lease.
+        """
+        return bool(self._execute('SELECT 1 FROM tasks WHERE state = ? OR (state = ? AND expires < ?) LIMIT 1',
+                                  (PENDING, LEASED, time.time())))
+
+    def next_expiry(self):
+        """
+        Return the seconds until the first lease held by another shard
+        expires, or None if no other shard holds a lease.
+        """
+        rows = self._execute('SELECT MIN(expires) FROM tasks WHERE state = ? AND owner != ?',
+                             (LEASED, self.owner))
+        return None if rows[0][0] is None else rows[0][0] - time.time()
+
+    def requeue_failed(self):
+        """
+        Make failed records pending again, with a fresh attempt count.
+        :return: The number of records requeued
+        """
+        with self._transaction() as con:
+            return con.execute('UPDATE tasks SET state = ?, owner = NULL, attempts = 0, updated = ? '
+                               'WHERE state = ?', (PENDING, time.time(), FAILED)).rowcount
+
+    def record_shard(self, stats: dict):
+        """
+        Store this shard's run statistics (see COUNTERS) for the merged report.
+        """
+        self._execute('UPDATE shards SET finished = ?, stats = ? WHERE owner = ?',
+                      (time.time(), json.dumps(stats), self.owner))
+
+    def summary(self):
+        """
+        Return a dict of state -> number of records.
+        """
+        return dict(self._execute('SELECT state, COUNT(*) FROM tasks GROUP BY state'))
+
+    def finished(self):
+        """
+        Return True if every record is done or failed.
+        """
+        return not self._execute('SELECT 1 FROM tasks WHERE state IN (?, ?) LIMIT 1', (PENDING, LEASED))
+
+    def totals(self):
+        """
+        Sum the statistics recorded by the shards.
+        :return: A dict of COUNTERS, plus 'stages', a dict of stage ->
+            (seconds, calls)
+        """
+        totals = dict.fromkeys(COUNTERS, 0)
+        stages = {}
+        for (shard_stats,) in self._execute('SELECT stats FROM shards WHERE stats IS NOT NULL'):
+            shard_stats = json.loads(shard_stats)
+            for k in COUNTERS:
+                totals[k] += shard_stats.get(k, 0)
+            for stage, (total, count) in shard_stats.get('stages', {}).items():
+                t, c = stages.get(stage, (0.0, 0))
+                stages[stage] = (t + total, c + count)
+        totals['stages'] = stages
+        return totals
+
+    def merged(self):
+        """
+        Merge the results of all shards.
+        :return: A (finished DOIs, failed DOIs, stats) tuple, where stats is a
+            dict of report lines
+        """
+        finished = [r[0] for r in self._execute('SELECT doi FROM tasks WHERE state = ? ORDER BY seq', (DONE,))]
+        failed = [r[0] for r in self._execute('SELECT doi FROM tasks WHERE state = ? ORDER BY seq', (FAILED,))]
+        per_shard = dict(self._execute('SELECT owner, COUNT(*) FROM tasks WHERE state = ? GROUP BY owner',
+                                       (DONE,)))
+        stats = {}
+        for owner, started, finished_at in self._execute('SELECT owner, started, finished FROM shards '
+                                                         'ORDER BY started'):
+            elapsed = f'{round(finished_at - started, 1)} s' if finished_at else 'running or died'
+            stats[f'Shard {owner}'] = f'{per_shard.get(owner, 0)} packages, {elapsed}'
+        totals = self.totals()
+        stats['Deduplicated objects'] = totals['saved_objects']
+        stats['Bytes saved'] = f'{totals["saved_bytes"]} ({round(totals["saved_bytes"]/(1024*1024), 1)} MB)'
+        stats['Retried MN calls'] = totals['retries']
+        stats['Calls out of retries'] = totals['exhausted']
+        stats['Rolled back packages'] = totals['rolled_back']
+        stats['Bytes wasted'] = f'{totals["wasted_bytes"]} ({round(totals["wasted_bytes"]/(1024*1024), 1)} MB)'
+        for stage, (total, count) in sorted(totals['stages'].items()):
+            stats[f'Time in {stage}'] = f'{round(total, 1)} s ({count} calls)'
+        return finished, failed, stats
+
+    def report(self):
+        """
+        Generate the report of all shards together.
+        """
+        finished, failed, stats = self.merged()
+        report(succ=len(finished), fail=len(failed), finished_dois=finished, failed_dois=failed, stats=stats)
+
+    def close(self):
+        with self._lock:
+            self._con.close()
+
+
+def run_shard(queue: WorkQueue, create: Callable, stats: Callable, poll: float=5.0):
+    """
+    Process records from ``queue`` until every record is done or failed.
+
+    ``create(records, on_result)`` runs one round of package creation over an
+    iterable of (doi, qdc) records and calls ``on_result(doi, success)`` as
+    each package finishes (see run.create_packages). When there is nothing
+    left to claim but other shards still hold leases, the shard waits, so
+    that it can take over leases that expire.
+    ``stats()`` returns this shard's statistics for the merged report, which
+    is generated by the shard that finishes last.
+
+    On SIGINT the shard stops claiming records. The engines finish or cancel
+    the packages in flight and return; records that were claimed but have
+    no result are released for other shards.
+    """
+    L = getLogger(__name__)
+    def interrupt(signum, frame):
+        queue.stopping = True
+        signal.default_int_handler(signum, frame)
+    queue.register()
+    try:
+        while not queue.stopping:
+            if queue.available():
+                # the async engine installs its own SIGINT handler for the round
+                try:
+                    signal.signal(signal.SIGINT, interrupt)
+                except ValueError:
+                    pass
+                create(queue.records(), queue.complete)
+                if queue.release():
+                    # only an interrupted round leaves claimed records without a result
+                    queue.stopping = True
+                continue
+            wait = queue.next_expiry()
+            if wait is None:
+                break
+            L.debug(f'Waiting for the leases of other shards ({round(wait, 1)} s until the first expires)')
+            time.sleep(min(max(wait, 0.1), poll))
+    except KeyboardInterrupt:
+        queue.stopping = True
+    finally:
+        queue.release()
+        try:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+        except ValueError:
+            pass
+    if queue.stopping:
+        L.info(f'Shard {queue.owner} interrupted; released its unfinished records')
+    queue.record_shard(stats())
+    L.info(f'Shard {queue.owner} finished ({queue.summary()})')
+    if queue.finished():
+        queue.report()
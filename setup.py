@@ -14,9 +14,12 @@ setuptools.setup(
     url='https://github.com/iannesbitt/mn-qdc',
     packages=setuptools.find_packages(),
     include_package_data=True,
+    package_data={'mn_qdc': ['manifest/*.jsonld']},
     install_requires=[
         'dataone.common',
         'dataone.libclient',
+        'lxml',
+        'aiohttp',
         'metapype',
     ],
     extras_require={
@@ -26,8 +29,9 @@ setuptools.setup(
     },
     entry_points = {
         'console_scripts': [
-            'mnqdc=mn_qdc.run:main',
-            'testmnqdc=mn_qdc.test:main'
+            'mnqdc=mn_qdc.cli:main',
+            'testmnqdc=mn_qdc.test:main',
+            'benchmnqdc=mn_qdc.bench:main',
         ],
     },
     python_requires='>=3.9, <4.0',